@@ -0,0 +1,299 @@
+import os
+import re
+import json
+import json_codec
+import user_dict
+from arx_mgr import iter_tweetfile, load_arx, scan_segments
+from tweet_parser import get_extractor, normalize_hashtag
+
+CACHE_DIR = 'aggregates'
+
+# Client name inside the HTML link Twitter gives as a tweet's source
+_SOURCE_LINK = re.compile(r'<a\b[^>]*>(.*?)</a>', re.S)
+
+
+class Aggregator:
+    """
+    A statistic the engine computes over an archive in one pass alongside the others. Each segment gets its own
+    partial state, which is saved in the segment's cache, and the partial states are merged for the report, so
+    subclasses must keep their state as plain JSON values (or convert it in dump and load).
+    """
+    name = None         # Name the aggregator is registered and cached under
+    fields = ()         # Tweet fields it reads (see tweet_parser.FIELDS)
+    version = 1         # Change this when the aggregator changes, to stop using partial states cached before
+
+    def start(self):
+        """
+        :return: Empty partial state
+        """
+        return {}
+
+    def add(self, state, record):
+        """
+        Add one tweet to a partial state.
+        :param record: tweet_parser.TweetRecord with (at least) this aggregator's fields
+        """
+        raise NotImplementedError
+
+    def merge(self, state, other):
+        """
+        Merge another partial state into this one.
+        :return: The merged state
+        """
+        raise NotImplementedError
+
+    def finish(self, state, top=None):
+        """
+        Turn a merged state into the aggregator's result.
+        :param top: Keep only this many of the largest entries, where the result is a ranking
+        :return: JSON-serialisable result (rankings are dictionaries in rank order)
+        """
+        return state
+
+    def dump(self, state):
+        """
+        :return: state as a JSON value, for the cache
+        """
+        return state
+
+    def load(self, data):
+        """
+        :return: State from a JSON value written by dump
+        """
+        return data
+
+
+class TopCounts(Aggregator):
+    """
+    Count the tweets with each key, such as each hashtag, and rank the keys by count.
+    """
+
+    def __init__(self, name, fields, keys):
+        """
+        :param name: Name to register the aggregator under
+        :param fields: Tweet fields keys reads
+        :param keys: Function taking a tweet record and returning the distinct keys it counts toward (strings)
+        """
+        self.name = name
+        self.fields = tuple(fields)
+        self.keys = keys
+
+    def add(self, state, record):
+        for key in self.keys(record):
+            state[key] = state.get(key, 0) + 1
+
+    def merge(self, state, other):
+        for key, count in other.items():
+            state[key] = state.get(key, 0) + count
+        return state
+
+    def finish(self, state, top=None):
+        ranked = sorted(state.items(), key=lambda item : (-item[1], item[0]))
+        return dict(ranked if top is None else ranked[:top])
+
+
+class TweetsPerMinute(Aggregator):
+    """
+    Count the tweets posted in each minute (UTC).
+    """
+    name = 'per_minute'
+    fields = ('timestamp',)
+
+    def add(self, state, record):
+        if record.timestamp is not None:
+            minute = record.timestamp.strftime('%Y-%m-%d %H:%M')
+            state[minute] = state.get(minute, 0) + 1
+
+    def merge(self, state, other):
+        for minute, count in other.items():
+            state[minute] = state.get(minute, 0) + count
+        return state
+
+    def finish(self, state, top=None):
+        return dict(sorted(state.items()))
+
+
+class DistinctUsers(Aggregator):
+    """
+    Count the distinct users who posted tweets.
+    """
+    name = 'distinct_users'
+    fields = ('user_id',)
+
+    def start(self):
+        return set()
+
+    def add(self, state, record):
+        if record.user_id is not None:
+            state.add(record.user_id)
+
+    def merge(self, state, other):
+        state |= other
+        return state
+
+    def finish(self, state, top=None):
+        return len(state)
+
+    def dump(self, state):
+        return sorted(state)
+
+    def load(self, data):
+        return set(data)
+
+
+def _source_name(source):
+    """
+    :return: The client name from a tweet's source, without the HTML link around it
+    """
+    match = _SOURCE_LINK.search(source)
+    return match.group(1) if match else source
+
+# Aggregators by name, in the order reports list them
+AGGREGATORS = {}
+
+def register(aggregator):
+    """
+    Make an aggregator available to reports, replacing any registered under the same name.
+    :param aggregator: Aggregator instance
+    :return: The aggregator
+    """
+    AGGREGATORS[aggregator.name] = aggregator
+    return aggregator
+
+register(TweetsPerMinute())
+register(TopCounts('hashtags', ('hashtags',), lambda record : set(map(normalize_hashtag, record.hashtags))))
+register(TopCounts('sources', ('source',), lambda record : (_source_name(record.source),) if record.source else ()))
+register(TopCounts('langs', ('lang',), lambda record : (record.lang,) if record.lang else ()))
+register(DistinctUsers())
+
+
+def cache_path(job, taj_name):
+    """
+    :param job: Job dictionary with a path to an archive
+    :param taj_name: Filename of the TAJ (no directory)
+    :return: Path of the TAJ's cached partial results
+    """
+    return os.path.join(job['path'], CACHE_DIR, taj_name + '.json')
+
+def load_cache(job, entry):
+    """
+    Load the partial results cached for a TAJ, if they still match the file on disk.
+    :param job: Job dictionary with a path to an archive
+    :param entry: The TAJ's ARX entry
+    :return: Dictionary of aggregator name -> [version, dumped partial state], empty if there's no up-to-date cache
+    """
+    taj_name = os.path.basename(str(entry[0]))
+    try:
+        with open(cache_path(job, taj_name)) as fin:
+            data = json_codec.load(fin)
+        stat = os.stat(os.path.join(job['path'], taj_name))
+    except (OSError, ValueError):
+        return {}
+    if data.get('size') != stat.st_size or data.get('mtime') != stat.st_mtime:
+        return {}
+    return data.get('results', {})
+
+def save_cache(job, entry, results, stat):
+    """
+    Cache the partial results for a TAJ, keyed by the file's size and modification time when it was read.
+    :param job: Job dictionary with a path to an archive
+    :param entry: The TAJ's ARX entry
+    :param results: Dictionary of aggregator name -> [version, dumped partial state]
+    :param stat: os.stat_result of the TAJ from before it was read
+    """
+    taj_name = os.path.basename(str(entry[0]))
+    path = cache_path(job, taj_name)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path + '.tmp', 'w') as fout:
+        json.dump({'taj' : taj_name, 'size' : stat.st_size, 'mtime' : stat.st_mtime, 'results' : results}, fout)
+    os.replace(path + '.tmp', path)
+
+def scan_file(tweetfile, aggregators, task=None):
+    """
+    Run aggregators over every tweet in a file in a single pass.
+    :param tweetfile: Path to a file with one tweet JSON object per line
+    :param aggregators: List of Aggregator
+    :param task: Optional task_mgr.Task to count tweets for and check for cancellation
+    :return: List of partial states, one per aggregator
+    """
+    states = [aggregator.start() for aggregator in aggregators]
+    fields = []
+    for aggregator in aggregators:
+        fields.extend(field for field in aggregator.fields if field not in fields)
+    adders = [(aggregator.add, state) for aggregator, state in zip(aggregators, states)]
+    tweets = iter_tweetfile(tweetfile, users=user_dict.needs_profiles(fields))
+    if task is not None: tweets = task.track(tweets)
+    for record in get_extractor(*fields).extract_iter(tweets):
+        for add, state in adders:
+            add(state, record)
+    return states
+
+def aggregate(job, names=None, use_cache=True, task=None):
+    """
+    Run the registered aggregators over an archive in one pass. Finished TAJ files never change once the next one is
+    started, so each one's partial results are cached beside the archive, and later runs only read the unfinished
+    TAJ, new TAJ files, and any whose cache is missing an aggregator.
+    :param job: Same as for arx_mgr.scan_tweets
+    :param names: Names of the aggregators to run (all registered ones if None)
+    :param use_cache: Read and write cached partial results
+    :param task: Optional task_mgr.Task to report progress to and check for cancellation
+    :return: Dictionary of aggregator name -> merged state
+    :raise KeyError: If an aggregator isn't registered
+    """
+    aggregators = [AGGREGATORS[name] for name in (names if names is not None else list(AGGREGATORS))]
+    totals = [aggregator.start() for aggregator in aggregators]
+    if type(job) is not dict:
+        if task is not None: task.expect(1, None)
+        for idx, state in enumerate(scan_file(job, aggregators, task)):
+            totals[idx] = aggregators[idx].merge(totals[idx], state)
+        if task is not None: task.segment_done(job)
+        return {aggregator.name : total for aggregator, total in zip(aggregators, totals)}
+
+    segments = scan_segments(job)
+    finished = set(entry[0] for entry in load_arx(job)['finished'] or [])
+    if task is not None: task.expect(len(segments), sum(entry[5] for entry in segments))
+    for entry in segments:
+        cacheable = use_cache and os.path.basename(str(entry[0])) in finished
+        cached = load_cache(job, entry) if cacheable else {}
+        states = [None] * len(aggregators)
+        for idx, aggregator in enumerate(aggregators):
+            saved = cached.get(aggregator.name)
+            if saved is not None and saved[0] == aggregator.version:
+                states[idx] = aggregator.load(saved[1])
+
+        # Read the segment for whichever aggregators it has no cached results for
+        missing = [idx for idx, state in enumerate(states) if state is None]
+        if missing:
+            stat = os.stat(str(entry[0]))
+            for idx, state in zip(missing, scan_file(str(entry[0]), [aggregators[idx] for idx in missing], task)):
+                states[idx] = state
+                cached[aggregators[idx].name] = [aggregators[idx].version, aggregators[idx].dump(state)]
+            if cacheable: save_cache(job, entry, cached, stat)
+        elif task is not None:
+            task.tweets_scanned += entry[5]
+
+        for idx, state in enumerate(states):
+            totals[idx] = aggregators[idx].merge(totals[idx], state)
+        if task is not None: task.segment_done(entry)
+    return {aggregator.name : total for aggregator, total in zip(aggregators, totals)}
+
+def report(job, names=None, top=10, use_cache=True, task=None):
+    """
+    Compute the registered statistics for an archive (see aggregate).
+    :param top: Number of entries to keep in rankings, such as the top hashtags (None for all)
+    :return: Dictionary of aggregator name -> result
+    """
+    totals = aggregate(job, names, use_cache, task)
+    return {name : AGGREGATORS[name].finish(total, top) for name, total in totals.items()}
+
+def write_report(job, outfile, names=None, top=10, task=None):
+    """
+    Compute the registered statistics for an archive and save them as JSON.
+    :param outfile: Path of the JSON file to write
+    :return: Dictionary of aggregator name -> result
+    """
+    results = report(job, names, top, task=task)
+    os.makedirs(os.path.dirname(outfile) or '.', exist_ok=True)
+    with open(outfile, 'w') as fout:
+        json.dump(results, fout, indent=4)
+    return results
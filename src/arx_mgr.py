@@ -1,8 +1,19 @@
-import json
+import json_codec
 import os, time
+import threading
 from pathlib import Path
 from uuid import uuid4
 import tweet_parser
+import tweet_store
+import user_dict
+from bloom_filter import BloomFilter
+
+# Tweet fields the per-segment summaries in ARX entries are built from
+SUMMARY_FIELDS = ('lang', 'user_id', 'user_mentions', 'hashtags')
+
+# One lock per archive, held while its ARX is written (see archive_lock)
+_archive_locks = {}
+_archive_locks_lock = threading.Lock()
 
 def enildaer(filename, buf_size=8388608):
     """
@@ -49,8 +60,9 @@ def load_arx(job):
     # If ARX exists, load the JSON into a python dict
     try :
         with open(arx_path) as fin:
-            arx = json.load(fin)
+            arx = json_codec.load(fin)
             job['arx'] = arx
+            job['arx_stat'] = get_stat(fin.fileno())
             return arx
     # If ARX does not exist, create it and return the dict
     except FileNotFoundError:
@@ -61,41 +73,116 @@ def load_arx(job):
             pass
         # Create the base ARX file
         with open(arx_path,'w+') as fout:
-            # Create a blank archive file
-            
-            # Prepend a + to make a key required
-            # All other keys are optional
-            andkeys = []; orkeys = []
-            for keyword in job['keywords']:
-                if keyword[0] == '+':
-                    andkeys.append(keyword[1:])
-                else :
-                    orkeys.append('\"'+keyword+'\"')
-            query = ' '.join([
-                ' '.join(andkeys),
-                ' OR '.join(orkeys)
-            ])
-            
-            # Initialize our archive index with this query
-            arx = {
-                'query' : query,
-                'filters' : None,
-                'unfinished' : None,
-                'finished' : []
-            }
+            arx = new_arx(job)
             job['arx'] = arx
-            json.dump(arx, fout, indent=4, sort_keys=True)
+            json_codec.dump_index(arx, fout)
             return arx
 
+def new_arx(job):
+    """
+    Create a blank archive index for a job's query.
+    :param job: Job dictionary with its keywords
+    :return: ARX dictionary with no TAJ files
+    """
+    # Prepend a + to make a key required
+    # All other keys are optional
+    andkeys = []; orkeys = []
+    for keyword in job['keywords']:
+        if keyword[0] == '+':
+            andkeys.append(keyword[1:])
+        else :
+            orkeys.append('\"'+keyword+'\"')
+    query = ' '.join([
+        ' '.join(andkeys),
+        ' OR '.join(orkeys)
+    ])
+    
+    # Initialize our archive index with this query
+    return {
+        'query' : query,
+        'filters' : None,
+        'unfinished' : None,
+        'finished' : []
+    }
+
+def resolve_archive(job, single_file=False):
+    """
+    Turn a job name, path to an index.arx, or path to a single tweet file into something scan_tweets can read.
+    :param job: Job name (loaded from jobs/<job>.json), path to an index.arx, or path to a tweet file
+    :param single_file: Treat job as a file with one tweet JSON object per line
+    :return: Job dictionary with a 'path' to the archive, or the tweet file path
+    """
+    if len(job) > 4 and job[-4:].lower() == '.arx' and '/' in job:
+        return {'path':job[0:job.rfind('/')]}
+    elif len(job) > 4 and job[-4:].lower() == '.arx' and '\\' in job:
+        return {'path':job[0:job.rfind('\\')]}
+    elif not single_file:
+        with open('jobs/' + job + '.json') as jobfile :
+            return json_codec.load(jobfile)
+    return job
+
 def write_arx(job):
     """
-    Write a new archive index json file
+    Write a new archive index json file. The file is replaced in one step, so readers never see it half-written. If
+    another writer, such as compactor.compact_archive, has rewritten finished segments since this job's ARX was
+    loaded, its changes are merged in first (see merge_published).
     :param job: The job whose archive index you want to update
     """
-    arx = job['arx']
     arx_path = job['path'] + '/index.arx'
-    with open(arx_path,'w+') as fout:
-        json.dump(arx, fout, indent=4, sort_keys=True)
+    with archive_lock(job):
+        if get_stat(arx_path) != job.get('arx_stat'):
+            try:
+                with open(arx_path) as fin:
+                    published = json_codec.load(fin)
+            except (OSError, ValueError):
+                published = None
+            if published is not None and published.get('revision', 0) != job['arx'].get('revision', 0):
+                merge_published(job['arx'], published)
+        with open(arx_path + '.tmp', 'w') as fout:
+            json_codec.dump_index(job['arx'], fout)
+        os.replace(arx_path + '.tmp', arx_path)
+        job['arx_stat'] = get_stat(arx_path)
+
+def archive_lock(job):
+    """
+    :param job: Job dictionary with a path to an archive
+    :return: The lock (a threading.RLock) to hold while reading and rewriting the archive's ARX, shared by every job
+    dictionary for the archive in this process
+    """
+    key = os.path.realpath(job['path'])
+    with _archive_locks_lock:
+        return _archive_locks.setdefault(key, threading.RLock())
+
+def get_stat(path):
+    """
+    :param path: Path of a file, or the descriptor of an open one
+    :return: Tuple identifying the current version of the file, or None if it doesn't exist
+    """
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+    return stat.st_mtime_ns, stat.st_size, stat.st_ino
+
+def merge_published(arx, published):
+    """
+    Bring an ARX held in memory, such as a running collector's, up to date with one another writer published. Other
+    writers only rewrite finished segments before the last one, so the published list is kept up to its last entry,
+    and the entries from there on, which this ARX may have grown or added to, are kept from this one.
+    :param arx: ARX dictionary to update in place
+    :param published: ARX dictionary as read from disk
+    """
+    finished = arx['finished'] if arx['finished'] is not None else []
+    names = [entry[0] for entry in finished]
+    if published.get('finished') and published['finished'][-1][0] in names:
+        last = published['finished'][-1]
+        finished[:] = published['finished'][:-1] + finished[names.index(last[0]):]
+        # Keep a summary another writer added to the last entry (see build_summaries), if it's still unchanged here
+        entry = finished[len(published['finished']) - 1]
+        if len(last) > 6 and last[6] and (len(entry) < 7 or not entry[6]) and entry[5] == last[5]:
+            entry[6:] = [last[6]]
+    for key in ('revision', 'retired', 'store'):
+        if key in published: arx[key] = published[key]
 
 def first_bound(taj_file):
     """
@@ -110,7 +197,7 @@ def first_bound(taj_file):
             line = line.strip()
             if line:
                 try:
-                    tweet = json.loads(line)
+                    tweet = json_codec.loads(line)
                     # Get date and ID bounds from the top of the file
                     if first_date is None: first_date = tweet_parser.getDate(tweet)
                     if first_id is None: first_id = tweet_parser.getTweetID(tweet)
@@ -133,7 +220,7 @@ def last_bound(taj_file) :
             if line:
                 # Get date and ID bounds from the top of the file
                 try:
-                    tweet = json.loads(line)
+                    tweet = json_codec.loads(line)
                     if last_date is None: last_date = tweet_parser.getDate(tweet)
                     if last_id is None : last_id = tweet_parser.getTweetID(tweet)
                 except ValueError:
@@ -206,18 +293,123 @@ def finalize_taj(job):
         arx['finished'][-1][3] = first_time
     
     arx['finished'][-1][5] = arx['unfinished'][5]   # The number of tweets didn't change
+    
+    # Summarize the finished file's contents so scans filtering on them can skip it
+    arx['finished'][-1][6:] = [summarize_taj(path + arx['finished'][-1][0])]
+    
+    # Bring any per-segment indexes up to date with the finished file
+    update_segment_indexes(job, arx['finished'][-1])
+
+def summarize_taj(taj_file):
+    """
+    Summarize which languages, authors, mentioned users and hashtags a TAJ file holds, for pruning scans (see
+    check_summary). The summary is stored as a seventh element of the file's ARX entry.
+    :param taj_file: Path to the TAJ file
+    :return: Dictionary with the sorted list of 'langs', and a Bloom filter (see BloomFilter.to_json) each of
+    'authors' and 'mentions' (user IDs as strings) and 'hashtags' (see tweet_parser.normalize_hashtag)
+    """
+    return summarize_records(tweet_parser.get_extractor(*SUMMARY_FIELDS).extract_iter(
+        iter_tweetfile(taj_file, users=False)))
+
+def summarize_records(records):
+    """
+    Summarize tweets as summarize_taj does, for callers already reading them.
+    :param records: Iterator over tweet_parser.TweetRecord with (at least) SUMMARY_FIELDS
+    :return: Summary dictionary (see summarize_taj)
+    """
+    langs = set(); authors = set(); mentions = set(); hashtags = set()
+    for record in records:
+        if record.lang is not None: langs.add(record.lang)
+        if record.user_id is not None: authors.add(str(record.user_id))
+        mentions.update(map(str, record.user_mentions))
+        hashtags.update(map(tweet_parser.normalize_hashtag, record.hashtags))
+    return {
+        'langs' : sorted(langs),
+        'authors' : BloomFilter.for_items(authors).to_json(),
+        'mentions' : BloomFilter.for_items(mentions).to_json(),
+        'hashtags' : BloomFilter.for_items(hashtags).to_json(),
+    }
+
+def build_summaries(job, task=None):
+    """
+    Add summaries (see summarize_taj) to the ARX entries of finished TAJ files that lack them, such as those of an
+    archive collected before summaries were kept.
+    :param job: Job dictionary with a path to an archive
+    :param task: Optional task_mgr.Task to report progress to and check for cancellation
+    :return: Number of TAJ files summarized
+    """
+    arx = load_arx(job)
+    finished = arx['finished'] or []
+    if task is not None: task.expect(len(finished), sum(entry[5] for entry in finished))
+    summaries = {}  # TAJ name -> (number of tweets when summarized, summary)
+    for entry in finished:
+        if len(entry) < 7 or not entry[6]:
+            summaries[entry[0]] = (entry[5], summarize_taj(job['path'] + '/' + entry[0]))
+        if task is not None:
+            task.tweets_scanned += entry[5]
+            task.segment_done(entry)
+    if not summaries:
+        return 0
+
+    # Publish as compactor.publish does: a new revision makes a running collector merge the summaries in rather than
+    # write over them. Files rewritten since they were summarized are left for the next run.
+    built = 0
+    with archive_lock(job):
+        arx = load_arx(job)
+        for entry in arx['finished'] or []:
+            num, summary = summaries.get(entry[0], (None, None))
+            if summary is not None and entry[5] == num and (len(entry) < 7 or not entry[6]):
+                entry[6:] = [summary]
+                built += 1
+        if built:
+            arx['revision'] = arx.get('revision', 0) + 1
+            write_arx(job)
+    return built
+
+def update_segment_indexes(job, entry):
+    """
+    Rebuild the optional per-segment indexes the job has enabled for a finished TAJ.
+    :param job: The job the TAJ belongs to
+    :param entry: ARX entry of the finished TAJ
+    """
+    # Imported here since the index modules read archives through this one
+    if job.get('edge_store', False):
+        import edge_store
+        edge_store.update_segment(job, entry)
+    if job.get('tag_index', False):
+        import tag_index
+        tag_index.update_segment(job, entry)
+    if job.get('text_index', False):
+        import text_index
+        text_index.update_segment(job, entry)
 
 def append_current_tweets(job, tweets):
     """
     Append the tweets to the end of the latest TAJ in the ARX
     :param job: The collection job these tweets belong to
     :param tweets: List of stringified tweet JSON objects sorted first-to-last by ID. Must not contain line breaks!
+    :raise ValueError: If there are no tweets, or the job names a different shared store than its archive has
     """
     
     if len(tweets) == 0 : raise ValueError
     
     arx = job['arx']; path = job['path'] + '/'
     
+    # Keep the tweets in the shared store, if the job or archive has one, and only refer to them in the TAJ
+    store = job.get('shared_store') or arx.get('store')
+    if store is not None:
+        if arx.get('store') is None:
+            # Name the store before any TAJ refers to it
+            arx['store'] = store
+            write_arx(job)
+        elif arx['store'] != store:
+            raise ValueError('The archive in ' + job['path'] + ' keeps its tweets in the shared store ' +
+                             arx['store'] + ', not ' + store)
+        tweets = tweet_store.share_tweets(store, tweets)
+    # Otherwise keep each state of each user's profile once, in the archive's user dictionary
+    elif job.get('user_dictionary', False):
+        tweets = user_dict.normalize_tweets(job['path'], tweets)
+    
     # Finalize the old unfinished file if it is full
     if 'unfinished' in arx and arx['unfinished'] is not None:
         if os.path.getsize(path+arx['unfinished'][0]) > (job['max_taj_size']*1024*1024):
@@ -301,7 +493,8 @@ def get_prepend_bounds(job):
     else :
         return None, None
 
-def iter_tweetfile(tweetfile, min_id=None, max_id=None, min_date=None, max_date=None, reverse=False):
+def iter_tweetfile(tweetfile, min_id=None, max_id=None, min_date=None, max_date=None, reverse=False, lazy=False,
+                   where=None, users=True):
     """
     
     :param tweetfile: File containing JSON tweets, one per line 
@@ -310,25 +503,43 @@ def iter_tweetfile(tweetfile, min_id=None, max_id=None, min_date=None, max_date=
     :param min_date: Skip tweets before this POSIX timestamp
     :param max_date: Skip tweets after this POSIX timestamp
     :param reverse: Read the file backwards
-    :return: Generator over tweet objects in the file
+    :param lazy: Yield tweet_parser.LazyTweet records that decode only the fields that are read, instead of dicts.
+    Only the tweet ID and date are decoded to check the bounds, so skipped tweets cost little.
+    :param where: Optional tweet_filter.Filter; only tweets matching it are yielded, and lines its prefilter rejects
+    are skipped without being decoded
+    :param users: Swap the stand-ins for user objects kept in the archive's user dictionary back for the full
+    profiles (see user_dict.Rehydrator). Leave this off when only users' IDs and screen names are read.
+    :return: Generator over tweet objects in the file, with tweets kept in a shared store read from it (see
+    tweet_store.Resolver)
     """
     if min_id is None: min_id = -1
     if max_id is None: max_id = float('inf')
     if min_date is None: min_date = -1
     if max_date is None: max_date = float('inf')
     
+    resolve = tweet_store.Resolver(tweetfile)
+    rehydrate = user_dict.Rehydrator(tweetfile) if users else None
     with open(tweetfile, errors="ignore") as fin:
         if reverse: fin = enildaer(fin)
         for line in fin:
-            line = line.strip()
+            line = resolve(line.strip())
             if line:
+                if where is not None and not where.prefilter(line):
+                    continue
+                if rehydrate is not None: line = rehydrate(line)
+                # Lazy tweets aren't decoded in full here, so at least skip lines cut short, as by a crash mid-append
+                if lazy and line[-1] != '}':
+                    continue
                 try:
-                    tweet = json.loads(line)
-                    if (min_id <= tweet_parser.getTweetID(tweet) <= max_id) and \
-                            (min_date <= time.mktime(tweet_parser.getTimeStamp(tweet).timetuple()) <= max_date) :
-                        yield tweet
+                    tweet = tweet_parser.LazyTweet(line) if lazy else json_codec.loads(line)
+                    in_bounds = (min_id <= tweet_parser.getTweetID(tweet) <= max_id) and \
+                            (min_date <= time.mktime(tweet_parser.getTimeStamp(tweet).timetuple()) <= max_date) and \
+                            (where is None or where.match(tweet))
                 except:
                     continue
+                # Yield outside the try block so closing the generator early isn't swallowed as a bad line
+                if in_bounds:
+                    yield tweet
                 
 def check_bounds(arx_entry, min_id=None, max_id=None, min_date=None, max_date=None):
     """
@@ -349,7 +560,88 @@ def check_bounds(arx_entry, min_id=None, max_id=None, min_date=None, max_date=No
         return False
     return True
     
-def scan_tweets(job, min_id=None, max_id=None, min_date=None, max_date=None, reverse=False):
+def check_summary(arx_entry, langs=None, authors=None, mentions=None, hashtags=None):
+    """
+    Return False if the ARX entry's summary (see summarize_taj) shows its file can hold no tweet in one of the
+    languages, AND none by one of the authors, AND so on, or True if it might. Entries without a summary always
+    might. Leave a constraint as None to not check it.
+    :param arx_entry: ARX list (filename, min_id, max_id, min_date, max_date, num_tweets[, summary])
+    :param langs: Language codes
+    :param authors: User IDs of authors
+    :param mentions: User IDs of mentioned users
+    :param hashtags: Hashtags (case and a leading # don't matter)
+    :return: True if the tweet file might hold matching tweets
+    """
+    if len(arx_entry) < 7 or not arx_entry[6]:
+        return True
+    summary = arx_entry[6]
+    if langs is not None and set(langs).isdisjoint(summary['langs']):
+        return False
+    for name, items in (('authors', authors), ('mentions', mentions), ('hashtags', hashtags)):
+        if items is None: continue
+        bloom = BloomFilter.from_json(summary[name])
+        if name == 'hashtags': items = map(tweet_parser.normalize_hashtag, items)
+        if not any(str(item) in bloom for item in items):
+            return False
+    return True
+    
+def scan_segments(job, min_id=None, max_id=None, min_date=None, max_date=None, reverse=False, langs=None,
+                  authors=None, mentions=None, hashtags=None):
+    """
+    List the TAJ files scan_tweets would read for these bounds, in the order it would read them.
+    :param job: Dictionary with a path to an archive index
+    :param min_id: Minimum tweet ID
+    :param max_id: Maximum tweet ID
+    :param min_date: Minimum date (POSIX timestamp)
+    :param max_date: Maximum date (POSIX timestamp)
+    :param reverse: Order the files new-to-old instead of old-to-new
+    :param langs: Also skip files whose summary shows they hold no tweets in these languages (and likewise for the
+    authors, mentions and hashtags; see check_summary)
+    :return: List of ARX entries whose filename has been joined to the archive path
+    """
+    if min_date is None: min_date = -1
+    if max_date is None: max_date = float('inf')
+    
+    arx = load_arx(job)
+    entries = list(arx['finished'] or [])
+    if arx['unfinished'] is not None: entries.append(arx['unfinished'])
+    # Read unfinished file first and finished files new-to-old if going backwards
+    if reverse: entries.reverse()
+    
+    segments = []
+    for entry in entries:
+        # Check bounds to avoid iterating through files unnecessarily
+        try :
+            if not check_bounds(entry, min_id, max_id, min_date, max_date):
+                continue
+        except: # In case a bound was included improperly in the ARX, just check through the whole file
+            pass
+        try:
+            if not check_summary(entry, langs, authors, mentions, hashtags):
+                continue
+        except (KeyError, IndexError, TypeError, ValueError): # Likewise for a malformed summary
+            pass
+        
+        # Relative path correction
+        entry[0] = Path(job['path']).joinpath(Path(entry[0]))
+        segments.append(entry)
+    return segments
+
+def scan_size(job, min_id=None, max_id=None, min_date=None, max_date=None, where=None):
+    """
+    Estimate how much work a scan_tweets call with these bounds will do, using only the ARX.
+    :param job: Same as for scan_tweets
+    :param where: Same as for scan_tweets
+    :return: Tuple of (int) number of TAJ files to read, (int) number of tweets in them (None if unknown)
+    """
+    if type(job) is not dict:
+        return 1, None
+    summary = where.summary() if where is not None else {}
+    segments = scan_segments(job, min_id, max_id, min_date, max_date, **summary)
+    return len(segments), sum(entry[5] for entry in segments)
+
+def scan_tweets(job, min_id=None, max_id=None, min_date=None, max_date=None, reverse=False, on_segment=None,
+                lazy=False, where=None, users=True):
     """
     Generator for iterating through a Tweet archive, one JSON object at a time.
     :param job: Dictionary with a path to an archive index OR a tweet file with one JSON object per line
@@ -361,6 +653,13 @@ def scan_tweets(job, min_id=None, max_id=None, min_date=None, max_date=None, rev
     :param min_date: Minimum date (POSIX timestamp)
     :param max_date: Maximum date (POSIX timestamp)
     :param reverse: Read tweets new-to-old instead of old-to-new
+    :param on_segment: Optional callback, called with each ARX entry (or the file) once its tweets have been read
+    :param lazy: Yield tweet_parser.LazyTweet records instead of dicts, decoding each tweet only as far as it is
+    read. Much cheaper when only a few top-level fields are used, but slower for consumers that read whole tweets.
+    :param where: Optional tweet_filter.Filter; only tweets matching it are yielded. It is pushed down as far as it
+    goes: TAJ files whose ARX summary rules it out are skipped, and lines it can rule out are never decoded.
+    :param users: Give full user profiles where the archive keeps them in a user dictionary (see iter_tweetfile);
+    turn this off when only users' IDs and screen names are read
     :return: Iterator over tweet objects.
     """
     
@@ -369,68 +668,15 @@ def scan_tweets(job, min_id=None, max_id=None, min_date=None, max_date=None, rev
     
     # If arx is a dict, we're reading an archive with an index
     if type(job) is dict:
-        arx = load_arx(job)
-        # Read unfinished file first if going backwards
-        if reverse:
-            if arx['unfinished'] is not None:
-                ufinfile = arx['unfinished']
-                # Skip files outside ID/date bounds
-                try :
-                    unfin_out_of_bounds = not check_bounds(ufinfile, min_id, max_id, min_date, max_date)
-                except :  # In case a bound was included improperly in the ARX, just check through the whole file
-                    unfin_out_of_bounds = False
-                if not unfin_out_of_bounds:
-                    # Relative path correction
-                    ufinfile[0] = Path(job['path']).joinpath(Path(ufinfile[0]))
-                    # Iterate through tweets
-                    for tweet in iter_tweetfile(arx['unfinished'][0], min_id, max_id, min_date, max_date, reverse):
-                        yield tweet
-
-        # Read finished files
-        if arx['finished'] is not None and len(arx['finished']) > 0:
-            
-            # Allow the tweets to be read new-to-old or old-to-new
-            if reverse:
-                fin_files = reversed(arx['finished'])
-            else:
-                fin_files = arx['finished']
-            
-            for finfile in fin_files:
-                
-                # Check bounds to avoid iterating through files unnecessarily
-                try :
-                    if not check_bounds(finfile, min_id, max_id, min_date, max_date):
-                        continue
-                except: # In case a bound was included improperly in the ARX, just check through the whole file
-                    pass
-                
-                # Relative path correction
-                finfile[0] = Path(job['path']).joinpath(Path(finfile[0]))
-                
-                # Iterate through tweets in the file
-                for tweet in iter_tweetfile(finfile[0], min_id, max_id, min_date, max_date, reverse):
-                    yield tweet
-                                
-        # Read unfinished file last if going old-to-new
-        if not reverse:
-            if arx['unfinished'] is not None:
-                ufinfile = arx['unfinished']
-                
-                # Skip files outside ID/date bounds
-                try:
-                    unfin_out_of_bounds = not check_bounds(ufinfile, min_id, max_id, min_date, max_date)
-                except:  # In case a bound was included improperly in the ARX, just check through the whole file
-                    unfin_out_of_bounds = False
-                    
-                if not unfin_out_of_bounds:
-                    # Relative path correction
-                    ufinfile[0] = Path(job['path']).joinpath(Path(ufinfile[0]))
-                    # Iterate through tweets
-                    for tweet in iter_tweetfile(arx['unfinished'][0], min_id, max_id, min_date, max_date, reverse):
-                        yield tweet
+        summary = where.summary() if where is not None else {}
+        for entry in scan_segments(job, min_id, max_id, min_date, max_date, reverse, **summary):
+            # Iterate through tweets in the file
+            for tweet in iter_tweetfile(entry[0], min_id, max_id, min_date, max_date, reverse, lazy, where, users):
+                yield tweet
+            if on_segment is not None: on_segment(entry)
                                     
     # Reading a single file, not an ARX
     else:
-        for tweet in iter_tweetfile(job, min_id, max_id, min_date, max_date, reverse):
+        for tweet in iter_tweetfile(job, min_id, max_id, min_date, max_date, reverse, lazy, where, users):
             yield tweet
-    
+        if on_segment is not None: on_segment(job)
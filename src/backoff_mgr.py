@@ -0,0 +1,76 @@
+import time, threading
+import random
+from budget_mgr import credential_key
+
+# Backoff schedule for each kind of failure: (first delay, longest delay) in seconds. Each consecutive failure of
+# the same kind doubles the delay until it reaches the cap.
+BACKOFF = {
+    'tcp' : (0.25, 16.0),           # Trouble reaching Twitter's servers
+    'http' : (5.0, 320.0),          # HTTP errors from the API
+    'ratelimit' : (60.0, 960.0),    # Twitter wants us to chill out
+    'other' : (5.0, 50.0),          # Anything unexpected
+}
+
+
+class CircuitBreaker :
+    """
+    Failure counters and cooldown for one credential on one API endpoint. Shared by every job using that credential,
+    and kept across collection cycles so repeated failures keep backing off further.
+    """
+
+    def __init__(self, key) :
+        self.key = key
+        self.lock = threading.Lock()
+        self.failures = {kind : 0 for kind in BACKOFF}
+        self.retry_at = 0.0             # Don't call the endpoint again before this POSIX time
+        self.has_succeeded = False      # Whether a request has ever gone through on this endpoint
+
+    def failure(self, kind) :
+        """
+        Record a failure and open the breaker for a jittered, exponentially growing delay.
+        :param kind: One of the keys of BACKOFF
+        :return: Delay before the endpoint may be tried again, in seconds
+        """
+        base, cap = BACKOFF[kind]
+        with self.lock :
+            self.failures[kind] += 1
+            delay = min(cap, base * 2 ** (self.failures[kind] - 1))
+            delay = delay / 2.0 + random.uniform(0.0, delay / 2.0)  # Keep jobs sharing a credential from retrying in lockstep
+            self.retry_at = max(self.retry_at, time.time() + delay)
+            return delay
+
+    def success(self) :
+        """
+        Record a successful request and close the breaker.
+        """
+        with self.lock :
+            for kind in self.failures : self.failures[kind] = 0
+            self.has_succeeded = True
+
+    def wait_time(self) :
+        """
+        :return: Seconds until the endpoint may be tried again (0.0 if it may be tried now)
+        """
+        return max(0.0, self.retry_at - time.time())
+
+
+class BreakerRegistry :
+    """
+    Hand out one CircuitBreaker per credential and endpoint, so that every job on a credential sees the same cooldown.
+    """
+
+    def __init__(self) :
+        self.lock = threading.Lock()
+        self.breakers = {}  # ALWAYS LOCK WHILE USING THIS DICT
+
+    def get(self, job, endpoint) :
+        """
+        :param job: The job dictionary, with 'credfile' and 'app_auth' loaded
+        :param endpoint: API endpoint name, such as 'search/tweets'
+        :return: The CircuitBreaker for this job's credential on this endpoint
+        """
+        key = credential_key(job) + (endpoint,)
+        with self.lock :
+            if key not in self.breakers :
+                self.breakers[key] = CircuitBreaker(key)
+            return self.breakers[key]
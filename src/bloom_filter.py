@@ -0,0 +1,77 @@
+import math
+import base64
+import hashlib
+
+# False-positive rate Bloom filters are sized for by default
+DEFAULT_ERROR = 0.01
+
+
+class BloomFilter:
+    """
+    Set membership test that can give false positives but never false negatives, in a fixed number of bits. Items are
+    hashed with BLAKE2b rather than hash() so a filter gives the same answers in every process it's loaded in.
+    """
+
+    def __init__(self, num_bits, num_hashes, bits=None):
+        """
+        :param num_bits: Size of the filter in bits
+        :param num_hashes: Number of bits set per item
+        :param bits: Contents of the filter (all clear if None)
+        """
+        self.num_bits = num_bits
+        self.num_hashes = num_hashes
+        self.bits = bytearray((num_bits + 7) // 8) if bits is None else bytearray(bits)
+
+    @classmethod
+    def for_items(cls, items, error=DEFAULT_ERROR):
+        """
+        Build a filter holding the items, just large enough for their number.
+        :param items: Strings
+        :param error: Target false-positive rate
+        :return: BloomFilter
+        """
+        items = set(items)
+        if not items:
+            return cls(0, 0)
+        num_bits = max(8, int(math.ceil(-len(items) * math.log(error) / math.log(2) ** 2)))
+        num_bits = (num_bits + 7) // 8 * 8
+        bloom = cls(num_bits, max(1, int(round(num_bits / len(items) * math.log(2)))))
+        for item in items:
+            bloom.add(item)
+        return bloom
+
+    def _positions(self, item):
+        """
+        :return: The bits an item sets, by double hashing one 128-bit digest
+        """
+        digest = hashlib.blake2b(item.encode('utf-8'), digest_size=16).digest()
+        first = int.from_bytes(digest[:8], 'little')
+        step = int.from_bytes(digest[8:], 'little') | 1
+        return [(first + idx * step) % self.num_bits for idx in range(self.num_hashes)]
+
+    def add(self, item):
+        for position in self._positions(item):
+            self.bits[position >> 3] |= 1 << (position & 7)
+
+    def __contains__(self, item):
+        """
+        :return: False if the item was definitely never added, True if it probably was
+        """
+        if self.num_bits == 0:
+            return False
+        bits = self.bits
+        return all(bits[position >> 3] & (1 << (position & 7)) for position in self._positions(item))
+
+    def to_json(self):
+        """
+        :return: [num_bits, num_hashes, base64 of the bits], for storing in an ARX
+        """
+        return [self.num_bits, self.num_hashes, base64.b64encode(bytes(self.bits)).decode('ascii')]
+
+    @classmethod
+    def from_json(cls, data):
+        """
+        :param data: List written by to_json
+        :return: BloomFilter
+        """
+        return cls(data[0], data[1], base64.b64decode(data[2]))
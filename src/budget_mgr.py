@@ -0,0 +1,114 @@
+import time, threading
+
+# Length of Twitter's rate-limiting window, in seconds (plus a little slack)
+RATE_WINDOW = 15.05 * 60.0
+
+
+def credential_key(job) :
+    """
+    Identify the rate limit a job draws from. App-auth limits are per-application and user-auth limits are
+    per-user, and a credfile holds exactly one of each.
+    :param job: The job dictionary
+    :return: Hashable key shared by every job using the same limit
+    """
+    return job['credfile'], bool(job['app_auth'])
+
+
+class BudgetAllocator :
+    """
+    Share each credential's rate-limit budget among the jobs using it, in proportion to how quickly new tweets
+    arrive for each job. Every job keeps a minimum share so quiet topics are still polled.
+    """
+
+    def __init__(self, floor=0.05, smoothing=0.3, saturation_boost=2.0) :
+        """
+        :param floor: Minimum fraction of a credential's budget given to each job
+        :param smoothing: Weight of the newest observation in each job's moving-average arrival rate
+        :param saturation_boost: Multiply the observed rate by this when a cycle's last query comes back full, since
+        the true rate is then higher than we could see
+        """
+        self.floor = floor
+        self.smoothing = smoothing
+        self.saturation_boost = saturation_boost
+
+        self.lock = threading.Lock()
+        self.rates = {}         # ALWAYS LOCK WHILE USING THIS DICT. job name -> tweets/second (None until observed)
+        self.last_seen = {}     # job name -> end of the job's last collection cycle
+        self.credentials = {}   # job name -> credential_key(job)
+
+    def register(self, job) :
+        """
+        Start sharing a credential's budget with this job.
+        :param job: The job dictionary, with 'name', 'credfile' and 'app_auth' loaded
+        """
+        with self.lock :
+            self.credentials[job['name']] = credential_key(job)
+            self.rates.setdefault(job['name'], None)
+            self.last_seen[job['name']] = time.time()
+
+    def unregister(self, job_name) :
+        """
+        Return a stopped job's share to the other jobs on its credential.
+        :param job_name: Name of the job
+        """
+        with self.lock :
+            self.credentials.pop(job_name, None)
+            self.rates.pop(job_name, None)
+            self.last_seen.pop(job_name, None)
+
+    def observe(self, job, num_tweets, saturated=False) :
+        """
+        Record the result of one collection cycle for a job. The rate is measured over the time since the job's
+        previous cycle, so it doesn't depend on how many queries a cycle makes.
+        :param job: The job dictionary
+        :param num_tweets: Number of new tweets the cycle's queries returned in all
+        :param saturated: Whether the cycle's last query came back full, leaving tweets uncollected
+        """
+        now = time.time()
+        with self.lock :
+            name = job['name']
+            if name not in self.credentials : return
+            elapsed = max(now - self.last_seen.get(name, now), 1.0)
+            self.last_seen[name] = now
+
+            rate = num_tweets / elapsed
+            if saturated : rate *= self.saturation_boost
+
+            if self.rates.get(name) is None :
+                self.rates[name] = rate
+            else :
+                self.rates[name] = self.smoothing * rate + (1.0 - self.smoothing) * self.rates[name]
+
+    def share(self, job) :
+        """
+        Get the fraction of its credential's budget this job should use right now.
+        :param job: The job dictionary
+        :return: Fraction between floor and 1.0
+        """
+        with self.lock :
+            key = self.credentials.get(job['name'], credential_key(job))
+            peers = [name for name, cred in self.credentials.items() if cred == key]
+            if job['name'] not in peers : peers.append(job['name'])
+            if len(peers) == 1 : return 1.0
+
+            # Jobs we haven't heard from yet get the average rate so they aren't starved before their first query
+            known = [self.rates[name] for name in peers if self.rates.get(name) is not None]
+            default = sum(known) / len(known) if len(known) > 0 else 0.0
+            rates = {name : (self.rates.get(name) if self.rates.get(name) is not None else default) for name in peers}
+
+        floor = min(self.floor, 1.0 / len(peers))
+        total = sum(rates.values())
+        if total <= 0.0 :
+            return 1.0 / len(peers)
+        return floor + (1.0 - floor * len(peers)) * rates[job['name']] / total
+
+    def cycle_time(self, job, num_queries, max_queries) :
+        """
+        Get how long a collection cycle making num_queries queries should take so that, across all jobs sharing the
+        credential, no more than max_queries are made per rate-limiting window.
+        :param job: The job dictionary
+        :param num_queries: Queries the job will make this cycle
+        :param max_queries: Queries the credential may make per window
+        :return: Cycle length in seconds
+        """
+        return RATE_WINDOW * num_queries / (self.share(job) * max_queries)
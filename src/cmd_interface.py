@@ -1,17 +1,141 @@
 import cmd
+import os
 import time, sys
+import re
 import threading
-import json
-from arx_mgr import scan_tweets
+import arx_mgr
+from arx_mgr import resolve_archive
 from run_job import Job
 from job_mgr import Dispatcher
+import edge_store
+import tag_index
+import text_index
+import tweet_parser
+import tweet_filter
 
-# Import NetworkX if available, for user interaction graph export
-try:
-    import networkx as nx
-    import twitter_graph
-except:
-    nx = None
+import twitter_graph
+import temporal_graph
+import graph_metrics
+import aggregate
+import compactor
+import field_export
+import verifier
+
+def format_task(info):
+    """
+    Render a task_mgr.Task.describe() dictionary as one line for the terminal.
+    """
+    line = 'Task ' + info['id'] + ' (' + info['name'] + ') is ' + info['state'] + ': ' + \
+           str(info['tweets_scanned']) + ' tweets'
+    if info['tweets_total']: line += ' of ~' + str(info['tweets_total'])
+    if info['segments_total'] is not None:
+        line += ', ' + str(info['segments_done']) + '/' + str(info['segments_total']) + ' segments'
+    if info['eta'] is not None: line += ', ETA ' + str(int(info['eta'])) + 's'
+    if info['error'] is not None: line += ' [' + info['error'] + ']'
+    return line
+
+def parse_graph_args(arg, default_outfile):
+    """
+    Parse the job, output file and flags shared by the graph commands (see help exportgraph).
+    :param arg: Text the user typed after the command name
+    :param default_outfile: Output file to use if none is given
+    :return: Dictionary of the job, output file, bounds and interaction options, with any other double-dash flags
+    in 'options' as {flag name : the words after it, or True if there are none}
+    """
+    # Initialize filename and flags to default values
+    job = None; single_file = False; outfile = None
+    min_id = None; max_id = None
+    min_date = None; max_date = None
+    undirected = False; multigraph = False
+    processes = 1
+    options = {}
+    replies = True; repl_explicit = False
+    mentions = False; retweets = False; quotes = False
+    
+    # Scan filename and flags from the user input
+    params = arg.strip()
+    
+    # Get the job or filename
+    if params[0] == '"':
+        end = params.find('"',start=1)+1
+        job = params[:end]
+    elif params[0] == "'":
+        end = params.find("'",start=1)+1
+        job = params[:end]
+    else:
+        job = params.split()[0]
+    params = params[len(job):].strip()  # Remove the file/job name
+    
+    # Get the output filename
+    if len(params) > 0 and params[0] != '-':
+        if params[0] == '"' :
+            end = params.find('"', start=1) + 1
+            outfile = params[:end]
+        elif params[0] == "'" :
+            end = params.find("'", start=1) + 1
+            outfile = params[:end]
+        else :
+            outfile = params.split()[0]
+        params = params[len(outfile):]  # Remove the output filename
+    else:
+        outfile = default_outfile
+        params = ' ' + params
+    
+    # Get the flags
+    flags = params.split(' -')      # Split the remaining string into flags
+    flags.pop(0)                    # Pop the leading empty string from the list of flags
+    for flag in flags:              # Iterate through flags
+        # Check multi-character flags
+        if flag[0] == '-' and len(flag) > 1:
+            flag = flag[1:]
+            if flag.lower() == 'singlefile':
+                single_file = True
+            elif flag.split()[0].lower() == 'date':
+                bounds = flag.split()[1].split(':')
+                try:
+                    min_date = int(bounds[0])
+                except:
+                    pass
+                try:
+                    max_date = int(bounds[1])
+                except:
+                    pass
+            elif flag.split()[0].lower() == 'processes':
+                processes = int(flag.split()[1])
+                if processes < 1: processes = None     # One per CPU
+            elif flag.split()[0].lower() == 'index':
+                bounds = flag.split()[1].split(':')
+                try :
+                    min_id = int(bounds[0])
+                except :
+                    pass
+                try :
+                    max_id = int(bounds[1])
+                except :
+                    pass
+            else:
+                # Leave command-specific flags to the command
+                words = flag.split()
+                options[words[0].lower()] = ' '.join(words[1:]) if len(words) > 1 else True
+        # Check single-character flags
+        else:
+            if 'U' in flag: undirected = True
+            if 'M' in flag: multigraph = True
+            if 'r' in flag: repl_explicit = True
+            if 'm' in flag: mentions = True
+            if 't' in flag: retweets = True
+            if 'q' in flag: quotes = True
+    
+    # Check if user didn't want replies included
+    if (mentions or retweets or quotes) and not repl_explicit: replies = False
+    
+    return {
+        'job' : job, 'single_file' : single_file, 'outfile' : outfile,
+        'min_id' : min_id, 'max_id' : max_id, 'min_date' : min_date, 'max_date' : max_date,
+        'undirected' : undirected, 'multigraph' : multigraph, 'processes' : processes,
+        'replies' : replies, 'mentions' : mentions, 'retweets' : retweets, 'quotes' : quotes,
+        'options' : options,
+    }
 
 class TestCmd(cmd.Cmd):
     
@@ -36,10 +160,12 @@ class TestCmd(cmd.Cmd):
                 print('Ending all collection threads...')
                 for job in self.dispatcher.getJobs():
                     self.dispatcher.setJobStatus(job,Job.STOPPING)
+                self.dispatcher.tasks.shutdown(wait=True)
                 self.dispatcher.ex.shutdown(wait=True)
                 time.sleep(0.1)
                 sys.exit("Ornitholog was terminated by user command.")
             else:
+                self.dispatcher.tasks.shutdown(wait=True)
                 self.dispatcher.ex.shutdown(wait=True)
                 time.sleep(0.1)
                 sys.exit("Ornitholog was terminated by user command.")
@@ -82,11 +208,28 @@ class TestCmd(cmd.Cmd):
         elif arg.lower() == '--all':
             for job in sorted(self.dispatcher.getJobs()):
                 print(job,'is',self.dispatcher.getJobStatus(job).name)
+        elif arg.lower() == '--tasks':
+            tasks = self.dispatcher.tasks.getTasks()
+            if len(tasks) == 0:
+                print('No background tasks.')
+            for task in tasks:
+                print(format_task(task.describe()))
         else:
             print(arg,'is',self.dispatcher.getJobStatus(arg).name)
     def help_status(self):
         print('Return the status of an active job.\n'
-              'ex: \'status my_job\' to check on the job defined in jobs/my_job.json')
+              'ex: \'status my_job\' to check on the job defined in jobs/my_job.json\n'
+              'Use \'status --all\' for every job and \'status --tasks\' for background tasks such as exportgraph')
+    
+    def do_cancel(self, arg):
+        if len(arg.strip()) == 0 :
+            self.onecmd('help cancel')
+        elif self.dispatcher.tasks.cancel(arg.strip()):
+            print('Cancelling task', arg.strip())
+        else:
+            print('Task', arg.strip(), 'is not queued or running.')
+    def help_cancel(self):
+        print('Cancel a background task, such as an export, by the task number shown in \'status --tasks\'.')
         
     def do_list(self, arg):
         print('Not yet implemented.')
@@ -99,116 +242,62 @@ class TestCmd(cmd.Cmd):
         print('The functionality to remove inactive jobs from the list is not yet complete.')
     
     def do_exportgraph(self, arg):
-        
-        # Make sure the user has NetworkX installed
-        if nx is None:
-            print('NetworkX library is required for this feature.')
-            return
-        
-        # Initialize filename and flags to default values
-        job = None; single_file = False; outfile = None
-        min_id = None; max_id = None
-        min_date = None; max_date = None
-        undirected = False; multigraph = False
-        replies = True; repl_explicit = False
-        mentions = False; retweets = False; quotes = False
-        
-        # Scan filename and flags from the user input
         try:
-            params = arg.strip()
-            
-            # Get the job or filename
-            if params[0] == '"':
-                end = params.find('"',start=1)+1
-                job = params[:end]
-            elif params[0] == "'":
-                end = params.find("'",start=1)+1
-                job = params[:end]
-            else:
-                job = params.split()[0]
-            params = params[len(job):].strip()  # Remove the file/job name
-
-            # Get the output filename
-            if len(params) > 0 and params[0] != '-':
-                if params[0] == '"' :
-                    end = params.find('"', start=1) + 1
-                    outfile = params[:end]
-                elif params[0] == "'" :
-                    end = params.find("'", start=1) + 1
-                    outfile = params[:end]
-                else :
-                    outfile = params.split()[0]
-                params = params[len(outfile):]  # Remove the output filename
-            else:
-                outfile = 'data/graph.gml'
-                params = ' ' + params
-
-            # Get the flags
-            flags = params.split(' -')      # Split the remaining string into flags
-            flags.pop(0)                    # Pop the leading empty string from the list of flags
-            for flag in flags:              # Iterate through flags
-                # Check multi-character flags
-                if flag[0] == '-' and len(flag) > 1:
-                    flag = flag[1:]
-                    if flag.lower() == 'singlefile':
-                        single_file = True
-                    elif flag.split()[0].lower() == 'date':
-                        bounds = flag.split()[1].split(':')
-                        try:
-                            min_date = int(bounds[0])
-                        except:
-                            pass
-                        try:
-                            max_date = int(bounds[1])
-                        except:
-                            pass
-                    elif flag.split()[0].lower() == 'index':
-                        bounds = flag.split()[1].split(':')
-                        try :
-                            min_id = int(bounds[0])
-                        except :
-                            pass
-                        try :
-                            max_id = int(bounds[1])
-                        except :
-                            pass
-                # Check single-character flags
-                else:
-                    if 'U' in flag: undirected = True
-                    if 'M' in flag: multigraph = True
-                    if 'r' in flag: repl_explicit = True
-                    if 'm' in flag: mentions = True
-                    if 't' in flag: retweets = True
-                    if 'q' in flag: quotes = True
-                    
-            # Check if user didn't want replies included
-            if (mentions or retweets or quotes) and not repl_explicit: replies = False
-            
+            request = parse_graph_args(arg, 'data/graph.gml')
+            window = request['options'].get('window')
+            step = None
+            if window is not None:
+                bounds = window.split(':')
+                window = int(bounds[0])
+                step = int(bounds[1]) if len(bounds) > 1 and bounds[1] else window
+            dynamic = 'dynamic' in request['options']
+            where = tweet_filter.from_options(request['options'])
         except:
             print('Syntax error in exportgraph request; check your entry.')
             raise
+        outfile = request['outfile']
+        min_id = request['min_id']; max_id = request['max_id']
+        min_date = request['min_date']; max_date = request['max_date']
+        undirected = request['undirected']; multigraph = request['multigraph']
+        processes = request['processes']
+        replies = request['replies']; mentions = request['mentions']
+        retweets = request['retweets']; quotes = request['quotes']
         
         try:
-            if len(job) > 4 and job[-4:].lower() == '.arx' and '/' in job:
-                job = {'path':job[0:job.rfind('/')]}
-            elif len(job) > 4 and job[-4:].lower() == '.arx' and '\\' in job:
-                job = {'path':job[0:job.rfind('\\')]}
-            elif not single_file:
-                with open('jobs/' + job + '.json') as jobfile :
-                    job = json.load(jobfile)
+            job = resolve_archive(request['job'], request['single_file'])
         except:
             print('Unable to load specified job!')
             return
         
-        # Iterate through tweets to build the graph
-        tweetgen = scan_tweets(job, min_id, max_id, min_date, max_date)
-        graph = twitter_graph.build_graph(tweetgen, not undirected, multigraph, replies, mentions, retweets, quotes)
+        # Sliding-window snapshots are written by their own exporter
+        if window is not None:
+            if multigraph:
+                print('Sliding windows can only be used with weighted graphs; drop -M.')
+                return
+            if dynamic and twitter_graph.graph_writers.graph_format(outfile) != 'gexf':
+                print('A dynamic graph can only be written to a .gexf file.')
+                return
+            task = self.dispatcher.tasks.submit('exportgraph ' + outfile, temporal_graph.export_windows,
+                                                job, outfile, window, step, min_id, max_id, min_date, max_date,
+                                                not undirected, replies, mentions, retweets, quotes, dynamic, where)
+            print('Exporting windowed graphs to', outfile, 'as task', task.task_id + '.')
+            return
         
-        # Write the graph to file
-        nx.write_gml(graph, outfile)
+        # Build and write the graph in the background so the terminal stays responsive
+        task = self.dispatcher.tasks.submit('exportgraph ' + outfile, twitter_graph.export_graph,
+                                            job, outfile, min_id, max_id, min_date, max_date,
+                                            not undirected, multigraph, replies, mentions, retweets, quotes,
+                                            processes, where)
+        print('Exporting graph to', outfile, 'as task', task.task_id +
+              '. Use \'status --tasks\' to check on it or \'cancel', task.task_id + '\' to stop it.')
     def help_exportgraph(self):
         print('Build and export the user interaction graph of a specified job or index.arx'+
               '\nfile. If no output file is specified, the graph is saved to data/graph.gml.'+
+              '\nThe format follows the output file\'s extension: .gml, .gexf, or .csv for an edge'+
+              '\nlist plus a <name>-nodes.csv node list. Add .gz, .bz2 or .xz to compress it.'+
+              '\nA .csr output is a directory of arrays that can be memory-mapped from Python'+
+              '\nwith compact_graph.load_graph() (requires numpy).'+
+              '\nThe export runs in the background; check on it with \'status --tasks\'.'+
               '\nSyntax:'+
               '\nexportgraph <jobname> <output file> [options]'+
               '\n\nAlternatively, any file containing one tweet JSON object per line can be'+
@@ -220,6 +309,13 @@ class TestCmd(cmd.Cmd):
               '\n\t--date min:max\t to specify a minimum and maximum (local) POSIX time for'+
               '\n\t\t\t\t\t tweets to be included (omit a min or max bound to include'+
               '\n\t\t\t\t\t all tweets before/after that date)'+
+              '\n\t--window len:step\t to export one weighted graph per sliding time window of'+
+              '\n\t\t\t\t\t len seconds, starting every step seconds, from a single pass'+
+              '\n\t\t\t\t\t (each file is named after its window\'s start time)'+
+              '\n\t--dynamic\t with --window and a .gexf output, write one dynamic GEXF whose'+
+              '\n\t\t\t\t\t edge weights change over time instead of one file per window'+
+              '\n\t--processes N\t to scan the archive\'s TAJ files in N worker processes'+
+              '\n\t\t\t\t\t (0 for one per CPU; the graph is the same either way)'+
               '\n\t-U\t to generate an undirected graph'+
               '\n\t-M\t to generate one edge per interaction instead of weighting edges by the'+
               '\n\t\t # of repeated interactions'+
@@ -228,8 +324,528 @@ class TestCmd(cmd.Cmd):
               '\n\t-m\t to include mentions in user interactions'+
               '\n\t-t\t to include reTweets in user interactions'+
               '\n\t-q\t to include quoted tweets in user interactions.'+
+              '\n\nOnly count the interactions in tweets matching all of these filters:'+
+              '\n\t--from id,id\t\t tweets written by one of these user IDs'+
+              '\n\t--mentions id,id\t tweets mentioning one of these user IDs'+
+              '\n\t--hashtag tag,tag\t tweets with one of these hashtags (any case)'+
+              '\n\t--lang code,code\t tweets in one of these languages, e.g. en'+
+              '\n\t--isreply\t\t only replies'+
+              '\n\t--isretweet\t\t only retweets'+
+              '\n\t--notretweet\t no retweets'+
+              '\n\t--text words\t\t tweets whose text contains these words (any case; the'+
+              '\n\t\t\t\t\t text can\'t contain " -")'+
+              '\nSegments and lines that can\'t match are skipped without being decoded.'+
               '\n\nExample:\nexportgraph "C:\\Twitter Data\\tweets.json" C:\\tweetgraph.gml --singlefile --date\n 1525132800: -rmU\n')
 
+    def do_export(self, arg):
+        if len(arg.strip()) == 0 :
+            self.onecmd('help export')
+            return
+        try:
+            request = parse_graph_args(arg, 'data/export.csv')
+            fields = field_export.DEFAULT_FIELDS
+            if request['options'].get('fields') not in (None, True):
+                fields = [field.strip() for field in request['options']['fields'].split(',') if field.strip()]
+            unknown = [field for field in fields if field not in tweet_parser.FIELDS]
+            where = tweet_filter.from_options(request['options'])
+        except:
+            print('Syntax error in export request; check your entry.')
+            return
+        if unknown:
+            print('Unknown fields:', ', '.join(unknown) + '. Choose from:', ', '.join(tweet_parser.FIELDS))
+            return
+        try:
+            job = resolve_archive(request['job'], request['single_file'])
+        except:
+            print('Unable to load specified job!')
+            return
+        outfile = request['outfile']
+        task = self.dispatcher.tasks.submit('export ' + outfile, field_export.export_fields, job, outfile, fields,
+                                            request['min_id'], request['max_id'], request['min_date'],
+                                            request['max_date'], where, request['processes'])
+        print('Exporting', ', '.join(fields), 'to', outfile, 'as task', task.task_id + '.')
+    def help_export(self):
+        print('Export chosen fields of the tweets in a job or index.arx file, one row per tweet'+
+              '\nin archive order. The format follows the output file\'s extension: .csv (the'+
+              '\ndefault, data/export.csv) or .jsonl for one JSON object per line. Add .gz, .bz2'+
+              '\nor .xz to compress it. Lists, such as hashtags, are written as JSON in CSV cells,'+
+              '\nand times in ISO 8601. The export runs in the background.'+
+              '\nSyntax:'+
+              '\nexport <jobname> <output file> [options]'+
+              '\n\nOptions:'+
+              '\n\t--fields a,b,c\t the tweet_parser fields to write, in column order (default'+
+              '\n\t\t\t\t\t ' + ','.join(field_export.DEFAULT_FIELDS) + ')'+
+              '\n\t--index min:max\t, --date min:max and --singlefile as for exportgraph'+
+              '\n\t--processes N\t to project the TAJ files in N worker processes (0 for one per'+
+              '\n\t\t\t\t\t CPU; the output is the same either way)'+
+              '\n\t--from, --mentions, --hashtag, --lang, --isreply, --isretweet, --notretweet'+
+              '\n\t and --text filter the tweets as for exportgraph'+
+              '\n\nFields: ' + ', '.join(tweet_parser.FIELDS) +
+              '\n\nExample:\nexport my_job data/climate.csv.gz --fields tweet_id,timestamp,screen_name,text'+
+              '\n --hashtag climate --processes 4\n')
+
+    def do_graphstats(self, arg):
+        if len(arg.strip()) == 0 :
+            self.onecmd('help graphstats')
+            return
+        try:
+            request = parse_graph_args(arg, 'data/graphstats.csv')
+            top = int(request['options']['top']) if 'top' in request['options'] else None
+            damping = float(request['options'].get('damping', 0.85))
+            where = tweet_filter.from_options(request['options'])
+        except:
+            print('Syntax error in graphstats request; check your entry.')
+            return
+        if request['multigraph']:
+            print('Graph metrics are computed on the weighted graph; drop -M.')
+            return
+        outfile = request['outfile']
+        
+        # A graph saved in compact form can be analysed without going back to the archive
+        if os.path.isdir(request['job']) and os.path.isfile(os.path.join(request['job'], 'meta.json')):
+            job = request['job']
+        else:
+            try:
+                job = resolve_archive(request['job'], request['single_file'])
+            except:
+                print('Unable to load specified job!')
+                return
+        
+        task = self.dispatcher.tasks.submit('graphstats ' + outfile, graph_metrics.export_metrics,
+                                            job, outfile, request['min_id'], request['max_id'],
+                                            request['min_date'], request['max_date'], not request['undirected'],
+                                            request['replies'], request['mentions'], request['retweets'],
+                                            request['quotes'], request['processes'], damping, top, where)
+        print('Computing graph metrics into', outfile, 'as task', task.task_id + '.')
+    def help_graphstats(self):
+        print('Compute degree, PageRank and connected components for the user interaction graph'+
+              '\nof a job, index.arx file or saved .csr graph, and write one CSV row per user,'+
+              '\nhighest PageRank first. Runs in the background; requires numpy.'+
+              '\nIf no output file is specified, the results are saved to data/graphstats.csv.'+
+              '\nSyntax:'+
+              '\ngraphstats <jobname> <output file> [options]'+
+              '\n\nTakes the same --index, --date, --singlefile, --processes, -U, -r, -m, -t and -q'+
+              '\noptions and tweet filters (--from, --hashtag, --text, ...) as exportgraph'+
+              '\n(see \'help exportgraph\'), plus:'+
+              '\n\t--top k\t\t to write only the k most influential users by PageRank'+
+              '\n\t--damping d\t to set the PageRank damping factor (default 0.85)'+
+              '\n\nColumns: rank, id, handle, then in_degree, out_degree, in_weight and out_weight'+
+              '\n(degree and weight if -U), pagerank, and component (0 is the largest component).'+
+              '\n\nExample:\ngraphstats my_job data/influencers.csv --top 100 -rm\n')
+
+    def do_edgestore(self, arg):
+        if len(arg.strip()) == 0 :
+            self.onecmd('help edgestore')
+            return
+        try:
+            job = resolve_archive(arg.strip())
+        except:
+            print('Unable to load specified job!')
+            return
+        if type(job) is not dict:
+            print('The edge store needs an archive, not a single tweet file.')
+            return
+        task = self.dispatcher.tasks.submit('edgestore ' + arg.strip(), edge_store.build_store, job)
+        print('Building edge store as task', task.task_id + '.')
+    def help_edgestore(self):
+        print('Build or refresh the edge store of a job or index.arx file in the background.'+
+              '\nThe edge store keeps interaction counts for each finished TAJ file, so exportgraph'+
+              '\nonly has to parse new tweets. Jobs with "edge_store": true keep it up to date'+
+              '\nautomatically; use this for archives collected before it was turned on.'+
+              '\nSyntax:'+
+              '\nedgestore <jobname>')
+
+    def do_findtweets(self, arg):
+        if len(arg.strip()) == 0 :
+            self.onecmd('help findtweets')
+            return
+        try:
+            request = parse_graph_args(arg, None)
+            options = request['options']
+            hashtags = options['hashtag'].split(',') if 'hashtag' in options else None
+            authors = [int(user_id) for user_id in options['from'].split(',')] if 'from' in options else None
+            mentions = [int(user_id) for user_id in options['mentions'].split(',')] if 'mentions' in options else None
+            limit = int(options.get('limit', 20))
+        except:
+            print('Syntax error in findtweets request; check your entry.')
+            return
+        if not (hashtags or authors or mentions):
+            print('Give at least one of --hashtag, --from or --mentions.')
+            return
+        try:
+            job = resolve_archive(request['job'], request['single_file'])
+        except:
+            print('Unable to load specified job!')
+            return
+        bounds = (request['min_id'], request['max_id'], request['min_date'], request['max_date'])
+        
+        # Save every match in the background, or show the first few right away
+        if request['outfile'] is not None:
+            task = self.dispatcher.tasks.submit('findtweets ' + request['outfile'], tag_index.export_tweets, job,
+                                                request['outfile'], hashtags, authors, mentions, *bounds)
+            print('Saving matching tweets to', request['outfile'], 'as task', task.task_id + '.')
+            return
+        found = 0
+        tweets = tag_index.find_tweets(job, hashtags, authors, mentions, *bounds, lazy=True)
+        try:
+            for tweet in tweets:
+                if found == limit:
+                    print('... more tweets match; raise --limit or give an output file to see them all.')
+                    break
+                # Tweets are only decoded as far as they're read, so a malformed one shows up here
+                try:
+                    text = ' '.join((tweet_parser.getTweetText(tweet) or '').split())
+                    shown = (tweet_parser.getTweetID(tweet), tweet_parser.getDate(tweet),
+                             '@' + str(tweet_parser.getScreenName(tweet)) + ':', text)
+                except ValueError:
+                    continue
+                found += 1
+                print(*shown)
+        finally:
+            tweets.close()
+        if found == 0: print('No tweets found.')
+    def help_findtweets(self):
+        print('Find the tweets in a job, index.arx file or tweet file with a hashtag, from an author'+
+              '\nor mentioning a user, and print them (or save them, one JSON object per line, to an'+
+              '\noutput file in the background). Segments covered by a tag index (see \'help tagindex\')'+
+              '\nonly have their matching tweets read; others are scanned.'+
+              '\nSyntax:'+
+              '\nfindtweets <jobname> [output file] [options]'+
+              '\n\nOptions (separate several values with commas to match any of them; the tweets'+
+              '\nmust match every option given):'+
+              '\n\t--hashtag tags\t to find tweets with one of these hashtags (case doesn\'t matter)'+
+              '\n\t--from IDs\t to find tweets written by one of these user IDs'+
+              '\n\t--mentions IDs\t to find tweets mentioning one of these user IDs'+
+              '\n\t--limit N\t to print at most N tweets (default 20)'+
+              '\n\t--index min:max, --date min:max and --singlefile as for exportgraph'+
+              '\n\nExample:\nfindtweets my_job --hashtag climate,ClimateChange --mentions 783214\n')
+
+    def do_tagindex(self, arg):
+        if len(arg.strip()) == 0 :
+            self.onecmd('help tagindex')
+            return
+        try:
+            job = resolve_archive(arg.strip())
+        except:
+            print('Unable to load specified job!')
+            return
+        if type(job) is not dict:
+            print('The tag index needs an archive, not a single tweet file.')
+            return
+        task = self.dispatcher.tasks.submit('tagindex ' + arg.strip(), tag_index.build_index, job)
+        print('Building tag index as task', task.task_id + '.')
+    def help_tagindex(self):
+        print('Build or refresh the tag index of a job or index.arx file in the background.'+
+              '\nThe tag index lists the tweets with each hashtag, author and mentioned user in each'+
+              '\nfinished TAJ file, so findtweets only reads matching tweets. Jobs with'+
+              '\n"tag_index": true keep it up to date automatically; use this for archives collected'+
+              '\nbefore it was turned on.'+
+              '\nSyntax:'+
+              '\ntagindex <jobname>')
+
+    def do_searchtext(self, arg):
+        if len(arg.strip()) == 0 :
+            self.onecmd('help searchtext')
+            return
+        # The query can hold - and quotes of its own, so only pick out the options named here
+        job = arg.split()[0]
+        options = {}
+        query = re.sub(r'(?:^|\s)--(index|date|limit|out|singlefile)\b(?:\s+(?!--)(\S+))?',
+                       lambda match : options.__setitem__(match.group(1), match.group(2)) or ' ',
+                       arg.strip()[len(job):]).strip()
+        try:
+            bounds = [None, None, None, None]
+            for name, first in (('index', 0), ('date', 2)):
+                if name in options:
+                    low, high = options[name].split(':')
+                    if low: bounds[first] = int(low)
+                    if high: bounds[first + 1] = int(high)
+            limit = int(options.get('limit') or 20)
+            text_index.parse_query(query)
+        except ValueError as err:
+            print('Syntax error in searchtext request:', err)
+            return
+        except:
+            print('Syntax error in searchtext request; check your entry.')
+            return
+        try:
+            job = resolve_archive(job, 'singlefile' in options)
+        except:
+            print('Unable to load specified job!')
+            return
+        
+        # Save every match in the background, or show the first few right away
+        if options.get('out'):
+            task = self.dispatcher.tasks.submit('searchtext ' + options['out'], text_index.export_tweets, job,
+                                                options['out'], query, *bounds)
+            print('Saving matching tweets to', options['out'], 'as task', task.task_id + '.')
+            return
+        found = 0
+        hits = text_index.search(job, query, *bounds)
+        try:
+            for hit in hits:
+                if found == limit:
+                    print('... more tweets match; raise --limit or use --out to see them all.')
+                    break
+                # Tweets are only decoded as far as they're read, so a malformed one shows up here
+                try:
+                    tweet = hit.load(lazy=True)
+                    text = ' '.join((tweet_parser.getTweetText(tweet) or '').split())
+                    shown = (hit.tweet_id, tweet_parser.getDate(tweet),
+                             '@' + str(tweet_parser.getScreenName(tweet)) + ':', text)
+                except ValueError:
+                    continue
+                found += 1
+                print(*shown)
+        finally:
+            hits.close()
+        if found == 0: print('No tweets found.')
+    def help_searchtext(self):
+        print('Search the text of the tweets in a job, index.arx file or tweet file, and print the'+
+              '\nmatches in tweet ID order (or save them, one JSON object per line, to a file in the'+
+              '\nbackground). Segments covered by a text index (see \'help textindex\') are answered'+
+              '\nwithout reading their tweets; others are scanned.'+
+              '\nSyntax:'+
+              '\nsearchtext <jobname> <query> [options]'+
+              '\n\nQueries match whole words, ignoring case: all words and "quoted phrases" must'+
+              '\nappear unless joined by OR, a leading - or NOT excludes a word or phrase, and'+
+              '\nparentheses group.'+
+              '\n\nOptions:'+
+              '\n\t--out file\t to save every matching tweet to this file'+
+              '\n\t--limit N\t to print at most N tweets (default 20)'+
+              '\n\t--index min:max, --date min:max and --singlefile as for exportgraph'+
+              '\n\nExample:\nsearchtext my_job "climate change" (hoax OR scam) -satire --date 1525132800:\n')
+
+    def do_textindex(self, arg):
+        if len(arg.strip()) == 0 :
+            self.onecmd('help textindex')
+            return
+        try:
+            job = resolve_archive(arg.strip())
+        except:
+            print('Unable to load specified job!')
+            return
+        if type(job) is not dict:
+            print('The text index needs an archive, not a single tweet file.')
+            return
+        task = self.dispatcher.tasks.submit('textindex ' + arg.strip(), text_index.build_index, job)
+        print('Building text index as task', task.task_id + '.')
+    def help_textindex(self):
+        print('Build or refresh the full-text index of a job or index.arx file in the background.'+
+              '\nThe text index lists where each word appears in the tweets of each finished TAJ file,'+
+              '\nso searchtext can answer queries without reading them. Jobs with "text_index": true'+
+              '\nkeep it up to date automatically; use this for archives collected before it was'+
+              '\nturned on.'+
+              '\nSyntax:'+
+              '\ntextindex <jobname>')
+
+    def do_summarize(self, arg):
+        if len(arg.strip()) == 0 :
+            self.onecmd('help summarize')
+            return
+        try:
+            job = resolve_archive(arg.strip())
+        except:
+            print('Unable to load specified job!')
+            return
+        if type(job) is not dict:
+            print('Summaries are kept in an archive\'s index, not for a single tweet file.')
+            return
+        task = self.dispatcher.tasks.submit('summarize ' + arg.strip(), arx_mgr.build_summaries, job)
+        print('Summarizing finished TAJ files as task', task.task_id + '.')
+    def help_summarize(self):
+        print('Add summaries to the index.arx entries of finished TAJ files that lack them, in the'+
+              '\nbackground. A summary lists the languages in the file and keeps Bloom filters of its'+
+              '\nauthors, mentioned users and hashtags, so searches for them skip files that can\'t'+
+              '\nmatch. New TAJ files are summarized as they\'re finished; use this for archives'+
+              '\ncollected before summaries were kept. Like compact, it is safe while the job is'+
+              '\ncollecting.'+
+              '\nSyntax:'+
+              '\nsummarize <jobname>')
+
+    def do_report(self, arg):
+        if len(arg.strip()) == 0 :
+            self.onecmd('help report')
+            return
+        try:
+            request = parse_graph_args(arg, 'data/report.json')
+            top = int(request['options'].get('top', 10))
+            names = request['options']['only'].split(',') if 'only' in request['options'] else None
+        except:
+            print('Syntax error in report request; check your entry.')
+            return
+        unknown = [name for name in names or [] if name not in aggregate.AGGREGATORS]
+        if unknown:
+            print('Unknown statistics:', ', '.join(unknown) + '; choose from', ', '.join(aggregate.AGGREGATORS))
+            return
+        try:
+            job = resolve_archive(request['job'], request['single_file'])
+        except:
+            print('Unable to load specified job!')
+            return
+        task = self.dispatcher.tasks.submit('report ' + request['outfile'], aggregate.write_report, job,
+                                            request['outfile'], names, top)
+        print('Writing report to', request['outfile'], 'as task', task.task_id + '.')
+    def help_report(self):
+        print('Compute statistics over every tweet in a job, index.arx file or tweet file in a'+
+              '\nsingle pass, and save them as JSON. Runs in the background. Results for each'+
+              '\nfinished TAJ file are cached in the archive\'s aggregates/ directory, so running'+
+              '\na report again only reads the unfinished TAJ file and any new ones.'+
+              '\nIf no output file is specified, the report is saved to data/report.json.'+
+              '\nSyntax:'+
+              '\nreport <jobname> <output file> [options]'+
+              '\n\nStatistics: ' + ', '.join(aggregate.AGGREGATORS) +
+              '\n\nOptions:'+
+              '\n\t--only names\t to compute only these statistics (separated by commas)'+
+              '\n\t--top k\t\t to keep the k largest entries of each ranking (default 10)'+
+              '\n\t--singlefile\t to read a tweet file instead of a job'+
+              '\n\nExample:\nreport my_job data/my_job_report.json --only hashtags,langs --top 25\n')
+
+    def do_compact(self, arg):
+        if len(arg.strip()) == 0 :
+            self.onecmd('help compact')
+            return
+        try:
+            request = parse_graph_args(arg, None)
+            size = float(request['options']['size']) if 'size' in request['options'] else None
+            grace = float(request['options'].get('grace', compactor.DEFAULT_GRACE))
+            dry_run = 'dryrun' in request['options']
+        except:
+            print('Syntax error in compact request; check your entry.')
+            return
+        try:
+            job = resolve_archive(request['job'])
+        except:
+            print('Unable to load specified job!')
+            return
+        if size is None and 'max_taj_size' not in job:
+            print('Give a target size with --size for an index.arx file.')
+            return
+        if dry_run:
+            plan = compactor.compact_archive(job, size, grace, dry_run=True)
+            print('Would rewrite', plan['rewritten'], 'of', plan['before'], 'finished TAJ files into', plan['written'],
+                  'leaving', plan['after'], 'in all.')
+            return
+        task = self.dispatcher.tasks.submit('compact ' + request['job'], compactor.compact_archive, job, size, grace)
+        print('Compacting archive as task', task.task_id + '.')
+    def help_compact(self):
+        print('Merge undersized finished TAJ files and split oversized ones in a job or index.arx'+
+              '\nfile, keeping tweets in ID order and rebuilding their index entries, summaries and'+
+              '\nper-segment indexes. Runs in the background, and is safe to run while the job is'+
+              '\ncollecting: the newest TAJ files are left alone, and each rewrite is swapped into'+
+              '\nthe index.arx in one step. Replaced files are kept for a grace period, so scans'+
+              '\nalready reading them can finish, and deleted by a later compact.'+
+              '\nSyntax:'+
+              '\ncompact <jobname> [options]'+
+              '\n\nOptions:'+
+              '\n\t--size MB\t\t target size of each TAJ file (default: the job\'s max_taj_size)'+
+              '\n\t--grace seconds\t how long to keep replaced files (default ' +
+              str(compactor.DEFAULT_GRACE) + ')'+
+              '\n\t--dryrun\t\t only show what would be rewritten'+
+              '\n\nExample:\ncompact my_job --size 200\n')
+
+    def do_share(self, arg):
+        if len(arg.strip()) == 0 :
+            self.onecmd('help share')
+            return
+        try:
+            request = parse_graph_args(arg, None)
+            grace = float(request['options'].get('grace', compactor.DEFAULT_GRACE))
+        except:
+            print('Syntax error in share request; check your entry.')
+            return
+        if request['outfile'] is None:
+            print('Give the directory of the shared store to move the tweets to.')
+            return
+        try:
+            job = resolve_archive(request['job'])
+        except:
+            print('Unable to load specified job!')
+            return
+        task = self.dispatcher.tasks.submit('share ' + request['job'], compactor.share_archive, job,
+                                            request['outfile'], grace)
+        print('Moving tweets to the shared store as task', task.task_id + '.')
+    def help_share(self):
+        print('Move the tweets of a job or index.arx file into a shared store, where tweets'+
+              '\nmatched by several jobs are kept once. The finished TAJ files are rewritten to'+
+              '\nhold only references to their tweets, which every command reads through. Runs'+
+              '\nin the background and is safe while the job is collecting; the newest finished'+
+              '\nTAJ is left for a later run. Replaced files are kept for a grace period, then'+
+              '\ndeleted by a later share or compact. Add "shared_store" to a job to keep new'+
+              '\ntweets in the store from the start.'+
+              '\nSyntax:'+
+              '\nshare <jobname> <store directory> [options]'+
+              '\n\nOptions:'+
+              '\n\t--grace seconds\t how long to keep replaced files (default ' +
+              str(compactor.DEFAULT_GRACE) + ')'+
+              '\n\nExample:\nshare my_job data/shared\n')
+    def do_userdict(self, arg):
+        if len(arg.strip()) == 0 :
+            self.onecmd('help userdict')
+            return
+        try:
+            request = parse_graph_args(arg, None)
+            grace = float(request['options'].get('grace', compactor.DEFAULT_GRACE))
+        except:
+            print('Syntax error in userdict request; check your entry.')
+            return
+        try:
+            job = resolve_archive(request['job'])
+        except:
+            print('Unable to load specified job!')
+            return
+        task = self.dispatcher.tasks.submit('userdict ' + request['job'], compactor.normalize_users, job, grace)
+        print('Moving user profiles to the user dictionary as task', task.task_id + '.')
+    def help_userdict(self):
+        print('Move the user objects in the finished TAJ files of a job or index.arx file into'+
+              '\nthe archive\'s user dictionary, which keeps each state of each profile once. The'+
+              '\nTAJ files are rewritten to hold only the user\'s ID, screen name and a reference'+
+              '\nto the profile, which every command reads through. Runs in the background and is'+
+              '\nsafe while the job is collecting; the newest finished TAJ is left for a later'+
+              '\nrun. Add "user_dictionary" to a job to store new tweets this way from the start.'+
+              '\nSyntax:'+
+              '\nuserdict <jobname> [options]'+
+              '\n\nOptions:'+
+              '\n\t--grace seconds\t how long to keep replaced files (default ' +
+              str(compactor.DEFAULT_GRACE) + ')'+
+              '\n\nExample:\nuserdict my_job\n')
+
+    def do_verify(self, arg):
+        if len(arg.strip()) == 0 :
+            self.onecmd('help verify')
+            return
+        try:
+            request = parse_graph_args(arg, 'data/verify.json')
+            rebuild = 'rebuild' in request['options']
+        except:
+            print('Syntax error in verify request; check your entry.')
+            return
+        try:
+            job = resolve_archive(request['job'])
+        except:
+            print('Unable to load specified job!')
+            return
+        if type(job) is not dict:
+            print('Only an archive can be verified, not a single tweet file.')
+            return
+        task = self.dispatcher.tasks.submit('verify ' + request['outfile'], verifier.write_report, job,
+                                            request['outfile'], rebuild, request['processes'])
+        print('Verifying archive into', request['outfile'], 'as task', task.task_id + '.')
+    def help_verify(self):
+        print('Check every TAJ file of a job or index.arx file against its index, and save a'+
+              '\nreport as JSON. Finds malformed lines, tweets out of order or repeated within a'+
+              '\nfile, files whose tweet IDs overlap, files missing from the disk or the index, and'+
+              '\nindex entries with the wrong bounds or counts. Runs in the background.'+
+              '\nIf no output file is specified, the report is saved to data/verify.json.'+
+              '\nSyntax:'+
+              '\nverify <jobname> <output file> [options]'+
+              '\n\nOptions:'+
+              '\n\t--processes N\t to read the TAJ files in N worker processes (0 for one per CPU)'+
+              '\n\t--rebuild\t\t to replace the index.arx with one built from the TAJ files, keeping'+
+              '\n\t\t\t\t\t the old one as index.arx.bak. This also recovers a lost index.arx'+
+              '\n\t\t\t\t\t (give the job name, so its query can be restored). Stop the job first.'+
+              '\n\nExample:\nverify my_job data/my_job_verify.json --processes 0 --rebuild\n')
+
 class Commander(threading.Thread):
     """
     Easy interface for controlling Ornitholog via terminal. Starting this thread automatically creates a work
@@ -0,0 +1,305 @@
+import os, shutil
+import json
+from array import array
+
+# Compact graphs are stored as NumPy arrays
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+# SciPy is only needed to hand the adjacency to SciPy
+try:
+    import scipy.sparse as sp
+except ImportError:
+    sp = None
+
+FORMAT_VERSION = 1
+NO_HANDLE = -1
+
+# Arrays saved in a compact graph directory, one .npy file each
+ARRAYS = ('ids', 'user_handles', 'handle_offsets', 'sorted_ids', 'sorted_users', 'indptr', 'indices', 'weights')
+
+
+class UserTable:
+    """
+    Number users densely as they're added, for use as int32 array indices. User IDs are kept in a 64-bit array
+    rather than a list of Python ints, and each distinct screen name is stored once in a separate handle table, with
+    each user holding the number of their latest handle. It's built from a finished twitter_graph.InteractionCounts
+    when a graph is saved, rather than used while counting.
+    """
+
+    def __init__(self):
+        self.index = {}                     # user ID -> user number
+        self.ids = array('q')               # user number -> user ID
+        self.user_handles = array('i')      # user number -> handle number (NO_HANDLE if unknown)
+        self.handle_index = {}              # handle -> handle number
+        self.handle_names = []              # handle number -> handle
+
+    def __len__(self):
+        return len(self.ids)
+
+    def add(self, user_id, handle=None):
+        """
+        Get a user's number, numbering them if they're new.
+        :param user_id: Twitter user ID
+        :param handle: Latest screen name of the user, if known
+        :return: User number
+        """
+        idx = self.index.get(user_id)
+        if idx is None:
+            idx = self.index[user_id] = len(self.ids)
+            self.ids.append(user_id)
+            self.user_handles.append(NO_HANDLE)
+        if handle is not None:
+            self.set_handle(idx, handle)
+        return idx
+
+    def lookup(self, user_id):
+        """
+        :return: A user's number, or None if they aren't in the table
+        """
+        return self.index.get(user_id)
+
+    def set_handle(self, idx, handle):
+        """
+        Set a user's latest screen name, adding it to the handle table if it's new.
+        """
+        num = self.handle_index.get(handle)
+        if num is None:
+            num = self.handle_index[handle] = len(self.handle_names)
+            self.handle_names.append(handle)
+        self.user_handles[idx] = num
+
+    def handle(self, idx):
+        """
+        :return: A user's latest screen name, or None if it isn't known
+        """
+        num = self.user_handles[idx]
+        return None if num == NO_HANDLE else self.handle_names[num]
+
+    @classmethod
+    def from_counts(cls, counts):
+        """
+        Build the table for the users of a twitter_graph.InteractionCounts, keeping its user numbers.
+        :return: UserTable
+        """
+        table = cls()
+        for user_id, handle in zip(counts.ids, counts.handles):
+            table.add(user_id, handle)
+        return table
+
+
+class CSRGraph:
+    """
+    Weighted user interaction graph in compressed sparse row form. The edges out of user i are indices[indptr[i]:
+    indptr[i+1]], with matching weights; undirected graphs store each edge in both directions. Users are int32 numbers
+    (see UserTable), and everything is kept in flat NumPy arrays so a saved graph can be memory-mapped instead of
+    being read into memory.
+    """
+
+    def __init__(self, arrays, directed=True):
+        """
+        :param arrays: Dictionary holding a NumPy array for each name in ARRAYS, plus 'handle_blob' (uint8 array of
+        every handle's UTF-8 bytes, back to back)
+        :param directed: Whether the graph is directed
+        """
+        self.directed = directed
+        self.ids = arrays['ids']                        # user number -> user ID
+        self.user_handles = arrays['user_handles']      # user number -> handle number (NO_HANDLE if unknown)
+        self.handle_offsets = arrays['handle_offsets']  # handle number -> start of its bytes in handle_blob
+        self.handle_blob = arrays['handle_blob']
+        self.sorted_ids = arrays['sorted_ids']          # User IDs in increasing order, for lookups
+        self.sorted_users = arrays['sorted_users']      # User number of each of sorted_ids
+        self.indptr = arrays['indptr']
+        self.indices = arrays['indices']
+        self.weights = arrays['weights']
+
+    @property
+    def num_nodes(self):
+        return len(self.ids)
+
+    @property
+    def num_edges(self):
+        """
+        Number of edges, counting each undirected edge once.
+        """
+        if self.directed:
+            return len(self.indices)
+        loops = int(np.count_nonzero(self.indices == np.repeat(np.arange(self.num_nodes, dtype=np.int32),
+                                                                np.diff(self.indptr))))
+        return (len(self.indices) + loops) // 2
+
+    def lookup(self, user_id):
+        """
+        :return: A user's number, or None if they aren't in the graph
+        """
+        pos = int(np.searchsorted(self.sorted_ids, user_id))
+        if pos < len(self.sorted_ids) and self.sorted_ids[pos] == user_id:
+            return int(self.sorted_users[pos])
+        return None
+
+    def user_id(self, idx):
+        return int(self.ids[idx])
+
+    def handle(self, idx):
+        """
+        :return: A user's latest screen name, or None if it isn't known
+        """
+        num = int(self.user_handles[idx])
+        if num == NO_HANDLE:
+            return None
+        return bytes(self.handle_blob[self.handle_offsets[num]:self.handle_offsets[num + 1]]).decode('utf-8')
+
+    def neighbors(self, idx):
+        """
+        :param idx: User number
+        :return: Tuple of (int32 array) user numbers the user has an edge to, (array) weight of each edge
+        """
+        start, stop = self.indptr[idx], self.indptr[idx + 1]
+        return self.indices[start:stop], self.weights[start:stop]
+
+    def out_degree(self):
+        """
+        :return: Number of edges out of each user (all edges for undirected graphs)
+        """
+        return np.diff(self.indptr)
+
+    def to_sparse(self):
+        """
+        Wrap the arrays as a SciPy sparse matrix without copying them.
+        :return: scipy.sparse.csr_matrix
+        """
+        if sp is None:
+            raise ImportError('SciPy library is required for sparse adjacency output.')
+        n = self.num_nodes
+        return sp.csr_matrix((self.weights, self.indices, self.indptr), shape=(n, n), copy=False)
+
+    @classmethod
+    def from_counts(cls, counts):
+        """
+        Build the compact graph for a twitter_graph.InteractionCounts, keeping its user numbers. Multigraph edges
+        between the same users are summed into one weighted edge.
+        :return: CSRGraph
+        """
+        if np is None:
+            raise ImportError('NumPy library is required for compact graphs.')
+        n = len(counts.ids)
+        if counts.multigraph:
+            num = len(counts.edges)
+            rows = np.empty(num, dtype=np.int64)
+            cols = np.empty(num, dtype=np.int64)
+            for pos, edge in enumerate(counts.edges):
+                rows[pos] = edge[0]
+                cols[pos] = edge[1]
+            weights = np.ones(num, dtype=np.int64)
+        else:
+            keys = np.fromiter(counts.counts.keys(), dtype=np.int64, count=len(counts.counts))
+            rows = keys >> 32
+            cols = keys & 0xFFFFFFFF
+            weights = np.fromiter(counts.counts.values(), dtype=np.int64, count=len(counts.counts))
+        if not counts.directed:
+            # Store each edge in both directions, except self-loops
+            mirror = rows != cols
+            rows, cols = np.concatenate((rows, cols[mirror])), np.concatenate((cols, rows[mirror]))
+            weights = np.concatenate((weights, weights[mirror]))
+
+        # Sort edges by source then sink, summing any duplicates
+        keys, inverse = np.unique((rows << 32) | cols, return_inverse=True)
+        weights = np.bincount(inverse, weights=weights, minlength=len(keys)).astype(np.int64)
+        if len(weights) == 0 or weights.max() <= np.iinfo(np.int32).max:
+            weights = weights.astype(np.int32)
+        indices = (keys & 0xFFFFFFFF).astype(np.int32)
+        indptr = np.zeros(n + 1, dtype=np.int64)
+        np.cumsum(np.bincount(keys >> 32, minlength=n), out=indptr[1:])
+
+        table = UserTable.from_counts(counts)
+        encoded = [handle.encode('utf-8') for handle in table.handle_names]
+        handle_offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+        np.cumsum([len(handle) for handle in encoded], out=handle_offsets[1:])
+        ids = np.frombuffer(table.ids, dtype=np.int64).copy() if n else np.zeros(0, dtype=np.int64)
+        order = np.argsort(ids, kind='stable').astype(np.int32)
+        return cls({
+            'ids' : ids,
+            'user_handles' : np.frombuffer(table.user_handles, dtype=np.int32).copy() if n else
+                             np.zeros(0, dtype=np.int32),
+            'handle_offsets' : handle_offsets,
+            'handle_blob' : np.frombuffer(b''.join(encoded), dtype=np.uint8),
+            'sorted_ids' : ids[order],
+            'sorted_users' : order,
+            'indptr' : indptr,
+            'indices' : indices,
+            'weights' : weights,
+        }, counts.directed)
+
+    def save(self, path):
+        """
+        Save the graph as a directory of .npy files plus a meta.json, replacing any graph already saved there. The
+        graph is written beside the destination first, so a reader never sees a partial graph. A directory can't be
+        swapped for another in one step, so the old graph is moved aside to '<path>.old' and only deleted once the
+        new one is in place; load() reads it from there in between, and after a crash between the two moves.
+        :param path: Directory to save the graph in, such as 'data/graph.csr'
+        """
+        path = path.rstrip('/\\')
+        tmp_path = path + '.tmp'
+        old_path = path + '.old'
+        shutil.rmtree(tmp_path, ignore_errors=True)
+        os.makedirs(tmp_path)
+        for name in ARRAYS:
+            np.save(os.path.join(tmp_path, name + '.npy'), getattr(self, name))
+        with open(os.path.join(tmp_path, 'handles.bin'), 'wb') as fout:
+            fout.write(self.handle_blob.tobytes())
+        with open(os.path.join(tmp_path, 'meta.json'), 'w') as fout:
+            json.dump({'version' : FORMAT_VERSION, 'directed' : bool(self.directed),
+                       'nodes' : int(self.num_nodes), 'entries' : int(len(self.indices))}, fout, indent=4)
+        if os.path.isdir(path):
+            shutil.rmtree(old_path, ignore_errors=True)
+            os.replace(path, old_path)
+        os.replace(tmp_path, path)
+        shutil.rmtree(old_path, ignore_errors=True)
+
+    @classmethod
+    def load(cls, path, mmap=True):
+        """
+        Open a graph saved with save().
+        :param path: Directory the graph was saved in
+        :param mmap: Memory-map the arrays instead of reading them, so the graph opens instantly and only the parts
+        used are paged in
+        :return: CSRGraph
+        """
+        if np is None:
+            raise ImportError('NumPy library is required for compact graphs.')
+        # While save() is replacing a graph, the old one is moved aside until the new one is in place
+        path = path.rstrip('/\\')
+        if not os.path.isfile(os.path.join(path, 'meta.json')) and os.path.isfile(os.path.join(path + '.old',
+                                                                                              'meta.json')):
+            path = path + '.old'
+        with open(os.path.join(path, 'meta.json')) as fin:
+            meta = json.load(fin)
+        if meta.get('version') != FORMAT_VERSION:
+            raise ValueError('Unsupported compact graph version: ' + str(meta.get('version')))
+        mode = 'r' if mmap else None
+        arrays = {name : np.load(os.path.join(path, name + '.npy'), mmap_mode=mode) for name in ARRAYS}
+        blob_path = os.path.join(path, 'handles.bin')
+        if mmap and os.path.getsize(blob_path) > 0:
+            arrays['handle_blob'] = np.memmap(blob_path, dtype=np.uint8, mode='r')
+        else:
+            arrays['handle_blob'] = np.fromfile(blob_path, dtype=np.uint8)
+        return cls(arrays, meta['directed'])
+
+
+def save_graph(counts, path):
+    """
+    Save the graph for a twitter_graph.InteractionCounts in compact form (see CSRGraph.save).
+    :return: CSRGraph that was saved
+    """
+    graph = CSRGraph.from_counts(counts)
+    graph.save(path)
+    return graph
+
+def load_graph(path, mmap=True):
+    """
+    Open a graph saved in compact form (see CSRGraph.load).
+    :return: CSRGraph
+    """
+    return CSRGraph.load(path, mmap)
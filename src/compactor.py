@@ -0,0 +1,378 @@
+import os
+import time
+from uuid import uuid4
+import tweet_parser
+import aggregate
+import edge_store
+import tag_index
+import text_index
+import tweet_store
+import user_dict
+from arx_mgr import archive_lock, first_bound, load_arx, summarize_taj, update_segment_indexes, write_arx
+
+# Seconds a replaced TAJ file is kept after compaction, so scans that loaded the ARX before it was replaced can finish
+DEFAULT_GRACE = 3600
+
+# Lines rewritten per batch when moving tweets or users out of TAJ files
+REWRITE_BATCH = 1000
+
+# Job options for the per-segment indexes, and the directories they're kept in
+SEGMENT_INDEXES = (('edge_store', edge_store.STORE_DIR), ('tag_index', tag_index.INDEX_DIR),
+                   ('text_index', text_index.INDEX_DIR))
+
+
+def plan_compaction(sizes, target):
+    """
+    Choose which runs of finished segments to rewrite. Segments between half and twice the target size are left alone
+    (a finished TAJ grows past max_taj_size by up to one unfinished TAJ before the next is started). Runs of smaller
+    segments are merged, taking in their neighbours until they're large enough, and larger ones are split.
+    :param sizes: Sizes in bytes of the finished segments, in ARX order
+    :param target: Target segment size in bytes
+    :return: List of (start, stop) slices of the segments to rewrite together, in order
+    """
+    low = target / 2.0; high = target * 2.0
+    groups = []
+    idx = 0
+    while idx < len(sizes):
+        if low <= sizes[idx] <= high:
+            idx += 1
+            continue
+        start = idx; total = 0
+        while idx < len(sizes) and (total < low or not low <= sizes[idx] <= high):
+            total += sizes[idx]
+            idx += 1
+        # A small run at the end has nothing after it to fill it up, so merge it into what comes before
+        if total < low:
+            if groups and groups[-1][1] == start:
+                groups[-1] = (groups[-1][0], idx)
+                continue
+            if start > 0:
+                start -= 1
+        if idx - start > 1 or total > high:
+            groups.append((start, idx))
+    return groups
+
+def read_ids(taj_file):
+    """
+    :param taj_file: Path to a TAJ file
+    :return: List of (tweet ID, byte offset of its line, length of the line) for each tweet in the file, skipping
+    lines that aren't tweets
+    """
+    tweets = []
+    with open(taj_file, 'rb') as fin:
+        offset = 0
+        for line in fin:
+            start = offset
+            offset += len(line)
+            line = line.strip()
+            if not line: continue
+            try:
+                tweet_id = tweet_parser.getTweetID(tweet_parser.LazyTweet(line.decode('utf-8', 'ignore')))
+            except:
+                continue
+            if tweet_id is not None:
+                tweets.append((tweet_id, start, len(line) + 1))
+    return tweets
+
+def rewrite_group(job, sources, target):
+    """
+    Merge a run of finished segments and cut the result into TAJ files of about the target size. Tweets are put in ID
+    order: the files follow each other old-to-new, and each is ordered new-to-old like every finished TAJ. Nothing is
+    published; the new files aren't in the ARX yet.
+    :param job: Job dictionary with a path to an archive
+    :param sources: ARX entries of the segments, in order
+    :param target: Target segment size in bytes
+    :return: List of ARX entries for the new TAJ files, with summaries
+    """
+    path = job['path'] + '/'
+    tweets = []
+    for idx, entry in enumerate(sources):
+        tweets.extend((tweet_id, idx, offset, length) for tweet_id, offset, length in read_ids(path + entry[0]))
+    tweets.sort()
+    total = sum(tweet[3] for tweet in tweets)
+    num_files = max(1, int(round(total / float(target))))
+
+    # Cut into files of about equal size, never splitting tweets that share an ID
+    outputs = []
+    handles = [open(path + entry[0], 'rb') for entry in sources]
+    try:
+        start = 0; written = 0
+        while start < len(tweets):
+            stop = start
+            limit = total * (len(outputs) + 1) / num_files
+            while stop < len(tweets) and (stop == start or written < limit or len(outputs) == num_files - 1 or
+                                          tweets[stop][0] == tweets[stop - 1][0]):
+                written += tweets[stop][3]
+                stop += 1
+            outputs.append(write_segment(path, handles, tweets[start:stop]))
+            start = stop
+    except:
+        for entry in outputs:
+            os.remove(path + entry[0])
+        raise
+    finally:
+        for handle in handles:
+            handle.close()
+
+    # Chain the new entries' lower bounds from the last bounds before the run, as finalize_taj does
+    prior_id = sources[0][1]; prior_date = sources[0][3]
+    for entry in outputs:
+        entry[1] = prior_id; entry[3] = prior_date
+        prior_id = entry[2]; prior_date = entry[4]
+    return outputs
+
+def write_segment(path, handles, tweets):
+    """
+    Write tweets to a new finished TAJ file, newest first.
+    :param path: Archive directory, ending in a separator
+    :param handles: Open source TAJ files
+    :param tweets: List of (tweet ID, index into handles, byte offset and length of the tweet's line), in ID order
+    :return: ARX entry for the file, with its bounds, number of tweets and summary
+    """
+    taj_name = 'tweets-' + str(uuid4()) + '.taj'
+    with open(path + taj_name + '.tmp', 'wb') as fout:
+        for tweet_id, idx, offset, length in reversed(tweets):
+            handles[idx].seek(offset)
+            fout.write(handles[idx].readline().strip() + b'\n')
+    os.replace(path + taj_name + '.tmp', path + taj_name)
+    last_id, last_date = first_bound(path + taj_name)
+    return [taj_name, None, last_id, None, last_date, len(tweets), summarize_taj(path + taj_name)]
+
+def remove_segment(job, taj_name):
+    """
+    Delete a TAJ file along with any per-segment indexes and caches it has.
+    :param job: Job dictionary with a path to an archive
+    :param taj_name: Filename of the TAJ (no directory)
+    """
+    for file in [os.path.join(job['path'], taj_name), edge_store.store_path(job, taj_name),
+                 tag_index.index_path(job, taj_name), text_index.index_path(job, taj_name),
+                 aggregate.cache_path(job, taj_name)]:
+        try:
+            os.remove(file)
+        except FileNotFoundError:
+            pass
+
+def index_segment(job, entry):
+    """
+    Build the per-segment indexes for a new TAJ that the job enables or that the archive already keeps.
+    """
+    options = dict(job)
+    for option, directory in SEGMENT_INDEXES:
+        if os.path.isdir(os.path.join(job['path'], directory)):
+            options[option] = True
+    update_segment_indexes(options, entry)
+
+def publish(job, sources, outputs):
+    """
+    Replace a run of finished segments with their rewritten files in the ARX, in one atomic write. The run must
+    still be in the ARX unchanged and must not include the last finished segment, which a collector may be adding to.
+    :param job: Job dictionary with a path to an archive
+    :param sources: ARX entries of the segments that were rewritten, as they were read
+    :param outputs: ARX entries of the new files
+    :return: True if published, False if the archive changed underneath the rewrite
+    """
+    names = [entry[0] for entry in sources]
+    with archive_lock(job):
+        arx = load_arx(job)
+        finished = arx['finished'] or []
+        current = [entry[0] for entry in finished]
+        if names[0] not in current:
+            return False
+        start = current.index(names[0])
+        stop = start + len(names)
+        if current[start:stop] != names or stop >= len(finished) or \
+                any(entry[5] != source[5] for entry, source in zip(finished[start:stop], sources)):
+            return False
+        finished[start:stop] = outputs
+        retired = time.time()
+        arx['retired'] = arx.get('retired', []) + [[name, retired] for name in names]
+        arx['revision'] = arx.get('revision', 0) + 1
+        write_arx(job)
+    return True
+
+def purge_retired(job, grace=DEFAULT_GRACE):
+    """
+    Delete the TAJ files compaction replaced at least grace seconds ago, with their indexes and caches.
+    :param job: Job dictionary with a path to an archive
+    :param grace: Seconds to keep replaced files for scans still reading them
+    :return: Number of TAJ files deleted
+    """
+    now = time.time()
+    with archive_lock(job):
+        arx = load_arx(job)
+        expired = [item for item in arx.get('retired', []) if now - item[1] >= grace]
+        if not expired:
+            return 0
+        arx['retired'] = [item for item in arx['retired'] if now - item[1] < grace]
+        arx['revision'] = arx.get('revision', 0) + 1
+        write_arx(job)
+    for taj_name, retired in expired:
+        remove_segment(job, taj_name)
+    return len(expired)
+
+def compact_archive(job, target_mb=None, grace=DEFAULT_GRACE, dry_run=False, task=None):
+    """
+    Merge undersized finished TAJ files and split oversized ones so every segment is near the target size, keeping
+    the tweets in ID order. Safe to run while the job is collecting: the last finished TAJ and the unfinished TAJ are
+    left alone, new files are written beside the old ones, and each rewritten run is swapped into the ARX in one
+    atomic write, which the collector merges with its own changes (see arx_mgr.write_arx). Replaced files are kept
+    for the grace period, so scans already reading them can finish, then deleted by a later compaction.
+    :param job: Job dictionary with a path to an archive
+    :param target_mb: Target segment size in MB (the job's max_taj_size if None)
+    :param grace: Seconds to keep replaced TAJ files before deleting them
+    :param dry_run: Only plan the rewrite
+    :param task: Optional task_mgr.Task to report progress to and check for cancellation
+    :return: Dictionary with the number of segments 'before' and 'after' (or that there would be, for a dry run),
+    the number of segments 'rewritten' and 'written', runs 'skipped' because the archive changed underneath them,
+    and old TAJ files 'purged'
+    :raise ValueError: If there's no target size
+    """
+    if target_mb is None: target_mb = job.get('max_taj_size')
+    if target_mb is None: raise ValueError('No target size given, and the job has no max_taj_size')
+    target = target_mb * 1024 * 1024
+    arx = load_arx(job)
+    # The last finished TAJ may still grow, so it isn't compacted
+    candidates = [list(entry) for entry in (arx['finished'] or [])[:-1]]
+    groups = plan_compaction([os.path.getsize(os.path.join(job['path'], entry[0])) for entry in candidates], target)
+    result = {'before' : len(arx['finished'] or []), 'after' : len(arx['finished'] or []), 'rewritten' : 0,
+              'written' : 0, 'skipped' : 0, 'purged' : 0}
+    if dry_run:
+        for start, stop in groups:
+            total = sum(os.path.getsize(os.path.join(job['path'], entry[0])) for entry in candidates[start:stop])
+            result['rewritten'] += stop - start
+            result['written'] += max(1, int(round(total / float(target))))
+        result['after'] += result['written'] - result['rewritten']
+        return result
+
+    if task is not None:
+        sources = [entry for start, stop in groups for entry in candidates[start:stop]]
+        task.expect(len(sources), sum(entry[5] for entry in sources))
+    for start, stop in groups:
+        if task is not None: task.check()
+        sources = candidates[start:stop]
+        outputs = rewrite_group(job, sources, target)
+        for entry in outputs:
+            index_segment(job, entry)
+        if publish(job, sources, outputs):
+            result['rewritten'] += len(sources)
+            result['written'] += len(outputs)
+        else:
+            result['skipped'] += 1
+            for entry in outputs:
+                remove_segment(job, entry[0])
+        if task is not None:
+            for entry in sources:
+                task.tweets_scanned += entry[5]
+                task.segment_done(entry)
+    result['purged'] = purge_retired(job, grace)
+    result['after'] = len(load_arx(job)['finished'] or [])
+    return result
+
+def rewrite_lines(job, entry, transform):
+    """
+    Write a copy of a finished TAJ with its lines changed in batches, such as to move its tweets elsewhere. The
+    tweets, their order and so the ARX entry's bounds, count and summary stay the same. Nothing is published; the
+    new file isn't in the ARX yet.
+    :param job: Job dictionary with a path to an archive
+    :param entry: ARX entry of the segment
+    :param transform: Function taking a list of up to REWRITE_BATCH stripped lines and returning the lines to write
+    instead, in the same order
+    :return: ARX entry for the new TAJ file, or None if no line changed
+    """
+    path = job['path'] + '/'
+    taj_name = 'tweets-' + str(uuid4()) + '.taj'
+    changed = False
+    with open(path + entry[0], errors='ignore') as fin, open(path + taj_name + '.tmp', 'w') as fout:
+        def flush(batch):
+            lines = transform(batch)
+            fout.write('\n'.join(lines) + '\n')
+            return lines != batch
+        batch = []
+        for line in fin:
+            line = line.strip()
+            if line: batch.append(line)
+            if len(batch) == REWRITE_BATCH:
+                changed = flush(batch) or changed
+                batch = []
+        if batch: changed = flush(batch) or changed
+    if not changed:
+        os.remove(path + taj_name + '.tmp')
+        return None
+    os.replace(path + taj_name + '.tmp', path + taj_name)
+    return [taj_name] + list(entry[1:6]) + [entry[6] if len(entry) > 6 and entry[6] else summarize_taj(path + taj_name)]
+
+def rewrite_archive(job, transform, grace=DEFAULT_GRACE, task=None):
+    """
+    Rewrite the lines of every finished TAJ but the last (see rewrite_lines), swapping each into the ARX as
+    compact_archive swaps its rewrites, so this is safe while the job is collecting. The last finished TAJ, which
+    the collector may still add to, is left for a later run.
+    :param job: Job dictionary with a path to an archive
+    :param transform: Same as for rewrite_lines
+    :param grace: Seconds to keep replaced TAJ files before deleting them
+    :param task: Optional task_mgr.Task to report progress to and check for cancellation
+    :return: Dictionary with the number of segments 'rewritten', 'skipped' because the archive changed underneath
+    them, and old TAJ files 'purged'
+    """
+    candidates = [list(entry) for entry in (load_arx(job)['finished'] or [])[:-1]]
+    result = {'rewritten' : 0, 'skipped' : 0, 'purged' : 0}
+    if task is not None: task.expect(len(candidates), sum(entry[5] for entry in candidates))
+    for entry in candidates:
+        if task is not None: task.check()
+        output = rewrite_lines(job, entry, transform)
+        if output is not None:
+            index_segment(job, output)
+            if publish(job, [entry], [output]):
+                result['rewritten'] += 1
+            else:
+                result['skipped'] += 1
+                remove_segment(job, output[0])
+        if task is not None:
+            task.tweets_scanned += entry[5]
+            task.segment_done(entry)
+    result['purged'] = purge_retired(job, grace)
+    return result
+
+def share_archive(job, store, grace=DEFAULT_GRACE, task=None):
+    """
+    Move the tweets of an archive's finished TAJ files into a shared store (see tweet_store), so archives of jobs
+    with overlapping queries keep each tweet once. Each TAJ is rewritten to hold only references to its tweets (see
+    rewrite_archive), and the collector then keeps its new tweets in the store too.
+    :param job: Job dictionary with a path to an archive
+    :param store: Directory of the shared store
+    :param grace: Seconds to keep replaced TAJ files before deleting them
+    :param task: Optional task_mgr.Task to report progress to and check for cancellation
+    :return: Dictionary as from rewrite_archive, with the number of tweets 'stored' that the store didn't already
+    hold
+    :raise ValueError: If the archive already keeps its tweets in another store
+    """
+    with archive_lock(job):
+        arx = load_arx(job)
+        if arx.get('store') is None:
+            arx['store'] = store
+            arx['revision'] = arx.get('revision', 0) + 1
+            write_arx(job)
+        elif arx['store'] != store:
+            raise ValueError('The archive in ' + job['path'] + ' already keeps its tweets in ' + arx['store'])
+    before = len(tweet_store.open_store(store))
+    # The store is shared, so tweets go into it with their user objects whole
+    rehydrate = user_dict.Rehydrator(os.path.join(job['path'], 'index.arx'))
+    result = rewrite_archive(job, lambda lines : tweet_store.share_tweets(store, list(map(rehydrate, lines))),
+                             grace, task)
+    result['stored'] = len(tweet_store.open_store(store)) - before
+    return result
+
+def normalize_users(job, grace=DEFAULT_GRACE, task=None):
+    """
+    Move the user objects in an archive's finished TAJ files into its user dictionary (see user_dict), keeping each
+    state of each profile once. Each TAJ is rewritten to hold stand-ins for its user objects (see rewrite_archive).
+    Set the job's user_dictionary option for the collector to do the same with new tweets.
+    :param job: Job dictionary with a path to an archive
+    :param grace: Seconds to keep replaced TAJ files before deleting them
+    :param task: Optional task_mgr.Task to report progress to and check for cancellation
+    :return: Dictionary as from rewrite_archive, with the number of profile 'versions' the dictionary didn't
+    already hold
+    """
+    before = len(user_dict.open_dictionary(job['path'], create=True))
+    result = rewrite_archive(job, lambda lines : user_dict.normalize_tweets(job['path'], lines), grace, task)
+    result['versions'] = len(user_dict.open_dictionary(job['path'])) - before
+    return result
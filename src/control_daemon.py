@@ -0,0 +1,196 @@
+import os
+import json
+import threading
+import socketserver
+import log_mgr
+from arx_mgr import resolve_archive
+from run_job import Job
+from job_mgr import Dispatcher
+
+import twitter_graph
+import temporal_graph
+import tweet_filter
+
+DEFAULT_SOCKET = 'logs/ornitholog.sock'
+
+
+class ControlHandler(socketserver.StreamRequestHandler) :
+    """
+    Serve one client connection: read one JSON command per line, answer each with one JSON reply per line.
+    """
+
+    def handle(self) :
+        for line in self.rfile :
+            line = line.strip()
+            if not line : continue
+            try :
+                request = json.loads(line.decode('utf-8'))
+                reply = self.server.daemon.handle_command(request)
+            except ValueError as exc :
+                reply = {'ok' : False, 'error' : 'Malformed request: ' + str(exc)}
+            except Exception as exc :
+                log_mgr.log_exception(self.server.daemon.log_file, exc, header='CONTROL ERROR', context=line)
+                reply = {'ok' : False, 'error' : str(exc)}
+            try :
+                self.wfile.write((json.dumps(reply) + '\n').encode('utf-8'))
+                self.wfile.flush()
+            except (BrokenPipeError, ConnectionResetError) :
+                return
+            
+            # Only stop serving once the client has its answer. shutdown() waits for serve_forever to return, so it
+            # can't be called from a request thread directly.
+            if self.server.daemon.shutting_down :
+                threading.Thread(target=self.server.shutdown, daemon=True).start()
+                return
+
+
+class ControlServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer) :
+    """
+    Unix domain socket server handing each client its own thread, so one slow client never holds up another.
+    """
+    daemon_threads = True
+
+    def __init__(self, socket_path, daemon) :
+        self.daemon = daemon
+        socketserver.UnixStreamServer.__init__(self, socket_path, ControlHandler)
+
+
+class Daemon :
+    """
+    Run a Dispatcher without a terminal and control it over a Unix domain socket. Requests are JSON objects, one per
+    line, with a 'cmd' entry of start, stop, status, export, cancel or shutdown. Every request gets one JSON reply line
+    with an 'ok' entry, plus 'error' on failure. Exports run as background tasks; the reply carries the task ID to pass
+    to status or cancel.
+    """
+
+    def __init__(self, socket_path=DEFAULT_SOCKET) :
+        self.socket_path = socket_path
+        self.log_file = 'logs/daemon_errors.log'
+        self.dispatcher = Dispatcher(name='Dispatcher')
+        self.dispatcher.daemon = True
+        self.server = None
+        self.shutting_down = False
+        self.commands = {
+            'start' : self.cmd_start,
+            'stop' : self.cmd_stop,
+            'status' : self.cmd_status,
+            'export' : self.cmd_export,
+            'cancel' : self.cmd_cancel,
+            'shutdown' : self.cmd_shutdown,
+        }
+
+    def serve_forever(self) :
+        """
+        Start the dispatcher and answer control requests until told to shut down.
+        """
+        # Clear out a socket left behind by a previous run
+        if os.path.exists(self.socket_path) :
+            os.remove(self.socket_path)
+        os.makedirs(os.path.dirname(self.socket_path) or '.', exist_ok=True)
+
+        self.dispatcher.start()
+        self.server = ControlServer(self.socket_path, self)
+        try :
+            self.server.serve_forever(poll_interval=0.5)
+        finally :
+            self.server.server_close()
+            if os.path.exists(self.socket_path) :
+                os.remove(self.socket_path)
+            self.dispatcher.tasks.shutdown(wait=True)
+            self.dispatcher.ex.shutdown(wait=True)
+            log_mgr.flush()
+
+    def handle_command(self, request) :
+        """
+        Carry out one control request.
+        :param request: Dictionary decoded from the client's JSON line
+        :return: Dictionary to send back as the reply
+        """
+        if type(request) is not dict or request.get('cmd') not in self.commands :
+            return {'ok' : False, 'error' : 'Unknown command. Try one of: ' + ', '.join(sorted(self.commands))}
+        return self.commands[request['cmd']](request)
+
+    def cmd_start(self, request) :
+        if request.get('all') :
+            return {'ok' : False, 'error' : 'Starting all jobs is not currently implemented.'}
+        if not request.get('job') :
+            return {'ok' : False, 'error' : 'No job specified.'}
+        self.dispatcher.pushRequest(request['job'])
+        return {'ok' : True, 'status' : {request['job'] : self.dispatcher.getJobStatus(request['job']).name}}
+
+    def cmd_stop(self, request) :
+        if request.get('all') :
+            jobs = list(self.dispatcher.getJobs())
+        elif request.get('job') :
+            jobs = [request['job']]
+        else :
+            return {'ok' : False, 'error' : 'No job specified.'}
+        for job in jobs :
+            self.dispatcher.setJobStatus(job, Job.STOPPING)
+        return {'ok' : True, 'status' : {job : self.dispatcher.getJobStatus(job).name for job in jobs}}
+
+    def cmd_status(self, request) :
+        if request.get('task') is not None :
+            task = self.dispatcher.tasks.getTask(request['task'])
+            if task is None :
+                return {'ok' : False, 'error' : 'No task ' + str(request['task']) + '.'}
+            return {'ok' : True, 'tasks' : [task.describe()]}
+        if request.get('tasks') :
+            return {'ok' : True, 'tasks' : [task.describe() for task in self.dispatcher.tasks.getTasks()]}
+        if request.get('job') :
+            jobs = [request['job']]
+        else :
+            jobs = sorted(self.dispatcher.getJobs())
+        return {'ok' : True, 'status' : {job : self.dispatcher.getJobStatus(job).name for job in jobs}}
+
+    def cmd_export(self, request) :
+        if not request.get('job') :
+            return {'ok' : False, 'error' : 'No job specified.'}
+        try :
+            job = resolve_archive(request['job'], request.get('singlefile', False))
+        except (OSError, ValueError) :
+            return {'ok' : False, 'error' : 'Unable to load specified job!'}
+        # Tweet filters, keyed by the terminal's flag names (see 'help exportgraph')
+        try :
+            where = tweet_filter.from_options(request.get('filter') or {})
+        except (ValueError, TypeError, AttributeError) :
+            return {'ok' : False, 'error' : 'Malformed tweet filter.'}
+
+        # Replies are the default interaction unless another kind was asked for
+        mentions = request.get('mentions', False)
+        retweets = request.get('retweets', False)
+        quotes = request.get('quotes', False)
+        replies = request.get('replies', not (mentions or retweets or quotes))
+        outfile = request.get('outfile') or 'data/graph.gml'
+
+        if request.get('window') :
+            if request.get('multigraph', False) :
+                return {'ok' : False, 'error' : 'Sliding windows can only be used with weighted graphs.'}
+            task = self.dispatcher.tasks.submit('export ' + outfile, temporal_graph.export_windows,
+                                                job, outfile, request['window'], request.get('step') or request['window'],
+                                                request.get('min_id'), request.get('max_id'),
+                                                request.get('min_date'), request.get('max_date'),
+                                                not request.get('undirected', False),
+                                                replies, mentions, retweets, quotes, request.get('dynamic', False),
+                                                where=where)
+            return {'ok' : True, 'outfile' : outfile, 'task' : task.describe()}
+        task = self.dispatcher.tasks.submit('export ' + outfile, twitter_graph.export_graph,
+                                            job, outfile, request.get('min_id'), request.get('max_id'),
+                                            request.get('min_date'), request.get('max_date'),
+                                            not request.get('undirected', False), request.get('multigraph', False),
+                                            replies, mentions, retweets, quotes, request.get('processes', 1),
+                                            where=where)
+        return {'ok' : True, 'outfile' : outfile, 'task' : task.describe()}
+
+    def cmd_cancel(self, request) :
+        if request.get('task') is None :
+            return {'ok' : False, 'error' : 'No task specified.'}
+        if not self.dispatcher.tasks.cancel(request['task']) :
+            return {'ok' : False, 'error' : 'Task ' + str(request['task']) + ' is not queued or running.'}
+        return {'ok' : True, 'task' : self.dispatcher.tasks.getTask(request['task']).describe()}
+
+    def cmd_shutdown(self, request) :
+        for job in self.dispatcher.getJobs() :
+            self.dispatcher.setJobStatus(job, Job.STOPPING)
+        self.shutting_down = True
+        return {'ok' : True}
@@ -0,0 +1,136 @@
+import os
+import gzip
+import json
+import json_codec
+from arx_mgr import iter_tweetfile, load_arx
+from tweet_parser import get_extractor
+
+# Interaction types, as bits of an edge's type mask
+REPLY = 1
+MENTION = 2
+RETWEET = 4
+QUOTE = 8
+
+STORE_DIR = 'edges'
+
+# Tweet fields the store is tallied from
+FIELDS = ('user_id', 'screen_name', 'reply_tuple', 'user_mention_tuples', 'retweet_tuple', 'quoted_user_tuple')
+
+
+def type_mask(replies=True, mentions=False, retweets=False, quotes=False):
+    """
+    Combine the interaction types a graph should include into one mask.
+    :return: Bitwise OR of the selected type bits
+    """
+    return (REPLY if replies else 0) | (MENTION if mentions else 0) | \
+           (RETWEET if retweets else 0) | (QUOTE if quotes else 0)
+
+def store_path(job, taj_name):
+    """
+    :param job: Job dictionary with a path to an archive
+    :param taj_name: Filename of the TAJ (no directory)
+    :return: Path of the TAJ's edge store file
+    """
+    return os.path.join(job['path'], STORE_DIR, taj_name + '.json.gz')
+
+def tally_segment(taj_file):
+    """
+    Count every interaction in a TAJ file, whatever its type. A tweet that reaches the same user in more than one
+    way (say, a reply that also mentions them) is counted once, under the mask of all the ways it reached them,
+    so that a graph of any combination of types can be weighted exactly from these counts.
+    :param taj_file: Path to the TAJ file
+    :return: Dictionary with 'counts' as [source ID, sink ID, type mask, count] lists in order of first appearance,
+    'handles' as [user ID, latest screen name] lists and 'num_tweets'
+    """
+    counts = {}
+    handles = {}
+    num_tweets = 0
+    for record in get_extractor(*FIELDS).extract_iter(iter_tweetfile(taj_file, users=False)):
+        num_tweets += 1
+        source = (record.user_id, record.screen_name)
+        if source[0] is None: continue
+
+        # Collect each distinct (ID, screen name) this tweet reaches, and how it reaches them
+        sinks = {}
+        reply = record.reply_tuple
+        if reply is not None: sinks[reply] = sinks.get(reply, 0) | REPLY
+        for mention in record.user_mention_tuples:
+            sinks[mention] = sinks.get(mention, 0) | MENTION
+        retweet = record.retweet_tuple
+        if retweet is not None: sinks[retweet] = sinks.get(retweet, 0) | RETWEET
+        quote = record.quoted_user_tuple
+        if quote is not None: sinks[quote] = sinks.get(quote, 0) | QUOTE
+        sinks.pop(source, None)
+
+        for sink, mask in sinks.items():
+            key = (source[0], sink[0], mask)
+            counts[key] = counts.get(key, 0) + 1
+            handles[sink[0]] = sink[1]
+        handles[source[0]] = source[1]
+
+    return {
+        'counts' : [[src, snk, mask, num] for (src, snk, mask), num in counts.items()],
+        'handles' : [[user_id, handle] for user_id, handle in handles.items()],
+        'num_tweets' : num_tweets,
+    }
+
+def update_segment(job, entry):
+    """
+    Rebuild the edge store file for one TAJ. Called when a segment is finalized, since the newest finished TAJ can
+    still grow.
+    :param job: Job dictionary with a path to an archive
+    :param entry: The TAJ's ARX entry
+    """
+    taj_name = os.path.basename(str(entry[0]))
+    taj_file = os.path.join(job['path'], taj_name)
+    data = tally_segment(taj_file)
+    stat = os.stat(taj_file)
+    data['taj'] = taj_name
+    data['size'] = stat.st_size
+    data['mtime'] = stat.st_mtime
+
+    # Write to a temporary file first so a reader never sees a partial store
+    path = store_path(job, taj_name)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with gzip.open(path + '.tmp', 'wt') as fout:
+        json.dump(data, fout)
+    os.replace(path + '.tmp', path)
+
+def load_segment(job, entry):
+    """
+    Load the edge store for a TAJ, if it exists and still matches the file on disk.
+    :param job: Job dictionary with a path to an archive
+    :param entry: The TAJ's ARX entry
+    :return: Dictionary as returned by tally_segment, or None if there is no up-to-date store
+    """
+    taj_name = os.path.basename(str(entry[0]))
+    try:
+        with gzip.open(store_path(job, taj_name), 'rt') as fin:
+            data = json_codec.load(fin)
+        stat = os.stat(os.path.join(job['path'], taj_name))
+    except (OSError, ValueError):
+        return None
+    if data.get('size') != stat.st_size or data.get('mtime') != stat.st_mtime:
+        return None
+    return data
+
+def build_store(job, task=None):
+    """
+    Build or refresh the edge store for every finished TAJ in an archive, such as one collected before the store
+    was enabled.
+    :param job: Job dictionary with a path to an archive
+    :param task: Optional task_mgr.Task to report progress to and check for cancellation
+    :return: Number of segments (re)built
+    """
+    arx = load_arx(job)
+    finished = arx['finished'] or []
+    if task is not None: task.expect(len(finished), sum(entry[5] for entry in finished))
+    built = 0
+    for entry in finished:
+        if load_segment(job, entry) is None:
+            update_segment(job, entry)
+            built += 1
+        if task is not None:
+            task.tweets_scanned += entry[5]
+            task.segment_done(entry)
+    return built
@@ -0,0 +1,200 @@
+import io
+import os
+import csv
+import gzip, bz2, lzma
+import datetime as dt
+import multiprocessing
+from collections import deque
+import json_codec
+import user_dict
+from arx_mgr import iter_tweetfile, scan_segments, scan_size
+from graph_writers import open_output, split_compression
+from tweet_parser import FIELDS, get_extractor
+
+# Fields exported if none are asked for: ID, time, author, text, hashtags and reply target
+DEFAULT_FIELDS = ('tweet_id', 'timestamp', 'user_id', 'screen_name', 'text', 'hashtags', 'reply_id')
+
+# Output formats by the output file's extension (ignoring any compression extension)
+FORMATS = {'.csv' : 'csv', '.jsonl' : 'jsonl', '.json' : 'jsonl'}
+
+# Compressors for whole chunks of output, by compression extension. Compressed chunks written back to back make a
+# valid multi-member file, which gzip, bzip2 and xz (and Python's readers for them) read as one.
+CHUNK_COMPRESSORS = {
+    '.gz' : lambda data : gzip.compress(data, mtime=0),     # No timestamp, so every export of the same rows matches
+    '.bz2' : bz2.compress,
+    '.xz' : lzma.compress,
+}
+
+# Values written as they are
+_SCALARS = (str, int, float, bool, type(None))
+
+# Segments each worker process may be ahead of the writer by, which bounds the memory held by finished chunks
+AHEAD = 2
+
+
+def export_format(outfile):
+    """
+    Pick an export format from an output path's extension, ignoring any compression extension.
+    :param outfile: Output path
+    :return: 'csv' or 'jsonl' (CSV if the extension isn't recognised)
+    """
+    return FORMATS.get(os.path.splitext(split_compression(outfile)[0])[1].lower(), 'csv')
+
+def plain_value(value):
+    """
+    :param value: Value of a tweet field
+    :return: The value as JSON can hold it: datetimes as ISO 8601 strings, sets as sorted lists, tuples as lists
+    """
+    if type(value) in _SCALARS:
+        return value
+    if isinstance(value, dt.datetime):
+        return value.isoformat()
+    if isinstance(value, (set, frozenset)):
+        return sorted(plain_value(item) for item in value)
+    if isinstance(value, (list, tuple)):
+        return [plain_value(item) for item in value]
+    return value
+
+def csv_value(value):
+    """
+    :param value: Value of a tweet field
+    :return: The value for a CSV cell: empty for None, and JSON for lists, sets and tuples
+    """
+    if type(value) in _SCALARS:
+        return value if value is not None else ''
+    value = plain_value(value)
+    if value is None:
+        return ''
+    if isinstance(value, list):
+        return json_codec.dumps(value)
+    return value
+
+def write_rows(records, fields, fmt, fout):
+    """
+    Write tweet records as rows.
+    :param records: Iterator over tweet_parser.TweetRecord with the fields
+    :param fields: Names of the fields, in column order
+    :param fmt: 'csv' or 'jsonl'
+    :param fout: Writable text file
+    :return: Number of rows written
+    """
+    rows = 0
+    if fmt == 'csv':
+        writer = csv.writer(fout)
+        for record in records:
+            writer.writerow([csv_value(getattr(record, field)) for field in fields])
+            rows += 1
+    else:
+        for record in records:
+            fout.write(json_codec.dumps({field : plain_value(getattr(record, field)) for field in fields}) + '\n')
+            rows += 1
+    return rows
+
+def header(fields, fmt):
+    """
+    :return: Header line for the format (the column names for CSV, none for JSONL)
+    """
+    if fmt != 'csv':
+        return ''
+    buffer = io.StringIO()
+    csv.writer(buffer).writerow(fields)
+    return buffer.getvalue()
+
+def export_segment(args):
+    """
+    Project the tweets in one TAJ file onto the fields. This is the map step of export_fields, run in a worker
+    process.
+    :param args: Tuple of (TAJ path, (min_id, max_id, min_date, max_date), fields, format, compression extension or
+    '', tweet_filter.Filter or None)
+    :return: Tuple of the rows as bytes, compressed if asked for, and the number of rows
+    """
+    taj_file, bounds, fields, fmt, compression, where = args
+    tweets = iter_tweetfile(taj_file, *bounds, lazy=True, where=where, users=user_dict.needs_profiles(fields))
+    buffer = io.StringIO()
+    rows = write_rows(get_extractor(*fields).extract_iter(tweets), fields, fmt, buffer)
+    data = buffer.getvalue().encode('utf-8')
+    if compression and rows:
+        data = CHUNK_COMPRESSORS[compression](data)
+    return data, rows
+
+def export_fields(job, outfile, fields=DEFAULT_FIELDS, min_id=None, max_id=None, min_date=None, max_date=None,
+                  where=None, processes=1, task=None):
+    """
+    Write chosen fields of the tweets in an archive to a CSV or JSON Lines file, one row per tweet in scan order.
+    Each TAJ file is projected as a whole, in worker processes if asked for, and the chunks are written in order as
+    they finish, so the output is the same with any number of processes. Workers only run a few segments ahead of
+    the writer, so memory use depends on the segment size, not the archive's. Compressed outputs are compressed by
+    the workers too, one chunk at a time.
+    :param job: Job dictionary with a path to an archive, or a tweet file (see arx_mgr.resolve_archive)
+    :param outfile: Output path; .csv or .jsonl, optionally followed by .gz, .bz2 or .xz
+    :param fields: Names of tweet_parser fields (see tweet_parser.FIELDS), in column order
+    :param where: Optional tweet_filter.Filter; only matching tweets are written (see arx_mgr.scan_tweets)
+    :param processes: Number of worker processes (None for one per CPU)
+    :param task: Optional task_mgr.Task to report progress to and check for cancellation
+    :return: Number of rows written
+    :raise ValueError: If a field isn't one tweet_parser can extract
+    """
+    fields = tuple(fields)
+    unknown = [field for field in fields if field not in FIELDS]
+    if unknown:
+        raise ValueError('Unknown tweet fields: ' + ', '.join(unknown))
+    fmt = export_format(outfile)
+    if min_date is None: min_date = -1
+    if max_date is None: max_date = float('inf')
+    bounds = (min_id, max_id, min_date, max_date)
+
+    # A single tweet file is streamed straight through
+    if type(job) is not dict:
+        if task is not None: task.expect(1, None)
+        tweets = iter_tweetfile(job, *bounds, lazy=True, where=where, users=user_dict.needs_profiles(fields))
+        if task is not None: tweets = task.track(tweets)
+        with open_output(outfile) as fout:
+            fout.write(header(fields, fmt))
+            rows = write_rows(get_extractor(*fields).extract_iter(tweets), fields, fmt, fout)
+        if task is not None: task.segment_done(job)
+        return rows
+
+    summary = where.summary() if where is not None else {}
+    segments = scan_segments(job, *bounds, **summary)
+    if task is not None: task.expect(*scan_size(job, *bounds, where=where))
+    compression = split_compression(outfile)[1]
+    work = iter([(str(entry[0]), bounds, fields, fmt, compression, where) for entry in segments])
+
+    directory = os.path.dirname(outfile)
+    if directory: os.makedirs(directory, exist_ok=True)
+    rows = 0
+    pool = None
+    with open(outfile, 'wb') as fout:
+        first = header(fields, fmt).encode('utf-8')
+        if first: fout.write(CHUNK_COMPRESSORS[compression](first) if compression else first)
+        if processes == 1 or len(segments) < 2:
+            results = map(export_segment, work)
+        else:
+            pool = multiprocessing.Pool(processes)
+            results = ordered_results(pool, export_segment, work, (processes or os.cpu_count() or 1) * AHEAD)
+        try:
+            for entry, (data, num) in zip(segments, results):
+                fout.write(data)
+                rows += num
+                if task is not None:
+                    task.tweets_scanned += entry[5]
+                    task.segment_done(entry)
+        finally:
+            if pool is not None: pool.terminate()
+    return rows
+
+def ordered_results(pool, func, work, ahead):
+    """
+    Run func over work in a pool, keeping at most ahead items submitted but not yet taken.
+    :param pool: multiprocessing.Pool
+    :param work: Iterator over arguments for func
+    :param ahead: Largest number of items in flight
+    :return: Generator over the results, in the order of work
+    """
+    pending = deque()
+    for args in work:
+        pending.append(pool.apply_async(func, (args,)))
+        if len(pending) >= ahead:
+            yield pending.popleft().get()
+    while pending:
+        yield pending.popleft().get()
@@ -0,0 +1,198 @@
+import os
+import csv
+import twitter_graph
+import compact_graph
+import graph_writers
+
+# Metrics are computed with NumPy array operations over the compact graph
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+# SciPy finds connected components faster, but isn't required
+try:
+    from scipy.sparse import csgraph
+except ImportError:
+    csgraph = None
+
+
+def edge_sources(graph):
+    """
+    :param graph: compact_graph.CSRGraph
+    :return: (int32 array) user number each stored edge leaves from, matching graph.indices
+    """
+    return np.repeat(np.arange(graph.num_nodes, dtype=np.int32), np.diff(graph.indptr))
+
+def degrees(graph):
+    """
+    Count each user's edges and total their interactions.
+    :param graph: compact_graph.CSRGraph
+    :return: Dictionary of arrays indexed by user number: 'in_degree', 'out_degree', 'in_weight' and 'out_weight'
+    for directed graphs, or 'degree' and 'weight' for undirected graphs
+    """
+    n = graph.num_nodes
+    out_degree = np.diff(graph.indptr)
+    out_weight = np.bincount(edge_sources(graph), weights=graph.weights, minlength=n).astype(np.int64)
+    if not graph.directed:
+        return {'degree' : out_degree, 'weight' : out_weight}
+    return {
+        'in_degree' : np.bincount(graph.indices, minlength=n),
+        'out_degree' : out_degree,
+        'in_weight' : np.bincount(graph.indices, weights=graph.weights, minlength=n).astype(np.int64),
+        'out_weight' : out_weight,
+    }
+
+def pagerank(graph, damping=0.85, max_iter=100, tol=1.0e-6, weighted=True, task=None):
+    """
+    Rank users by PageRank with sparse power iteration. This follows NetworkX's pagerank(): rank flows along edges in
+    proportion to their weight, users with no outgoing edges share their rank with everyone, and iteration stops once
+    the ranks change by less than num_nodes * tol in total.
+    :param graph: compact_graph.CSRGraph
+    :param damping: Probability of following an edge rather than jumping to a random user
+    :param max_iter: Most iterations to run (the last ranks are returned if they haven't converged by then)
+    :param tol: Convergence tolerance per user
+    :param weighted: Weight edges by their number of interactions
+    :param task: Optional task_mgr.Task to check for cancellation between iterations
+    :return: (float64 array) PageRank of each user number, summing to 1
+    """
+    n = graph.num_nodes
+    if n == 0:
+        return np.zeros(0)
+    sources = edge_sources(graph)
+    weights = graph.weights.astype(np.float64) if weighted else np.ones(len(graph.indices))
+    out_weight = np.bincount(sources, weights=weights, minlength=n)
+    dangling = out_weight == 0
+    # Share of each source's rank that each of its edges carries
+    share = weights / np.where(dangling, 1.0, out_weight)[sources]
+    del weights
+
+    ranks = np.full(n, 1.0 / n)
+    for _ in range(max_iter):
+        if task is not None: task.check()
+        last = ranks
+        ranks = damping * np.bincount(graph.indices, weights=last[sources] * share, minlength=n)
+        ranks += (damping * last[dangling].sum() + 1.0 - damping) / n
+        if np.abs(ranks - last).sum() < n * tol:
+            break
+    return ranks
+
+def connected_components(graph):
+    """
+    Find the weakly connected components of the graph (the connected components, if it is undirected).
+    :param graph: compact_graph.CSRGraph
+    :return: Tuple of (int) number of components, (int64 array) component of each user number. Components are
+    numbered from the largest down, so component 0 is the giant component.
+    """
+    n = graph.num_nodes
+    if n == 0:
+        return 0, np.zeros(0, dtype=np.int64)
+    if csgraph is not None:
+        labels = csgraph.connected_components(graph.to_sparse(), directed=True, connection='weak')[1]
+    else:
+        # Hook the larger of each edge's two labels onto the smaller, then shortcut every user straight to their
+        # root, until no edge joins two different labels
+        sources = edge_sources(graph)
+        labels = np.arange(n)
+        while True:
+            lo = np.minimum(labels[sources], labels[graph.indices])
+            hi = np.maximum(labels[sources], labels[graph.indices])
+            joins = lo != hi
+            if not joins.any(): break
+            np.minimum.at(labels, hi[joins], lo[joins])
+            while True:
+                roots = labels[labels]
+                if (roots == labels).all(): break
+                labels = roots
+
+    # Renumber the components by size
+    _, inverse, sizes = np.unique(labels, return_inverse=True, return_counts=True)
+    rank = np.empty(len(sizes), dtype=np.int64)
+    rank[np.argsort(-sizes, kind='stable')] = np.arange(len(sizes))
+    return len(sizes), rank[inverse]
+
+def top_k(scores, k):
+    """
+    :param scores: Array of scores indexed by user number
+    :param k: Number of users to keep
+    :return: (int64 array) user numbers of the k highest scores, highest first (ties go to the lower user number)
+    """
+    k = min(k, len(scores))
+    if k <= 0:
+        return np.zeros(0, dtype=np.int64)
+    order = np.lexsort((np.arange(len(scores)), -scores))
+    return order[:k]
+
+def compute_metrics(graph, damping=0.85, task=None):
+    """
+    Compute every metric for a graph.
+    :param graph: compact_graph.CSRGraph
+    :param damping: PageRank damping factor
+    :param task: Optional task_mgr.Task to check for cancellation
+    :return: Dictionary of arrays indexed by user number: the degrees (see degrees), 'pagerank' and 'component',
+    plus 'num_components'
+    """
+    if np is None:
+        raise ImportError('NumPy library is required for graph metrics.')
+    metrics = degrees(graph)
+    metrics['pagerank'] = pagerank(graph, damping, task=task)
+    if task is not None: task.check()
+    metrics['num_components'], metrics['component'] = connected_components(graph)
+    return metrics
+
+def write_metrics(graph, metrics, outfile, top=None):
+    """
+    Write one CSV row per user, highest PageRank first.
+    :param graph: compact_graph.CSRGraph
+    :param metrics: Dictionary from compute_metrics
+    :param outfile: Output path; a .gz, .bz2 or .xz extension compresses the output
+    :param top: Only write this many users, the top influencers (all users if None)
+    :return: Number of users written
+    """
+    columns = [name for name in ('in_degree', 'out_degree', 'in_weight', 'out_weight', 'degree', 'weight',
+                                 'pagerank', 'component') if name in metrics]
+    order = top_k(metrics['pagerank'], graph.num_nodes if top is None else top)
+    with graph_writers.open_output(outfile) as fout:
+        writer = csv.writer(fout)
+        writer.writerow(['rank', 'id', 'handle'] + columns)
+        for rank, idx in enumerate(order, 1):
+            handle = graph.handle(idx)
+            writer.writerow([rank, graph.user_id(idx), '' if handle is None else handle] +
+                            [metrics[name][idx].item() for name in columns])
+    return len(order)
+
+def export_metrics(job, outfile, min_id=None, max_id=None, min_date=None, max_date=None, directed=True,
+                   replies=True, mentions=False, retweets=False, quotes=False, processes=1, damping=0.85, top=None,
+                   where=None, task=None):
+    """
+    Compute degree, PageRank and connected components for the interaction graph of an archive, and write them to
+    CSV (see write_metrics). The graph is built straight into compact form, so no graph file is written or read, and
+    everything runs as NumPy array operations that scale to graphs far beyond what NetworkX can hold.
+    :param job: Job dictionary with a path to an archive, a tweet file (see arx_mgr.resolve_archive), or the path of
+    a graph saved in compact form (see compact_graph), in which case the bounds and interaction options are ignored
+    :param outfile: Path of the CSV to write
+    :param processes: Number of worker processes to scan the archive with (None for one per CPU)
+    :param damping: PageRank damping factor
+    :param top: Only write the top this many users by PageRank
+    :param where: Optional tweet_filter.Filter; only interactions in matching tweets are counted
+    :param task: Optional task_mgr.Task to report progress to and check for cancellation
+    :return: Dictionary with the graph's 'nodes', 'edges', 'components' and 'largest_component' size
+    """
+    if type(job) is not dict and os.path.isdir(job):
+        graph = compact_graph.load_graph(job)
+    else:
+        counts = twitter_graph.count_interactions(job, min_id, max_id, min_date, max_date, directed, False,
+                                                  replies, mentions, retweets, quotes, processes, task,
+                                                  where=where)
+        graph = counts.to_csr()
+        del counts
+    if task is not None: task.check()
+    metrics = compute_metrics(graph, damping, task)
+    if task is not None: task.check()
+    write_metrics(graph, metrics, outfile, top)
+    return {
+        'nodes' : graph.num_nodes,
+        'edges' : graph.num_edges,
+        'components' : metrics['num_components'],
+        'largest_component' : int(np.count_nonzero(metrics['component'] == 0)),
+    }
@@ -0,0 +1,174 @@
+import os
+import gzip, bz2, lzma
+import csv
+import compact_graph
+from xml.sax.saxutils import quoteattr
+
+# Compressors chosen by the output file's final extension
+COMPRESSORS = {
+    '.gz' : gzip.open,
+    '.bz2' : bz2.open,
+    '.xz' : lzma.open,
+}
+
+
+def split_compression(outfile):
+    """
+    Split a compression extension off an output path.
+    :param outfile: Output path, such as 'data/graph.gexf.gz'
+    :return: Tuple of (path without compression extension, compression extension or '')
+    """
+    base, ext = os.path.splitext(outfile)
+    if ext.lower() in COMPRESSORS:
+        return base, ext.lower()
+    return outfile, ''
+
+def graph_format(outfile):
+    """
+    Pick a graph format from an output path's extension, ignoring any compression extension.
+    :param outfile: Output path
+    :return: 'gml', 'gexf', 'csv' or 'csr' (GML if the extension isn't recognised)
+    """
+    ext = os.path.splitext(split_compression(outfile)[0])[1].lower()
+    if ext in ('.gexf', '.csv', '.csr'):
+        return ext[1:]
+    return 'gml'
+
+def open_output(outfile):
+    """
+    Open an output file for writing text, compressing it if its extension asks for it.
+    :param outfile: Output path
+    :return: Writable text file object
+    """
+    directory = os.path.dirname(outfile)
+    if directory: os.makedirs(directory, exist_ok=True)
+    compression = split_compression(outfile)[1]
+    if compression:
+        return COMPRESSORS[compression](outfile, 'wt', encoding='utf-8', newline='')
+    return open(outfile, 'w', encoding='utf-8', newline='')
+
+def node_list_path(outfile):
+    """
+    Get where the node list goes when a graph is written as CSV: next to the edge list, with '-nodes' added to its
+    name.
+    :param outfile: Path of the CSV edge list
+    :return: Path of the CSV node list
+    """
+    base, compression = split_compression(outfile)
+    stem, ext = os.path.splitext(base)
+    return stem + '-nodes' + ext + compression
+
+def gml_string(value):
+    """
+    Quote a string for GML, escaping quotes, ampersands and non-ASCII characters as NetworkX does.
+    """
+    escaped = []
+    for char in str(value):
+        if char in '"&' or ord(char) > 127:
+            escaped.append('&#' + str(ord(char)) + ';')
+        else:
+            escaped.append(char)
+    return '"' + ''.join(escaped) + '"'
+
+def write_graph(counts, outfile, fmt=None):
+    """
+    Write the user interaction graph straight from its counts, one node and one edge at a time, without building it
+    in memory first.
+    :param counts: twitter_graph.InteractionCounts
+    :param outfile: Output path; a .gz, .bz2 or .xz extension compresses the output
+    :param fmt: 'gml', 'gexf', 'csv' or 'csr' (chosen from the extension if omitted)
+    """
+    if fmt is None: fmt = graph_format(outfile)
+    WRITERS[fmt](counts, outfile)
+
+def write_gml(counts, outfile):
+    """
+    Write a graph as GML, in the same layout nx.write_gml uses: nodes are numbered in order, labelled with their user
+    ID and carry a 'handle'.
+    """
+    with open_output(outfile) as fout:
+        fout.write('graph [\n')
+        if counts.directed: fout.write('  directed 1\n')
+        if counts.multigraph: fout.write('  multigraph 1\n')
+        for idx, (user_id, handle) in enumerate(zip(counts.ids, counts.handles)):
+            fout.write('  node [\n    id ' + str(idx) + '\n    label "' + str(user_id) + '"\n')
+            if handle is not None: fout.write('    handle ' + gml_string(handle) + '\n')
+            fout.write('  ]\n')
+        index = counts.index
+        if counts.multigraph:
+            for src, snk, tweet_id, timestamp in counts.iter_edges():
+                fout.write('  edge [\n    source ' + str(index[src]) + '\n    target ' + str(index[snk]) +
+                           '\n    key ' + str(tweet_id) + '\n    timestamp ' + repr(float(timestamp)) + '\n  ]\n')
+        else:
+            for src, snk, weight in counts.iter_edges():
+                fout.write('  edge [\n    source ' + str(index[src]) + '\n    target ' + str(index[snk]) +
+                           '\n    weight ' + str(weight) + '\n  ]\n')
+        fout.write(']\n')
+
+def write_gexf(counts, outfile):
+    """
+    Write a graph as GEXF 1.2 for Gephi. Nodes are keyed on user ID and labelled with their handle.
+    """
+    with open_output(outfile) as fout:
+        fout.write('<?xml version="1.0" encoding="UTF-8"?>\n'
+                   '<gexf xmlns="http://www.gexf.net/1.2draft" version="1.2">\n'
+                   '  <graph defaultedgetype="' + ('directed' if counts.directed else 'undirected') +
+                   '" mode="static">\n'
+                   '    <attributes class="node" mode="static">\n'
+                   '      <attribute id="0" title="handle" type="string"/>\n'
+                   '    </attributes>\n')
+        if counts.multigraph:
+            fout.write('    <attributes class="edge" mode="static">\n'
+                       '      <attribute id="0" title="tweet_id" type="long"/>\n'
+                       '      <attribute id="1" title="timestamp" type="double"/>\n'
+                       '    </attributes>\n')
+        fout.write('    <nodes>\n')
+        for user_id, handle in zip(counts.ids, counts.handles):
+            label = str(user_id) if handle is None else handle
+            fout.write('      <node id="' + str(user_id) + '" label=' + quoteattr(label) + '>')
+            if handle is not None:
+                fout.write('<attvalues><attvalue for="0" value=' + quoteattr(handle) + '/></attvalues>')
+            fout.write('</node>\n')
+        fout.write('    </nodes>\n    <edges>\n')
+        if counts.multigraph:
+            for idx, (src, snk, tweet_id, timestamp) in enumerate(counts.iter_edges()):
+                fout.write('      <edge id="' + str(idx) + '" source="' + str(src) + '" target="' + str(snk) +
+                           '"><attvalues><attvalue for="0" value="' + str(tweet_id) + '"/>'
+                           '<attvalue for="1" value="' + repr(float(timestamp)) + '"/></attvalues></edge>\n')
+        else:
+            for idx, (src, snk, weight) in enumerate(counts.iter_edges()):
+                fout.write('      <edge id="' + str(idx) + '" source="' + str(src) + '" target="' + str(snk) +
+                           '" weight="' + str(weight) + '"/>\n')
+        fout.write('    </edges>\n  </graph>\n</gexf>\n')
+
+def write_csv(counts, outfile):
+    """
+    Write a graph as a CSV edge list, plus a CSV node list of user IDs and handles (see node_list_path).
+    """
+    with open_output(node_list_path(outfile)) as fout:
+        writer = csv.writer(fout)
+        writer.writerow(['id', 'handle'])
+        writer.writerows(zip(counts.ids, counts.handles))
+    with open_output(outfile) as fout:
+        writer = csv.writer(fout)
+        if counts.multigraph:
+            writer.writerow(['source', 'target', 'tweet_id', 'timestamp'])
+        else:
+            writer.writerow(['source', 'target', 'weight'])
+        writer.writerows(counts.iter_edges())
+
+def write_csr(counts, outfile):
+    """
+    Save a graph as a directory of arrays that compact_graph.load_graph can memory-map (see compact_graph.CSRGraph).
+    Multigraph edges between the same users are summed into weighted edges.
+    """
+    if split_compression(outfile)[1]:
+        raise ValueError('Compact graphs are saved as arrays and cannot be compressed.')
+    compact_graph.save_graph(counts, outfile)
+
+WRITERS = {
+    'gml' : write_gml,
+    'gexf' : write_gexf,
+    'csv' : write_csv,
+    'csr' : write_csr,
+}
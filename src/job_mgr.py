@@ -1,6 +1,9 @@
 import time, threading
-import traceback
+import log_mgr
 from run_job import collection_job, Job
+from task_mgr import TaskManager
+from budget_mgr import BudgetAllocator
+from backoff_mgr import BreakerRegistry
 
 def dummy_load(job_id, executor, name,wait_time=10) :
     print('Beginning dummy load',name)
@@ -26,7 +29,7 @@ class Dispatcher(threading.Thread) :
     and optimize flow.
     """
     
-    def __init__(self,**kwargs) :
+    def __init__(self,max_tasks=1,**kwargs) :
         
         # Superclass constructor
         threading.Thread.__init__(self,daemon=True,**kwargs)
@@ -35,6 +38,15 @@ class Dispatcher(threading.Thread) :
         # Initialize our process pool
         self.ex = con.ThreadPoolExecutor()
         
+        # Heavy analysis commands get their own, smaller pool so they can't crowd out collection
+        self.tasks = TaskManager(max_workers=max_tasks)
+        
+        # Share each credential's rate-limit among its jobs by how fast their tweets arrive
+        self.budget = BudgetAllocator()
+        
+        # Backoff state per credential and endpoint, kept for as long as Ornitholog runs
+        self.breakers = BreakerRegistry()
+        
         # Futures dictionary to track jobs
         self.lock = threading.Lock()
         self.job_status = {}  # ALWAYS LOCK WHILE USING THIS DICT
@@ -47,16 +59,7 @@ class Dispatcher(threading.Thread) :
         self.workpool = []
     
     def log_error(self, exc, query=None) :
-        with open(self.log_file, 'a+') as fout :
-            fout.write('ERROR REPORT:\n')
-            if query is not None :
-                fout.write('QUERY: ' + str(query) + '\n')
-            fout.write(time.strftime("%m-%d-%Y %H:%M:%S (UTC %z)"))
-            fout.write('\n-----------\n')
-            traceback.print_stack(file=fout)
-            fout.write('\n-----------\n')
-            traceback.print_exc(file=fout)
-            fout.write('\n-----------\n\n\n\n\n')
+        log_mgr.log_exception(self.log_file, exc, header='ERROR REPORT', context=None if query is None else 'QUERY: ' + str(query), stack=True)
     
     def run(self) :
         while True :
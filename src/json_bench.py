@@ -0,0 +1,147 @@
+import argparse
+import json
+import random
+import sys
+import time
+import json_codec
+
+
+def sample_user(rng, user_id):
+    """
+    Make a user object shaped like the ones in search results.
+    """
+    handle = 'user' + str(user_id)
+    return {
+        'id' : user_id, 'id_str' : str(user_id), 'name' : 'User ' + str(user_id) + ' ✨',
+        'screen_name' : handle, 'location' : rng.choice(['', 'Gainesville, FL', 'München', 'Tokyo 東京']),
+        'description' : 'Writes about {science}, "policy" & the weather. ' * rng.randint(0, 3),
+        'url' : None, 'entities' : {'description' : {'urls' : []}},
+        'protected' : False, 'followers_count' : rng.randint(0, 100000), 'friends_count' : rng.randint(0, 5000),
+        'listed_count' : rng.randint(0, 500), 'created_at' : 'Mon Apr 02 13:25:11 +0000 2012',
+        'favourites_count' : rng.randint(0, 50000), 'utc_offset' : None, 'time_zone' : None, 'geo_enabled' : True,
+        'verified' : rng.random() < 0.05, 'statuses_count' : rng.randint(1, 200000), 'lang' : 'en',
+        'contributors_enabled' : False, 'is_translator' : False, 'is_translation_enabled' : False,
+        'profile_background_color' : 'C0DEED',
+        'profile_background_image_url' : 'http://abs.twimg.com/images/themes/theme1/bg.png',
+        'profile_background_image_url_https' : 'https://abs.twimg.com/images/themes/theme1/bg.png',
+        'profile_background_tile' : False,
+        'profile_image_url' : 'http://pbs.twimg.com/profile_images/' + str(user_id) + '/photo_normal.jpg',
+        'profile_image_url_https' : 'https://pbs.twimg.com/profile_images/' + str(user_id) + '/photo_normal.jpg',
+        'profile_link_color' : '1DA1F2', 'profile_sidebar_border_color' : 'C0DEED',
+        'profile_sidebar_fill_color' : 'DDEEF6', 'profile_text_color' : '333333',
+        'profile_use_background_image' : True, 'has_extended_profile' : False, 'default_profile' : True,
+        'default_profile_image' : False, 'following' : None, 'follow_request_sent' : None, 'notifications' : None,
+        'translator_type' : 'none',
+    }
+
+def sample_tweet(rng, tweet_id, nested=True):
+    """
+    Make a tweet shaped like those in search results: a mix of plain tweets, replies, mentions, retweets (with the
+    original tweet nested inside) and quotes, with non-ASCII text and the odd lone surrogate from truncated emoji.
+    """
+    author = rng.randint(1, 50000)
+    mentioned = rng.sample(range(1, 50000), rng.choice([0, 0, 1, 2]))
+    text = ' '.join(['@user' + str(user_id) for user_id in mentioned] +
+                    ['Climate data for today', '#weather', 'café \U0001f327️', 'https://t.co/abc123'])
+    if rng.random() < 0.002: text += ' \ud83c'
+    tweet = {
+        'created_at' : time.strftime('%a %b %d %H:%M:%S +0000 %Y', time.gmtime(1525132800 + tweet_id % 86400)),
+        'id' : tweet_id, 'id_str' : str(tweet_id), 'text' : text, 'truncated' : False,
+        'entities' : {
+            'hashtags' : [{'text' : 'weather', 'indices' : [23, 31]}], 'symbols' : [],
+            'user_mentions' : [{'screen_name' : 'user' + str(user_id), 'name' : 'User ' + str(user_id),
+                                'id' : user_id, 'id_str' : str(user_id), 'indices' : [0, 10]}
+                               for user_id in mentioned],
+            'urls' : [{'url' : 'https://t.co/abc123', 'expanded_url' : 'https://example.com/data/today',
+                       'display_url' : 'example.com/data/today', 'indices' : [45, 68]}],
+        },
+        'metadata' : {'iso_language_code' : 'en', 'result_type' : 'recent'},
+        'source' : '<a href="http://twitter.com/download/android" rel="nofollow">Twitter for Android</a>',
+        'in_reply_to_status_id' : None, 'in_reply_to_status_id_str' : None, 'in_reply_to_user_id' : None,
+        'in_reply_to_user_id_str' : None, 'in_reply_to_screen_name' : None,
+        'user' : sample_user(rng, author),
+        'geo' : None, 'coordinates' : None, 'place' : None, 'contributors' : None,
+    }
+    kind = rng.random()
+    if kind < 0.2:
+        replied = rng.randint(1, 50000)
+        tweet.update({'in_reply_to_status_id' : tweet_id - 7, 'in_reply_to_status_id_str' : str(tweet_id - 7),
+                      'in_reply_to_user_id' : replied, 'in_reply_to_user_id_str' : str(replied),
+                      'in_reply_to_screen_name' : 'user' + str(replied)})
+    elif kind < 0.7 and nested:
+        tweet['retweeted_status'] = sample_tweet(rng, tweet_id - 1000, False)
+    elif kind < 0.8 and nested:
+        tweet['quoted_status_id'] = tweet_id - 2000
+        tweet['quoted_status_id_str'] = str(tweet_id - 2000)
+        tweet['quoted_status'] = sample_tweet(rng, tweet_id - 2000, False)
+    tweet.update({'is_quote_status' : 'quoted_status' in tweet, 'retweet_count' : rng.randint(0, 1000),
+                  'favorite_count' : rng.randint(0, 1000), 'favorited' : False, 'retweeted' : False,
+                  'possibly_sensitive' : False, 'lang' : 'en'})
+    return tweet
+
+def sample_lines(count, seed=0):
+    """
+    :return: List of count representative tweets as TAJ lines
+    """
+    rng = random.Random(seed)
+    return [json_codec.dumps(sample_tweet(rng, 990000000000000000 + idx * 9973)) for idx in range(count)]
+
+def best_time(func, repeat):
+    """
+    :return: Fastest of repeat runs of func, in seconds
+    """
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        best = min(best, time.perf_counter() - start)
+    return best
+
+def run(lines, repeat=5, out=sys.stdout):
+    """
+    Time each installed backend over the tweets, and check that re-encoding what each decodes gives the same TAJ
+    lines as the standard library.
+    :param lines: Tweets as TAJ lines
+    :param repeat: Runs per measurement (the fastest is reported)
+    :return: Dictionary of backend name -> (seconds per tweet decoded, seconds per page decoded, compatible)
+    """
+    megabytes = sum(len(line) for line in lines) / 1.0e6
+    pages = [('{"statuses": [' + ', '.join(lines[idx:idx + 100]) + '], "search_metadata": {}}').encode('utf-8')
+             for idx in range(0, len(lines), 100)]
+    tweets = [json.loads(line) for line in lines]
+    expected = [json.dumps(tweet) for tweet in tweets]
+    encode = best_time(lambda: list(map(json_codec.dumps, tweets)), repeat)
+
+    out.write('%d tweets, %.1f MB; TAJ encoding (standard library) takes %.1f us/tweet\n' %
+              (len(lines), megabytes, 1.0e6 * encode / len(lines)))
+    out.write('%-8s %14s %10s %16s  %s\n' % ('backend', 'decode us/tweet', 'MB/s', 'response ms/page', 'TAJ bytes'))
+    results = {}
+    for name, decode in json_codec.BACKENDS.items():
+        line_time = best_time(lambda: list(map(decode, lines)), repeat)
+        page_time = best_time(lambda: list(map(decode, pages)), repeat)
+        compatible = [json_codec.dumps(decode(line)) for line in lines] == expected
+        results[name] = (line_time / len(lines), page_time / max(len(pages), 1), compatible)
+        out.write('%-8s %14.1f %10.1f %16.2f  %s\n' % (name, 1.0e6 * line_time / len(lines), megabytes / line_time,
+                                                      1.0e3 * page_time / max(len(pages), 1),
+                                                      'identical' if compatible else 'DIFFERENT'))
+    out.write('In use: ' + json_codec.backend + ' (set $' + json_codec.BACKEND_ENV + ' to choose)\n')
+    return results
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark the JSON backends Ornitholog can use.')
+    parser.add_argument('--file', default=None, help='Tweet file with one JSON object per line, such as a TAJ '
+                                                     '(representative sample tweets are generated if omitted)')
+    parser.add_argument('--count', type=int, default=2000, help='Number of tweets to use')
+    parser.add_argument('--repeat', type=int, default=5, help='Runs per measurement')
+    args = parser.parse_args(argv)
+
+    if args.file is None:
+        lines = sample_lines(args.count)
+    else:
+        with open(args.file, errors='ignore') as fin:
+            lines = [line.strip() for line in fin if line.strip()][:args.count]
+    run(lines, args.repeat)
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,85 @@
+import json
+import os
+
+# orjson decodes several times faster than the standard library, but isn't required
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# Environment variable naming the backend to use, e.g. ORNITHOLOG_JSON=json to force the standard library
+BACKEND_ENV = 'ORNITHOLOG_JSON'
+
+
+def _orjson_loads(data):
+    """
+    Decode with orjson, falling back to the standard library for the few inputs orjson refuses but json accepts,
+    such as the lone surrogates left in truncated tweet text. (orjson reads integers beyond 64 bits as floats, but
+    Twitter's IDs and counts all fit.)
+    """
+    try:
+        return orjson.loads(data)
+    except orjson.JSONDecodeError:
+        return json.loads(data)
+
+# Decoders by backend name, fastest first. Encoding always goes through the standard library (see dumps).
+BACKENDS = {}
+if orjson is not None:
+    BACKENDS['orjson'] = _orjson_loads
+BACKENDS['json'] = json.loads
+
+backend = None      # Name of the backend in use
+loads = None        # Decode a str or bytes holding one JSON document, with the backend in use
+
+
+def set_backend(name=None):
+    """
+    Choose the JSON backend used to decode tweets, API responses and archive indexes in this process.
+    :param name: Key of BACKENDS, or None for the one named by $ORNITHOLOG_JSON, else the fastest installed
+    :return: Name of the backend now in use
+    """
+    global backend, loads
+    if name is None:
+        name = os.environ.get(BACKEND_ENV) or next(iter(BACKENDS))
+    if name not in BACKENDS:
+        raise ValueError('JSON backend ' + str(name) + ' is not available; choose from ' + ', '.join(BACKENDS))
+    backend = name
+    loads = BACKENDS[name]
+    return name
+
+def dumps(obj):
+    """
+    Encode a tweet as one TAJ line. Always uses the standard library with its default settings (ASCII output,
+    ', ' and ': ' separators), so archive files are byte-for-byte the same whichever backend decoded the tweet.
+    :param obj: Tweet object
+    :return: JSON string, without a newline
+    """
+    return json.dumps(obj)
+
+def load(fin):
+    """
+    Decode the JSON document in an open text file.
+    """
+    return loads(fin.read())
+
+def dump_index(obj, fout):
+    """
+    Write an archive index (ARX) in its usual layout: sorted keys, indented four spaces.
+    :param obj: ARX dictionary
+    :param fout: Open text file
+    """
+    json.dump(obj, fout, indent=4, sort_keys=True)
+
+def response_json(response):
+    """
+    Decode an API response's JSON body once, however many times it is asked for.
+    :param response: Reply from Twitter API as a rauth (requests) response object
+    :return: Decoded JSON
+    :raise ValueError: If the body isn't valid JSON
+    """
+    data = getattr(response, 'decoded_json', None)
+    if data is None:
+        data = response.decoded_json = loads(response.content)
+    return data
+
+set_backend()
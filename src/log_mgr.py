@@ -0,0 +1,172 @@
+import os, time
+import threading, atexit
+import traceback
+from collections import namedtuple
+from queue import Queue, Empty
+
+# A single log entry, built by the thread that reports it and written later by the LogWriter.
+#   log_file    Path of the log the record belongs in
+#   created     POSIX time the record was made
+#   kind        'event' for a one-line message, 'exception' for a full error report
+#   message     Short description of what happened
+#   detail      Pre-formatted traceback text (exceptions only)
+LogRecord = namedtuple('LogRecord', ['log_file', 'created', 'kind', 'message', 'detail'])
+
+
+class LogWriter(threading.Thread) :
+    """
+    Own every log file in one background thread. Other threads only put records on the queue, so collectors never
+    block on disk I/O; the writer drains the queue in batches, groups records by file and rotates any file that grows
+    past max_bytes.
+    """
+
+    def __init__(self, max_bytes=10485760, backup_count=5, batch_size=1000, flush_interval=0.5, **kwargs) :
+
+        # Superclass constructor
+        threading.Thread.__init__(self, name='LogWriter', daemon=True, **kwargs)
+
+        self.max_bytes = max_bytes              # Rotate a log once it grows past this size
+        self.backup_count = backup_count        # Keep this many rotated copies: log.1 (newest) ... log.N (oldest)
+        self.batch_size = batch_size            # Most records written per pass
+        self.flush_interval = flush_interval    # Seconds to wait for new records before checking again
+
+        self.queue = Queue()
+
+    def submit(self, record) :
+        """
+        Hand a record to the writer. Never blocks.
+        :param record: LogRecord to write
+        """
+        self.queue.put(record)
+
+    def run(self) :
+        while True :
+
+            # Wait for something to write
+            try :
+                batch = [self.queue.get(block=True, timeout=self.flush_interval)]
+            except Empty :
+                continue
+
+            # Take whatever else is already waiting, up to a full batch
+            while len(batch) < self.batch_size :
+                try :
+                    batch.append(self.queue.get_nowait())
+                except Empty :
+                    break
+
+            try :
+                self.write_batch(batch)
+            except Exception :
+                traceback.print_exc()   # Nowhere left to log it
+            finally :
+                for _ in batch : self.queue.task_done()
+
+    def flush(self) :
+        """
+        Block until every record submitted so far has been written.
+        """
+        if self.is_alive() :
+            self.queue.join()
+
+    def write_batch(self, batch) :
+        """
+        Write a batch of records, opening each log file once.
+        :param batch: List of LogRecords in the order they were submitted
+        """
+        by_file = {}
+        for record in batch :
+            by_file.setdefault(record.log_file, []).append(format_record(record))
+
+        for log_file, entries in by_file.items() :
+            try :
+                os.makedirs(os.path.dirname(log_file) or '.', exist_ok=True)
+            except (FileNotFoundError, FileExistsError) :
+                pass
+            self.rotate(log_file)
+            with open(log_file, 'a+') as fout :
+                fout.write(''.join(entries))
+
+    def rotate(self, log_file) :
+        """
+        Shift log -> log.1 -> log.2 ... if the log has grown past max_bytes. The oldest copy is discarded.
+        :param log_file: Path of the log to check
+        """
+        try :
+            if os.path.getsize(log_file) < self.max_bytes : return
+        except OSError :
+            return
+
+        if self.backup_count < 1 :
+            os.remove(log_file)
+            return
+        for idx in range(self.backup_count - 1, 0, -1) :
+            older = log_file + '.' + str(idx)
+            if os.path.exists(older) :
+                os.replace(older, log_file + '.' + str(idx + 1))
+        os.replace(log_file, log_file + '.1')
+
+
+def format_record(record) :
+    """
+    Render a record as the text that goes in its log file.
+    :param record: LogRecord
+    :return: String ending in a line break
+    """
+    stamp = time.strftime("%m-%d-%Y %H:%M:%S (UTC %z)", time.localtime(record.created))
+    if record.kind == 'exception' :
+        return (record.message + '\n' + stamp + '\n-----------\n' + (record.detail or '') + '\n\n\n')
+    return stamp + ' ' + record.message + '\n'
+
+
+# The one writer shared by every thread in the process
+_writer = None
+_writer_lock = threading.Lock()
+
+def get_writer() :
+    """
+    Get the shared LogWriter, starting it on first use.
+    :return: LogWriter
+    """
+    global _writer
+    if _writer is None :
+        with _writer_lock :
+            if _writer is None :
+                _writer = LogWriter()
+                _writer.start()
+                atexit.register(_writer.flush)
+    return _writer
+
+def log(log_file, message) :
+    """
+    Queue a one-line message for a log file.
+    :param log_file: Path of the log
+    :param message: Text to record; a timestamp is added when it is written
+    """
+    get_writer().submit(LogRecord(log_file, time.time(), 'event', message, None))
+
+def log_exception(log_file, exc, header='EXCEPTION', context=None, stack=False) :
+    """
+    Queue an error report for the exception currently being handled. The traceback is captured here, in the thread
+    that caught the exception, and written later by the LogWriter.
+    :param log_file: Path of the log
+    :param exc: The exception being reported
+    :param header: First line of the report
+    :param context: Optional extra line (such as the query or job involved)
+    :param stack: Also record the stack of the calling thread
+    """
+    message = header + ': ' + str(exc)
+    if context is not None :
+        message += '\n' + str(context)
+    detail = ''
+    if stack :
+        detail += ''.join(traceback.format_stack()[:-1]) + '\n-----------\n'
+    detail += traceback.format_exc()
+    get_writer().submit(LogRecord(log_file, time.time(), 'exception', message, detail))
+
+def flush() :
+    """
+    Block until every queued record has been written.
+    """
+    if _writer is not None :
+        _writer.flush()
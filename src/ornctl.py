@@ -0,0 +1,123 @@
+import argparse
+import json
+import os
+import socket
+import sys
+
+# The daemon runs from the Ornitholog directory, one level above src/
+DEFAULT_SOCKET = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'logs', 'ornitholog.sock')
+
+
+def send_requests(socket_path, requests) :
+    """
+    Send control requests to a running Ornitholog daemon and yield its replies in order.
+    :param socket_path: Path to the daemon's control socket
+    :param requests: Iterable of request dictionaries
+    :return: Generator over reply dictionaries
+    """
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.connect(socket_path)
+    with sock, sock.makefile('rwb') as stream :
+        for request in requests :
+            stream.write((json.dumps(request) + '\n').encode('utf-8'))
+            stream.flush()
+            reply = stream.readline()
+            if not reply :
+                raise ConnectionError('Daemon closed the connection.')
+            yield json.loads(reply.decode('utf-8'))
+
+def parse_bounds(text) :
+    """
+    Parse a 'min:max' range where either side may be left blank.
+    :return: Tuple of (min, max) as ints or None
+    """
+    if text is None : return None, None
+    bounds = (text.split(':') + [''])[:2]
+    return tuple(int(bound) if bound.strip() else None for bound in bounds)
+
+def build_request(args) :
+    """
+    Turn parsed command-line arguments into a control request.
+    """
+    request = {'cmd' : args.cmd}
+    if args.cmd in ('start', 'stop', 'status') :
+        request['job'] = args.job
+        request['all'] = args.all
+        if args.cmd == 'status' :
+            request['tasks'] = args.tasks
+            request['task'] = args.task
+    elif args.cmd == 'cancel' :
+        request['task'] = args.task
+    elif args.cmd == 'export' :
+        min_id, max_id = parse_bounds(args.index)
+        min_date, max_date = parse_bounds(args.date)
+        request.update({
+            'job' : args.job, 'outfile' : args.outfile, 'singlefile' : args.singlefile,
+            'min_id' : min_id, 'max_id' : max_id, 'min_date' : min_date, 'max_date' : max_date,
+            'undirected' : args.U, 'multigraph' : args.M,
+            'mentions' : args.m, 'retweets' : args.t, 'quotes' : args.q,
+            'processes' : args.processes if args.processes > 0 else None,
+        })
+        if args.window is not None :
+            window, step = parse_bounds(args.window)
+            request.update({'window' : window, 'step' : step, 'dynamic' : args.dynamic})
+        if args.r : request['replies'] = True
+        # Tweet filters go by the terminal's flag names; 'mentions' there names users, not the interaction kind
+        filters = {name : value for name, value in (
+            ('from', args.from_users), ('mentions', args.mentions), ('hashtag', args.hashtag),
+            ('lang', args.lang), ('text', args.text)) if value is not None}
+        for name in ('isreply', 'isretweet', 'notretweet') :
+            if getattr(args, name) : filters[name] = True
+        if filters : request['filter'] = filters
+    return request
+
+def main(argv=None) :
+    parser = argparse.ArgumentParser(description='Send commands to an Ornitholog daemon (ornitholog.py --daemon).')
+    parser.add_argument('--socket', default=DEFAULT_SOCKET, help='Path to the daemon control socket')
+    sub = parser.add_subparsers(dest='cmd')
+    sub.required = True
+    for name in ('start', 'stop', 'status') :
+        cmd = sub.add_parser(name)
+        cmd.add_argument('job', nargs='?', default=None)
+        cmd.add_argument('--all', action='store_true')
+        if name == 'status' :
+            cmd.add_argument('--tasks', action='store_true', help='Report on background tasks')
+            cmd.add_argument('--task', default=None, help='Report on one background task')
+    export = sub.add_parser('export', help='Export a user interaction graph, as exportgraph does in the terminal')
+    export.add_argument('job')
+    export.add_argument('outfile', nargs='?', default=None)
+    export.add_argument('--singlefile', action='store_true')
+    export.add_argument('--index', default=None, help='min:max tweet ID')
+    export.add_argument('--date', default=None, help='min:max POSIX time')
+    export.add_argument('--window', default=None, help='len:step sliding windows, in seconds')
+    export.add_argument('--dynamic', action='store_true', help='With --window, write one dynamic GEXF')
+    export.add_argument('--processes', type=int, default=1, help='Worker processes (0 for one per CPU)')
+    for flag in 'UMrmtq' :
+        export.add_argument('-' + flag, action='store_true')
+    export.add_argument('--from', dest='from_users', default=None, help='Only tweets by these user IDs (id,id)')
+    export.add_argument('--mentions', default=None, help='Only tweets mentioning these user IDs (id,id)')
+    export.add_argument('--hashtag', default=None, help='Only tweets with one of these hashtags (tag,tag)')
+    export.add_argument('--lang', default=None, help='Only tweets in one of these languages (code,code)')
+    export.add_argument('--isreply', action='store_true', help='Only replies')
+    export.add_argument('--isretweet', action='store_true', help='Only retweets')
+    export.add_argument('--notretweet', action='store_true', help='No retweets')
+    export.add_argument('--text', default=None, help='Only tweets whose text contains these words')
+    cancel = sub.add_parser('cancel', help='Cancel a background task')
+    cancel.add_argument('task')
+    sub.add_parser('shutdown')
+    sub.add_parser('pipe', help='Send JSON requests read one-per-line from stdin')
+    args = parser.parse_args(argv)
+    
+    if args.cmd == 'pipe' :
+        requests = (json.loads(line) for line in sys.stdin if line.strip())
+    else :
+        requests = [build_request(args)]
+    
+    ok = True
+    for reply in send_requests(args.socket, requests) :
+        print(json.dumps(reply))
+        ok = ok and reply.get('ok', False)
+    return 0 if ok else 1
+
+if __name__ == '__main__' :
+    sys.exit(main())
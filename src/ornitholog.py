@@ -1,9 +1,23 @@
-from cmd_interface import Commander
+import argparse
 
 if __name__ == '__main__' :
     import os
+    parser = argparse.ArgumentParser(description='Ornitholog data acquisition tool for Twitter.')
+    parser.add_argument('--daemon', action='store_true',
+                        help='Run without a terminal, taking commands over a Unix domain socket (see ornctl.py)')
+    parser.add_argument('--socket', default=None,
+                        help='Control socket path for --daemon, relative to the Ornitholog directory')
+    args = parser.parse_args()
+    
     os.chdir('..')
-    comthread = Commander()
-    print('Starting terminal...')
-    comthread.start()
-    print('Terminal interface started.\n')
\ No newline at end of file
+    if args.daemon :
+        from control_daemon import Daemon, DEFAULT_SOCKET
+        daemon = Daemon(args.socket or DEFAULT_SOCKET)
+        print('Ornitholog daemon listening on', daemon.socket_path)
+        daemon.serve_forever()
+    else :
+        from cmd_interface import Commander
+        comthread = Commander()
+        print('Starting terminal...')
+        comthread.start()
+        print('Terminal interface started.\n')
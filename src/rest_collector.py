@@ -1,10 +1,11 @@
-import traceback
 import requests
 import twitter_api_interface
 import tweet_parser
 import arx_mgr
+import log_mgr
 import time
-import json
+import json_codec
+from backoff_mgr import BreakerRegistry
 
 
 
@@ -12,60 +13,59 @@ class RatelimitError(requests.exceptions.HTTPError) :
     """Twitter wants us to chill out and wait a little while before trying to reconnect."""
 
 
-# Error handling for our REST API connection
-def reset_errors(state) :
-    state['tcp_err_ctr'] = 0
-    state['http_err_ctr'] = 0
-    state['http_eyc_ctr'] = 0
-    state['other_errors'] = 0
+ERROR_LOG = 'logs/topic_tracking_errors.log'
+SEARCH_ENDPOINT = 'search/tweets'
+# Most tweets one search query returns (see twitter_api_interface.searchQuery)
+PAGE_SIZE = 100
 
-def signal_TCP_err(state) :
-    state['tcp_err_ctr'] += 1
-    err_count = min([state['tcp_err_ctr'], 64])
-    with open(state['error_log'], 'a+') as error_log :
-        error_log.write('REST TIME: ' + str((0.25 * err_count)) + ' seconds for TCP.\n')
-    time.sleep(0.25 * err_count)
+# Breakers for callers that don't share a registry of their own (the Dispatcher does)
+_default_breakers = BreakerRegistry()
 
-def signal_HTTP_err(state) :
-    state['http_err_ctr'] += 1
-    err_count = min([state['http_err_ctr'], 7])
-    with open(state['error_log'], 'a+') as error_log :
-        error_log.write('REST TIME: ' + str((5.0 * 2 ** (err_count - 1))) + ' seconds for HTTP.\n')
-    time.sleep(5.0 * 2 ** (err_count - 1))
 
-def signal_ratelimit_err(state) :
-    state['http_eyc_ctr'] += 1
-    with open(state['error_log'], 'a+') as error_log :
-        error_log.write('REST TIME: ' + str((60.0 * 2 ** (state['http_eyc_ctr'] - 1))) + ' seconds for ratelimit.\n')
-    time.sleep(60.0 * 2 ** (state['http_eyc_ctr'] - 1))
+# Error handling for our REST API connection. Each failure opens the credential's breaker for a while; nothing here
+# sleeps, the job waits out the cooldown between cycles instead.
+def signal_TCP_err(breaker) :
+    delay = breaker.failure('tcp')
+    log_mgr.log(ERROR_LOG, 'REST TIME: ' + str(round(delay, 2)) + ' seconds for TCP.')
 
-def signal_other_error(state) :
-    state['other_errors'] += 1
-    err_count = min([state['tcp_err_ctr'], 10])
-    with open(state['error_logs'], 'a+') as error_log :
-        error_log.write('REST TIME: ' + str((5.0 * err_count)) + ' seconds for unexpected error.\n')
-    time.sleep((5.0 * err_count))
+def signal_HTTP_err(breaker) :
+    delay = breaker.failure('http')
+    log_mgr.log(ERROR_LOG, 'REST TIME: ' + str(round(delay, 2)) + ' seconds for HTTP.')
 
-def log_error(state, exc) :
-    with open(state['error_log'], 'a+') as error_log :
-        error_log.write('EXCEPTION: ' + str(exc) + '\n')
-        error_log.write(time.strftime("%m-%d-%Y %H:%M:%S (UTC %z)"))
-        error_log.write('\n-----------\n')
-        traceback.print_exc(file=error_log)
-        error_log.write('\n\n\n')
+def signal_ratelimit_err(breaker) :
+    delay = breaker.failure('ratelimit')
+    log_mgr.log(ERROR_LOG, 'REST TIME: ' + str(round(delay, 2)) + ' seconds for ratelimit.')
+
+def signal_other_error(breaker) :
+    delay = breaker.failure('other')
+    log_mgr.log(ERROR_LOG, 'REST TIME: ' + str(round(delay, 2)) + ' seconds for unexpected error.')
+
+def log_error(exc) :
+    log_mgr.log_exception(ERROR_LOG, exc)
+
+def wait_time(job, breakers=None) :
+    """
+    Get how long a job should wait before its next collection cycle, either to keep its query spacing or because
+    its credential is cooling down after failures.
+    :param job: The job defining your collection parameters
+    :param breakers: The BreakerRegistry passed to collect()
+    :return: Seconds to wait (0.0 if the job may collect now)
+    """
+    if breakers is None: breakers = _default_breakers
+    spacing = job.get('next_cycle', 0.0) - time.time()
+    return max(0.0, spacing, breakers.get(job, SEARCH_ENDPOINT).wait_time())
 
 # Open a REST API connection, get some data
-def collect(job,sample_evenness=float('inf'),verbose=False) :
+def collect(job,sample_evenness=float('inf'),verbose=False,allocator=None,breakers=None) :
+    
+    # Failure counts live in the credential's breaker, so backoff keeps escalating across cycles and is shared with
+    # every job on the same credential
+    if breakers is None: breakers = _default_breakers
+    breaker = breakers.get(job, SEARCH_ENDPOINT)
     
-    # Start with no errors
-    state = {
-        'tcp_err_ctr' : 0,
-        'http_err_ctr' : 0,
-        'http_eyc_err' : 0,
-        'other_errors' : 0,
-        'error_log' : 'logs/topic_tracking_errors.log'
-    }
-    connection_has_succeeded = False
+    # Still cooling down from an earlier failure; try again later
+    if breaker.wait_time() > 0.0:
+        return
     
     ############################
     # Exception Handling Block #
@@ -79,48 +79,47 @@ def collect(job,sample_evenness=float('inf'),verbose=False) :
         # REST Collection Block #
         #########################
         
-        ctr = 0
-        while True :
-            if verbose: print(job['name'],'collecting chunk',str(ctr))
-            collectTweetBatch(job, sample_evenness,verbose=verbose)
-            job['chunks_collected'] += 1
-            reset_errors(state)
-            break
+        if verbose: print(job['name'],'collecting chunk',str(job['chunks_collected']))
+        collectTweetBatch(job, sample_evenness,verbose=verbose,allocator=allocator)
+        job['chunks_collected'] += 1
+        breaker.success()
             
-        # Catch & wait on HTTP/network errors
+        # Catch & back off on HTTP/network errors
     # We've been trying to collect data from Twitter's servers too quickly
     except RatelimitError :
-        signal_ratelimit_err(state)
+        signal_ratelimit_err(breaker)
         return
     # Trouble communicating with the API
     except requests.exceptions.HTTPError as exc :  # HTTP Errors
-        log_error(state, exc)
-        if connection_has_succeeded :  # Speed bump errors
-            signal_HTTP_err(state)  # Wait before continuing
+        log_error(exc)
+        if breaker.has_succeeded :  # Speed bump errors
+            signal_HTTP_err(breaker)  # Wait before continuing
             return
         else :
             raise
     # Trouble with our connection to Twitter's servers
-    except ConnectionError :
-        signal_TCP_err(state)
+    except (ConnectionError, requests.exceptions.ConnectionError) :
+        signal_TCP_err(breaker)
         return
     # Unexpected error
     except Exception as exc :  # Catch & log unexpected errors
         if verbose: print('Unhandled exception in REST API connection block!')
-        log_error(state, exc)
-        if connection_has_succeeded :
-            signal_other_error(state)
+        log_error(exc)
+        if breaker.has_succeeded :
+            signal_other_error(breaker)
             return
         else :
             raise
 
-def collectTweetBatch(job, sample_evenness=450.0, verbose=False):
+def collectTweetBatch(job, sample_evenness=450.0, verbose=False, allocator=None):
     """
     Collect an even sampling of tweets, up to all available Tweets in your rate-limiting period.
     :param job: The job defining your collection parameters
     :param sample_evenness: Increase for shorter collection intervals on each topic. (Warning: If set too high, this
     may cause you to undershoot your rate-limit because there is a small time-overhead in changing query topics.)
     :param verbose: Print status messages to console
+    :param allocator: Optional budget_mgr.BudgetAllocator sharing the credential's rate-limit among jobs by tweet
+    velocity. Without one, this job assumes it has the whole rate-limit to itself.
     :return:
     """
     
@@ -158,6 +157,7 @@ def collectTweetBatch(job, sample_evenness=450.0, verbose=False):
     try:
         #DONE_READING, RATE_LIMITED = api.archiveSearch(ARX, MAX_QUERIES, wait_on_rate_limit=True,
         #                                               auto_exhaust=True, lang=lang)
+        new_tweets = 0; saturated = False; answered = False
         for idx in range(NUM_QUERIES) :
             reply, RATE_LIMITED = twitter_api_interface.searchQuerySafe(
                 session,
@@ -166,7 +166,11 @@ def collectTweetBatch(job, sample_evenness=450.0, verbose=False):
                 arx_mgr.get_append_bounds(job),
                 job['app_auth']
             )
-            tweets = [json.dumps(tweet) for tweet in reversed(tweet_parser.getTweets(reply))]
+            tweets = [json_codec.dumps(tweet) for tweet in reversed(tweet_parser.getTweets(reply))]
+            if reply is not None:
+                answered = True
+                new_tweets += len(tweets)
+                saturated = len(tweets) >= PAGE_SIZE
             if len(tweets) == 0:
                 if verbose: print('Received zero tweets! Received HTTP',reply)
             else:
@@ -174,6 +178,8 @@ def collectTweetBatch(job, sample_evenness=450.0, verbose=False):
             if RATE_LIMITED :
                 if verbose: print('Warning! Rate limit reached. Verify that you aren\'t collecting too quickly.')
                 break
+        # The allocator sees one observation per cycle, so its rates don't depend on how many queries a cycle makes
+        if allocator is not None and answered: allocator.observe(job, new_tweets, saturated)
     except:
         if verbose: print('Exception during archive search!')
         raise
@@ -185,11 +191,17 @@ def collectTweetBatch(job, sample_evenness=450.0, verbose=False):
         if verbose: print('Error disconnecting from Twitter API!')
         job['session'] = None
     
-    # Preserve even query spacing; don't exceed rate-limit
+    # Preserve even query spacing; don't exceed rate-limit. The job waits this out between cycles (see wait_time).
+    if allocator is not None:
+        time_alloc = allocator.cycle_time(job, NUM_QUERIES, MAX_QUERIES)
     qfin = time.time()
     if verbose: print('End time: ' + str(qfin))
+    job['next_cycle'] = qstart + time_alloc
     t_interval = qfin - qstart
     if t_interval < time_alloc :
         if verbose: print('Finished early. Resting for ' + str(time_alloc - t_interval) + ' seconds.')
-        time.sleep(time_alloc - t_interval)
+    
+    # Let collect() open the credential's breaker so every job using it backs off together
+    if RATE_LIMITED :
+        raise RatelimitError('Rate limit reached for ' + job['name'])
         
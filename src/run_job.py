@@ -2,6 +2,7 @@ import rest_collector
 from arx_mgr import load_arx
 from twitter_api_interface import oauth2
 import json
+import time
 
 from enum import Enum
 class Job(Enum) :
@@ -101,6 +102,20 @@ def collection_job(job_id, dispatcher,verbose=False):
                 concurrently once per-application, whereas regular auth can be
                 used once per-user per-app concurrently.
                 
+    edge_store  Keep interaction counts for each finished TAJ in <path>/edges/ so
+                graph exports only parse new tweets (see edge_store.py).
+                (default: false)
+    
+    tag_index   Index the hashtags, authors and mentioned users of each finished TAJ
+                in <path>/tags/ so findtweets only reads matching tweets (see
+                tag_index.py).
+                (default: false)
+    
+    text_index  Index the words of the tweet text in each finished TAJ in <path>/text/
+                so searchtext can answer queries without reading tweets (see
+                text_index.py).
+                (default: false)
+    
     streaming_api   Use the streaming API to collect data. This has the potential
                     to collect a great amount of data (1% volume of all Twitter),
                     but only one stream can be active at once PER USER ACCOUNT. If
@@ -133,10 +148,17 @@ def collection_job(job_id, dispatcher,verbose=False):
         # Continue collecting data
         if job_state == Job.RUNNING:
             
+            # Wait out query spacing or a credential cooldown in short steps, so a stop request is seen promptly
+            wait = rest_collector.wait_time(job, dispatcher.breakers)
+            if wait > 0.0:
+                time.sleep(min(wait, 0.5))
+                continue
+            
             # Do your regular collecting and storing thing
             try :
-                rest_collector.collect(job,verbose=verbose)
+                rest_collector.collect(job,verbose=verbose,allocator=dispatcher.budget,breakers=dispatcher.breakers)
             except:
+                dispatcher.budget.unregister(job_id)
                 dispatcher.setJobStatus(job_id,Job.ERROR)
                 return 1
             
@@ -155,6 +177,9 @@ def collection_job(job_id, dispatcher,verbose=False):
             # Unpack your auth keys from file
             load_secrets(job)
             
+            # Share your credential's rate-limit with any other jobs using it
+            dispatcher.budget.register(job)
+            
             # You have successfully started
             dispatcher.setJobStatus(job_id,Job.RUNNING)
         
@@ -162,6 +187,7 @@ def collection_job(job_id, dispatcher,verbose=False):
         elif job_state == Job.STOPPING:
             
             # You have successfully stopped
+            dispatcher.budget.unregister(job_id)
             dispatcher.setJobStatus(job_id,Job.STOPPED)
             print(job_id,'has stopped.')
             return 0
@@ -169,6 +195,7 @@ def collection_job(job_id, dispatcher,verbose=False):
         elif job_state == Job.COMPLETED:
             
             # You finished your work. Usually not applicable.
+            dispatcher.budget.unregister(job_id)
             dispatcher.setJobStatus(job_id,Job.COMPLETED)
             return 0
         
\ No newline at end of file
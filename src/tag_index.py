@@ -0,0 +1,334 @@
+import os
+import time
+import json_codec
+import tweet_parser
+import tweet_store
+import user_dict
+from arx_mgr import iter_tweetfile, load_arx, scan_segments, scan_tweets
+from tweet_parser import get_extractor, normalize_hashtag
+
+FORMAT_VERSION = 1
+
+INDEX_DIR = 'tags'
+
+# Kinds of term the index maps to tweets
+KINDS = ('hashtags', 'authors', 'mentions')
+
+# Tweet fields the index is built from
+FIELDS = ('user_id', 'hashtags', 'user_mentions')
+
+
+def encode_postings(offsets):
+    """
+    Compress a posting list as the gaps between its entries, each written as a base-128 varint.
+    :param offsets: Increasing non-negative integers
+    :return: bytes
+    """
+    out = bytearray()
+    last = 0
+    for offset in offsets:
+        gap = offset - last
+        last = offset
+        while gap >= 0x80:
+            out.append((gap & 0x7F) | 0x80)
+            gap >>= 7
+        out.append(gap)
+    return bytes(out)
+
+def decode_postings(data):
+    """
+    Expand a posting list written by encode_postings.
+    :param data: bytes
+    :return: List of the increasing integers
+    """
+    offsets = []
+    last = 0; value = 0; shift = 0
+    for byte in data:
+        value |= (byte & 0x7F) << shift
+        if byte & 0x80:
+            shift += 7
+        else:
+            last += value
+            offsets.append(last)
+            value = 0; shift = 0
+    return offsets
+
+def index_path(job, taj_name):
+    """
+    :param job: Job dictionary with a path to an archive
+    :param taj_name: Filename of the TAJ (no directory)
+    :return: Path of the TAJ's tag index file
+    """
+    return os.path.join(job['path'], INDEX_DIR, taj_name + '.tix')
+
+def index_segment(taj_file):
+    """
+    Find the line of every tweet in a TAJ file carrying each hashtag, written by each author and mentioning each user.
+    :param taj_file: Path to the TAJ file
+    :return: Tuple of a dictionary mapping each of KINDS to {term : [byte offsets of the tweets' lines]}, and the
+    number of tweets read. Hashtags are normalized (see tweet_parser.normalize_hashtag); user IDs are keyed as strings.
+    """
+    postings = {kind : {} for kind in KINDS}
+    hashtags, authors, mentions = (postings[kind] for kind in KINDS)
+    extract = get_extractor(*FIELDS).extract
+    resolve = tweet_store.Resolver(taj_file)
+    num_tweets = 0
+    with open(taj_file, 'rb') as fin:
+        offset = 0
+        for line in fin:
+            start = offset
+            offset += len(line)
+            line = resolve(line.decode('utf-8', 'ignore').strip())
+            if not line: continue
+            try:
+                record = extract(json_codec.loads(line))
+            except ValueError:
+                continue
+            num_tweets += 1
+            if record.user_id is not None:
+                authors.setdefault(str(record.user_id), []).append(start)
+            for hashtag in set(map(normalize_hashtag, record.hashtags)):
+                hashtags.setdefault(hashtag, []).append(start)
+            for user_id in record.user_mentions:
+                mentions.setdefault(str(user_id), []).append(start)
+    return postings, num_tweets
+
+def update_segment(job, entry):
+    """
+    Rebuild the tag index file for one TAJ. Called when a segment is finalized, since the newest finished TAJ can
+    still grow.
+
+    The file starts with one line of JSON holding the TAJ's size and modification time and, for each kind of term,
+    a dictionary of term -> [start, length, number of tweets] locating its posting list. The compressed posting lists
+    (see encode_postings) follow back to back, so a query reads only the header and the lists it needs.
+    :param job: Job dictionary with a path to an archive
+    :param entry: The TAJ's ARX entry
+    """
+    taj_name = os.path.basename(str(entry[0]))
+    taj_file = os.path.join(job['path'], taj_name)
+    postings, num_tweets = index_segment(taj_file)
+    stat = os.stat(taj_file)
+    header = {'version' : FORMAT_VERSION, 'taj' : taj_name, 'size' : stat.st_size, 'mtime' : stat.st_mtime,
+              'num_tweets' : num_tweets}
+    blobs = []
+    position = 0
+    for kind in KINDS:
+        terms = header[kind] = {}
+        for term, offsets in postings[kind].items():
+            blob = encode_postings(offsets)
+            terms[term] = [position, len(blob), len(offsets)]
+            blobs.append(blob)
+            position += len(blob)
+
+    # Write to a temporary file first so a reader never sees a partial index
+    path = index_path(job, taj_name)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path + '.tmp', 'wb') as fout:
+        fout.write(json_codec.dumps(header).encode('utf-8') + b'\n')
+        for blob in blobs:
+            fout.write(blob)
+    os.replace(path + '.tmp', path)
+
+
+class SegmentIndex:
+    """
+    Tag index of one finished TAJ, opened for queries. Only the header is read up front; posting lists are read from
+    the file as they're looked up.
+    """
+
+    def __init__(self, path, header, start):
+        """
+        :param path: Path of the index file
+        :param header: Decoded header line
+        :param start: Byte offset where the posting lists begin
+        """
+        self.path = path
+        self.header = header
+        self.start = start
+
+    def terms(self, kind):
+        """
+        :param kind: One of KINDS
+        :return: Dictionary of the segment's terms of that kind -> number of tweets with each
+        """
+        return {term : location[2] for term, location in self.header[kind].items()}
+
+    def lookup(self, kind, terms):
+        """
+        Find the tweets matching any of the terms.
+        :param kind: One of KINDS
+        :param terms: Normalized terms (hashtags, or user IDs as strings)
+        :return: Set of byte offsets of the matching tweets' lines in the TAJ
+        """
+        found = set()
+        locations = [self.header[kind][term] for term in terms if term in self.header[kind]]
+        if not locations:
+            return found
+        with open(self.path, 'rb') as fin:
+            for position, length, _ in sorted(locations):
+                fin.seek(self.start + position)
+                found.update(decode_postings(fin.read(length)))
+        return found
+
+
+def load_segment(job, entry):
+    """
+    Open the tag index for a TAJ, if it exists and still matches the file on disk.
+    :param job: Job dictionary with a path to an archive
+    :param entry: The TAJ's ARX entry
+    :return: SegmentIndex, or None if there is no up-to-date index
+    """
+    taj_name = os.path.basename(str(entry[0]))
+    path = index_path(job, taj_name)
+    try:
+        with open(path, 'rb') as fin:
+            header = json_codec.loads(fin.readline())
+            start = fin.tell()
+        stat = os.stat(os.path.join(job['path'], taj_name))
+    except (OSError, ValueError):
+        return None
+    if header.get('version') != FORMAT_VERSION or header.get('size') != stat.st_size or \
+            header.get('mtime') != stat.st_mtime:
+        return None
+    return SegmentIndex(path, header, start)
+
+def build_index(job, task=None):
+    """
+    Build or refresh the tag index for every finished TAJ in an archive, such as one collected before the index was
+    enabled.
+    :param job: Job dictionary with a path to an archive
+    :param task: Optional task_mgr.Task to report progress to and check for cancellation
+    :return: Number of segments (re)built
+    """
+    arx = load_arx(job)
+    finished = arx['finished'] or []
+    if task is not None: task.expect(len(finished), sum(entry[5] for entry in finished))
+    built = 0
+    for entry in finished:
+        if load_segment(job, entry) is None:
+            update_segment(job, entry)
+            built += 1
+        if task is not None:
+            task.tweets_scanned += entry[5]
+            task.segment_done(entry)
+    return built
+
+def make_query(hashtags=None, authors=None, mentions=None):
+    """
+    Normalize the terms of a query.
+    :param hashtags: Hashtags, with or without #
+    :param authors: User IDs of authors
+    :param mentions: User IDs of mentioned users
+    :return: Dictionary of kind -> set of index terms, for each kind of term given
+    """
+    query = {}
+    if hashtags: query['hashtags'] = set(map(normalize_hashtag, hashtags))
+    if authors: query['authors'] = set(str(int(user_id)) for user_id in authors)
+    if mentions: query['mentions'] = set(str(int(user_id)) for user_id in mentions)
+    return query
+
+def matches(tweet, query):
+    """
+    Check a tweet against a query from make_query, without an index.
+    :return: True if the tweet matches every kind of term in the query
+    """
+    if 'hashtags' in query and query['hashtags'].isdisjoint(map(normalize_hashtag,
+                                                                  tweet_parser.getHashtags(tweet))):
+        return False
+    if 'authors' in query and str(tweet_parser.getUserID(tweet)) not in query['authors']:
+        return False
+    if 'mentions' in query and query['mentions'].isdisjoint(map(str, tweet_parser.getUserMentions(tweet))):
+        return False
+    return True
+
+def read_lines(taj_file, offsets, min_id=None, max_id=None, min_date=None, max_date=None, lazy=False):
+    """
+    Read the tweets on the lines starting at the given offsets of a TAJ, in the order given.
+    :param taj_file: Path to the TAJ file
+    :param offsets: Byte offsets of lines in the file
+    :param lazy: Yield tweet_parser.LazyTweet records instead of dicts
+    :return: Generator over the tweets within the bounds (see arx_mgr.iter_tweetfile)
+    """
+    if min_id is None: min_id = -1
+    if max_id is None: max_id = float('inf')
+    if min_date is None: min_date = -1
+    if max_date is None: max_date = float('inf')
+
+    resolve = tweet_store.Resolver(taj_file)
+    rehydrate = user_dict.Rehydrator(taj_file)
+    with open(taj_file, 'rb') as fin:
+        for offset in offsets:
+            fin.seek(offset)
+            line = rehydrate(resolve(fin.readline().decode('utf-8', 'ignore').strip()))
+            try:
+                # Lazy tweets aren't decoded in full here, so at least skip lines cut short (see arx_mgr.iter_tweetfile)
+                if lazy and not line.endswith('}'): continue
+                tweet = tweet_parser.LazyTweet(line) if lazy else json_codec.loads(line)
+                in_bounds = (min_id <= tweet_parser.getTweetID(tweet) <= max_id) and \
+                        (min_date <= time.mktime(tweet_parser.getTimeStamp(tweet).timetuple()) <= max_date)
+            except:
+                continue
+            if in_bounds:
+                yield tweet
+
+def find_tweets(job, hashtags=None, authors=None, mentions=None, min_id=None, max_id=None, min_date=None,
+                max_date=None, reverse=False, lazy=False, on_segment=None):
+    """
+    Find the tweets in an archive that carry one of the hashtags, AND were written by one of the authors, AND mention
+    one of the users (leave any of these out to not filter on it). Segments with an up-to-date tag index only have
+    their matching tweets read; the rest, such as the unfinished TAJ, are scanned.
+    :param job: Same as for arx_mgr.scan_tweets
+    :param hashtags: Hashtags to look for (case and a leading # don't matter)
+    :param authors: User IDs of authors to look for
+    :param mentions: User IDs of mentioned users to look for
+    :param reverse: Read segments new-to-old instead of old-to-new
+    :param lazy: Yield tweet_parser.LazyTweet records instead of dicts
+    :param on_segment: Optional callback, called with each ARX entry (or the file) once its tweets have been read
+    :return: Generator over the matching tweets, in the same order scan_tweets would give them
+    """
+    query = make_query(hashtags, authors, mentions)
+    if type(job) is not dict:
+        for tweet in scan_tweets(job, min_id, max_id, min_date, max_date, reverse, on_segment, lazy):
+            if matches(tweet, query): yield tweet
+        return
+
+    # Skip segments whose ARX summary rules out every match
+    for entry in scan_segments(job, min_id, max_id, min_date, max_date, reverse, None, authors or None,
+                               mentions or None, hashtags or None):
+        index = load_segment(job, entry) if query else None
+        if index is None:
+            for tweet in iter_tweetfile(entry[0], min_id, max_id, min_date, max_date, reverse, lazy):
+                if matches(tweet, query): yield tweet
+        else:
+            offsets = None
+            for kind, terms in query.items():
+                found = index.lookup(kind, terms)
+                offsets = found if offsets is None else offsets & found
+                if not offsets: break
+            for tweet in read_lines(entry[0], sorted(offsets, reverse=reverse), min_id, max_id, min_date, max_date,
+                                    lazy):
+                yield tweet
+        if on_segment is not None: on_segment(entry)
+
+def export_tweets(job, outfile, hashtags=None, authors=None, mentions=None, min_id=None, max_id=None, min_date=None,
+                  max_date=None, task=None):
+    """
+    Write the tweets find_tweets finds to a file, one JSON object per line.
+    :param outfile: Path of the file to write
+    :param task: Optional task_mgr.Task to report progress to and check for cancellation
+    :return: Number of tweets written
+    """
+    on_segment = None
+    if task is not None and type(job) is dict:
+        task.expect(len(scan_segments(job, min_id, max_id, min_date, max_date)), None)
+        on_segment = task.segment_done
+    tweets = find_tweets(job, hashtags, authors, mentions, min_id, max_id, min_date, max_date, on_segment=on_segment)
+    if task is not None: tweets = task.track(tweets)
+
+    num_tweets = 0
+    os.makedirs(os.path.dirname(outfile) or '.', exist_ok=True)
+    with open(outfile, 'w') as fout:
+        for tweet in tweets:
+            fout.write(json_codec.dumps(tweet) + '\n')
+            num_tweets += 1
+    return num_tweets
@@ -0,0 +1,199 @@
+import time, threading
+import itertools
+import concurrent.futures as con
+import log_mgr
+
+from enum import Enum
+class TaskState(Enum) :
+    """
+    Enumeration defining possible states for a background task.
+    """
+    QUEUED = 0      # Waiting for a free worker
+    RUNNING = 1     # Doing work
+    CANCELLING = 2  # Told to stop, but hasn't reached a stopping point yet
+    CANCELLED = 3   # Stopped before finishing
+    COMPLETED = 4   # Finished its work
+    ERROR = 5       # Stopped because of an exception
+
+
+class TaskCancelled(Exception) :
+    """The task was cancelled by the user."""
+
+
+class Task :
+    """
+    A heavy analysis command (such as a graph export) running in the background. The work function reports progress
+    through the task and checks in regularly so it can be cancelled.
+    """
+
+    def __init__(self, task_id, name) :
+        self.task_id = task_id
+        self.name = name
+        self.state = TaskState.QUEUED
+        self.error = None
+        self.result = None
+        self.submitted = time.time()
+        self.started = None
+        self.finished = None
+
+        # Progress counters
+        self.tweets_scanned = 0
+        self.tweets_total = None
+        self.segments_done = 0
+        self.segments_total = None
+
+        self._cancel = threading.Event()
+
+    def cancel(self) :
+        """
+        Ask the task to stop at its next check-in.
+        :return: True if the task was still queued or running
+        """
+        if self.state in [TaskState.QUEUED, TaskState.RUNNING] :
+            self._cancel.set()
+            self.state = TaskState.CANCELLING
+            return True
+        return False
+
+    def check(self) :
+        """
+        Raise TaskCancelled if the task has been told to stop. Work functions should call this often.
+        """
+        if self._cancel.is_set() :
+            raise TaskCancelled(self.name)
+
+    def expect(self, segments=None, tweets=None) :
+        """
+        Record how much work the task expects to do, for progress reporting.
+        :param segments: Number of TAJ files to be read
+        :param tweets: Number of tweets to be read, if known
+        """
+        self.segments_total = segments
+        self.tweets_total = tweets
+
+    def segment_done(self, segment=None) :
+        """
+        Callback for arx_mgr.scan_tweets(on_segment=...)
+        """
+        self.segments_done += 1
+        self.check()
+
+    def track(self, tweetgen, check_every=1000) :
+        """
+        Wrap a tweet generator to count tweets as they're read and stop if the task is cancelled.
+        :param tweetgen: Iterator over tweets
+        :param check_every: Check for cancellation after this many tweets
+        :return: Generator over the same tweets
+        """
+        for tweet in tweetgen :
+            self.tweets_scanned += 1
+            if self.tweets_scanned % check_every == 0 : self.check()
+            yield tweet
+
+    def eta(self) :
+        """
+        Estimate the seconds remaining from the scan rate so far.
+        :return: Seconds remaining, or None if it can't be estimated yet
+        """
+        if self.state != TaskState.RUNNING or self.started is None : return None
+        elapsed = time.time() - self.started
+        if self.tweets_total and self.tweets_scanned > 0 :
+            done = min(1.0, float(self.tweets_scanned) / self.tweets_total)
+        elif self.segments_total and self.segments_done > 0 :
+            done = min(1.0, float(self.segments_done) / self.segments_total)
+        else :
+            return None
+        return elapsed * (1.0 - done) / done
+
+    def describe(self) :
+        """
+        Summarise the task's progress.
+        :return: Dictionary of plain values, safe to print or serialise as JSON
+        """
+        eta = self.eta()
+        return {
+            'id' : self.task_id,
+            'name' : self.name,
+            'state' : self.state.name,
+            'tweets_scanned' : self.tweets_scanned,
+            'tweets_total' : self.tweets_total,
+            'segments_done' : self.segments_done,
+            'segments_total' : self.segments_total,
+            'eta' : None if eta is None else round(eta, 1),
+            'error' : None if self.error is None else str(self.error),
+        }
+
+
+class TaskManager :
+    """
+    Run heavy analysis commands in their own small thread pool, separate from the Dispatcher's collection threads, so
+    they neither block the terminal nor crowd out collection.
+    """
+
+    def __init__(self, max_workers=1) :
+        self.log_file = 'logs/task_errors.log'
+        self.ex = con.ThreadPoolExecutor(max_workers=max_workers)
+        self.lock = threading.Lock()
+        self.tasks = {}     # ALWAYS LOCK WHILE USING THIS DICT
+        self.ids = itertools.count(1)
+
+    def submit(self, name, func, *args, **kwargs) :
+        """
+        Queue a work function. It is called as func(*args, task=<Task>, **kwargs).
+        :param name: Short description shown in status reports
+        :return: The Task tracking this work
+        """
+        with self.lock :
+            task = Task(str(next(self.ids)), name)
+            self.tasks[task.task_id] = task
+        self.ex.submit(self._run, task, func, args, kwargs)
+        return task
+
+    def _run(self, task, func, args, kwargs) :
+        if task._cancel.is_set() :
+            task.state = TaskState.CANCELLED
+            task.finished = time.time()
+            return
+        task.state = TaskState.RUNNING
+        task.started = time.time()
+        try :
+            task.result = func(*args, task=task, **kwargs)
+            task.state = TaskState.COMPLETED
+        except TaskCancelled :
+            task.state = TaskState.CANCELLED
+        except Exception as exc :
+            task.error = exc
+            task.state = TaskState.ERROR
+            log_mgr.log_exception(self.log_file, exc, header='TASK ERROR', context='TASK: ' + task.name)
+        finally :
+            task.finished = time.time()
+
+    def getTask(self, task_id) :
+        """
+        :return: The Task with this ID, or None
+        """
+        with self.lock :
+            return self.tasks.get(str(task_id))
+
+    def getTasks(self) :
+        """
+        :return: List of all tasks submitted, oldest first
+        """
+        with self.lock :
+            return list(self.tasks.values())
+
+    def cancel(self, task_id) :
+        """
+        Cancel a queued or running task.
+        :return: True if the task was told to stop
+        """
+        task = self.getTask(task_id)
+        return task is not None and task.cancel()
+
+    def shutdown(self, wait=True) :
+        """
+        Cancel everything and stop the worker threads.
+        """
+        for task in self.getTasks() :
+            task.cancel()
+        self.ex.shutdown(wait=wait)
@@ -0,0 +1,212 @@
+import os, time
+import math
+from xml.sax.saxutils import quoteattr
+from arx_mgr import scan_tweets, scan_size
+from tweet_parser import getTimeStamp
+from twitter_graph import InteractionCounts, INDEX_BITS, INDEX_MASK
+import graph_writers
+
+
+class WindowedInteractions:
+    """
+    Count user interactions in sliding time windows from a single pass over the tweets. TAJ files aren't strictly
+    time-ordered, so interactions are first counted in bins the size of the greatest common divisor of the window
+    length and step; the window then slides over the bins in order, adding the newest bins' counts and evicting the
+    oldest. Bins are counted from the start of the first window, so every window's edges are those of the tweets in
+    [window start, window end), as an exportgraph run with those dates would count them.
+    """
+
+    def __init__(self, window, step, start=None, directed=True, replies=True, mentions=False, retweets=False,
+                 quotes=False, end=None):
+        """
+        :param window: Window length in seconds
+        :param step: Seconds between the starts of consecutive windows
+        :param start: POSIX time the first window starts (the earliest tweet's bin if omitted)
+        :param end: Latest POSIX time counted, inclusive (the latest tweet's if omitted). The last window is the last
+        one starting no later than this.
+        """
+        if window < 1 or step < 1:
+            raise ValueError('Window length and step must be at least one second.')
+        self.window = int(window)
+        self.step = int(step)
+        self.start = start
+        self.end = end
+        self.bin_size = math.gcd(self.window, self.step)
+        # Bins are numbered from here, so that window boundaries fall on bin boundaries
+        self.origin = start if start is not None else 0
+
+        # One numbering of users and their latest handles, shared by every bin
+        self.users = InteractionCounts(directed, False, replies, mentions, retweets, quotes)
+        self.bins = {}      # bin number -> {(source number << 32 | sink number) -> count}
+        self.first = None   # Earliest tweet time seen
+        self.last = None    # Latest tweet time seen
+
+    def add_tweet(self, tweet):
+        """
+        Count the interactions in one tweet in the bin for its timestamp.
+        """
+        timestamp = getTimeStamp(tweet)
+        if timestamp is None: return
+        posix = time.mktime(timestamp.timetuple())
+        if (self.start is not None and posix < self.start) or (self.end is not None and posix > self.end): return
+        if self.first is None or posix < self.first: self.first = posix
+        if self.last is None or posix > self.last: self.last = posix
+        # InteractionCounts.count() adds to whichever dict is its counts, so point it at this tweet's bin
+        self.users.counts = self.bins.setdefault(int((posix - self.origin) // self.bin_size), {})
+        self.users.add_tweet(tweet)
+
+    def update(self, tweetgen):
+        """
+        Count the interactions in every tweet from an iterator.
+        :return: self
+        """
+        for tweet in tweetgen:
+            self.add_tweet(tweet)
+        return self
+
+    def snapshots(self):
+        """
+        Slide the window across the counted period.
+        :return: Generator over (window start, window end, InteractionCounts for the window) in time order
+        """
+        if self.first is None: return
+        if self.start is not None: start = self.start
+        else: start = self.origin + ((self.first - self.origin) // self.bin_size) * self.bin_size
+        stop = self.last if self.end is None else min(self.last, self.end)
+        current = {}
+
+        def add(bins, sign):
+            for b in bins:
+                for key, weight in self.bins.get(b, {}).items():
+                    weight = current.get(key, 0) + sign * weight
+                    if weight: current[key] = weight
+                    else: del current[key]
+
+        bins_per_window = self.window // self.bin_size
+        bins_per_step = self.step // self.bin_size
+        lo = int((start - self.origin) // self.bin_size)
+        add(range(lo, lo + bins_per_window), 1)
+        while start <= stop:
+            yield start, start + self.window, self.snapshot(current)
+            # Slide forward one step: evict the oldest bins, add the newest
+            add(range(lo, lo + bins_per_step), -1)
+            add(range(lo + bins_per_window, lo + bins_per_window + bins_per_step), 1)
+            lo += bins_per_step
+            start += self.step
+
+    def snapshot(self, current):
+        """
+        Build the InteractionCounts for one window's edge counts, numbering only the users in the window.
+        """
+        users = self.users
+        snap = InteractionCounts(users.directed, False, users.replies, users.mentions, users.retweets, users.quotes)
+        for key, weight in current.items():
+            src = snap.node(users.ids[key >> INDEX_BITS])
+            snk = snap.node(users.ids[key & INDEX_MASK])
+            snap.count(src, snk, weight)
+            snap.handles[src] = users.handles[key >> INDEX_BITS]
+            snap.handles[snk] = users.handles[key & INDEX_MASK]
+        return snap
+
+
+def snapshot_path(outfile, start):
+    """
+    Name the file for one window's snapshot by adding the window's start time to the output name.
+    :param outfile: Output path given by the user, such as 'data/graph.gml.gz'
+    :param start: POSIX time the window starts
+    :return: Path such as 'data/graph-1525132800.gml.gz'
+    """
+    base, compression = graph_writers.split_compression(outfile)
+    stem, ext = os.path.splitext(base)
+    return stem + '-' + str(int(start)) + ext + compression
+
+def write_dynamic_gexf(windows, outfile):
+    """
+    Write every window into one dynamic GEXF file. Each snapshot holds from the start of its window until the next
+    window starts, so an edge's weight over time is a run of non-overlapping spells.
+    :param windows: WindowedInteractions that have counted their tweets
+    :param outfile: Output path
+    :return: Number of windows written
+    """
+    spells = {}     # (source ID, sink ID) -> [[start, end, weight], ...]
+    presence = {}   # user ID -> [[start, end], ...]
+    handles = {}
+    num_windows = 0
+    for start, end, snap in windows.snapshots():
+        num_windows += 1
+        until = start + windows.step
+        for src, snk, weight in snap.iter_edges():
+            runs = spells.setdefault((src, snk), [])
+            # Merge with the previous spell if the weight didn't change
+            if runs and runs[-1][1] == start and runs[-1][2] == weight: runs[-1][1] = until
+            else: runs.append([start, until, weight])
+        for user_id, handle in zip(snap.ids, snap.handles):
+            handles[user_id] = handle
+            runs = presence.setdefault(user_id, [])
+            if runs and runs[-1][1] == start: runs[-1][1] = until
+            else: runs.append([start, until])
+
+    with graph_writers.open_output(outfile) as fout:
+        fout.write('<?xml version="1.0" encoding="UTF-8"?>\n'
+                   '<gexf xmlns="http://www.gexf.net/1.2draft" version="1.2">\n'
+                   '  <graph defaultedgetype="' + ('directed' if windows.users.directed else 'undirected') +
+                   '" mode="dynamic" timeformat="double">\n'
+                   '    <attributes class="node" mode="static">\n'
+                   '      <attribute id="0" title="handle" type="string"/>\n'
+                   '    </attributes>\n'
+                   '    <attributes class="edge" mode="dynamic">\n'
+                   '      <attribute id="weight" title="Weight" type="float"/>\n'
+                   '    </attributes>\n'
+                   '    <nodes>\n')
+        for user_id, runs in presence.items():
+            handle = handles[user_id]
+            fout.write('      <node id="' + str(user_id) + '" label=' + quoteattr(handle or str(user_id)) + '>')
+            if handle is not None:
+                fout.write('<attvalues><attvalue for="0" value=' + quoteattr(handle) + '/></attvalues>')
+            fout.write('<spells>' + ''.join('<spell start="' + repr(float(a)) + '" end="' + repr(float(b)) + '"/>'
+                                            for a, b in runs) + '</spells></node>\n')
+        fout.write('    </nodes>\n    <edges>\n')
+        for idx, ((src, snk), runs) in enumerate(spells.items()):
+            fout.write('      <edge id="' + str(idx) + '" source="' + str(src) + '" target="' + str(snk) + '">'
+                       '<attvalues>' +
+                       ''.join('<attvalue for="weight" value="' + str(w) + '" start="' + repr(float(a)) +
+                               '" end="' + repr(float(b)) + '"/>' for a, b, w in runs) +
+                       '</attvalues><spells>' +
+                       ''.join('<spell start="' + repr(float(a)) + '" end="' + repr(float(b)) + '"/>'
+                               for a, b, w in runs) +
+                       '</spells></edge>\n')
+        fout.write('    </edges>\n  </graph>\n</gexf>\n')
+    return num_windows
+
+def export_windows(job, outfile, window, step, min_id=None, max_id=None, min_date=None, max_date=None,
+                   directed=True, replies=True, mentions=False, retweets=False, quotes=False, dynamic=False,
+                   where=None, task=None):
+    """
+    Export weighted user interaction graphs for a series of sliding time windows, from one pass over the archive.
+    :param job: Job dictionary with a path to an archive, or a tweet file (see arx_mgr.resolve_archive)
+    :param outfile: Output path. Each window is written to its own file named by its start time (see snapshot_path)
+    in the format chosen by the extension, unless dynamic is set.
+    :param window: Window length in seconds
+    :param step: Seconds between the starts of consecutive windows
+    :param dynamic: Write a single dynamic GEXF with edge weights over time instead of one file per window
+    :param where: Optional tweet_filter.Filter; only interactions in matching tweets are counted
+    :param task: Optional task_mgr.Task to report progress to and check for cancellation
+    :return: Number of windows written
+    """
+    windows = WindowedInteractions(window, step, min_date, directed, replies, mentions, retweets, quotes, max_date)
+    if task is None:
+        tweetgen = scan_tweets(job, min_id, max_id, min_date, max_date, where=where, users=False)
+    else:
+        task.expect(*scan_size(job, min_id, max_id, min_date, max_date, where))
+        tweetgen = task.track(scan_tweets(job, min_id, max_id, min_date, max_date, on_segment=task.segment_done,
+                                          where=where, users=False))
+    windows.update(tweetgen)
+
+    if dynamic:
+        return write_dynamic_gexf(windows, outfile)
+    num_windows = 0
+    for start, end, snap in windows.snapshots():
+        if task is not None: task.check()
+        graph_writers.write_graph(snap, snapshot_path(outfile, start), graph_writers.graph_format(outfile))
+        num_windows += 1
+    return num_windows
@@ -0,0 +1,537 @@
+import os, sys
+import re
+import time
+import unicodedata
+from array import array
+import json_codec
+import tweet_parser
+import tweet_store
+import user_dict
+from arx_mgr import load_arx, scan_segments
+from tweet_parser import get_extractor
+
+FORMAT_VERSION = 1
+
+INDEX_DIR = 'text'
+
+# Tweet fields the index is built from
+FIELDS = ('tweet_id', 'timestamp', 'text')
+
+# Words are runs of letters, digits and underscores, so hashtags and @mentions are indexed without their # or @
+_WORD = re.compile(r'\w+')
+
+# Pieces of a query: quoted phrases (optionally negated), parentheses, and anything else up to a space
+_QUERY_TOKEN = re.compile(r'-?"[^"]*"?|[()]|[^\s()"]+')
+
+
+def tokenize(text):
+    """
+    Split tweet text into the terms the index is keyed by.
+    :param text: Tweet text (None is treated as empty)
+    :return: List of NFKC-normalized, case-folded words, in order
+    """
+    if not text:
+        return []
+    return _WORD.findall(unicodedata.normalize('NFKC', text).casefold())
+
+def _append_varint(out, value):
+    """
+    Append a non-negative integer to a bytearray as a base-128 varint.
+    """
+    while value >= 0x80:
+        out.append((value & 0x7F) | 0x80)
+        value >>= 7
+    out.append(value)
+
+def encode_positions(postings):
+    """
+    Compress a positional posting list. Each tweet is written as the gap from the previous tweet's number, its number
+    of positions, then the gaps between its positions, all as varints.
+    :param postings: List of (tweet number, [positions of the term in its text]) in increasing order
+    :return: bytes
+    """
+    out = bytearray()
+    last = 0
+    for doc, positions in postings:
+        _append_varint(out, doc - last)
+        last = doc
+        _append_varint(out, len(positions))
+        prev = 0
+        for position in positions:
+            _append_varint(out, position - prev)
+            prev = position
+    return bytes(out)
+
+def decode_positions(data):
+    """
+    Expand a positional posting list written by encode_positions.
+    :param data: bytes
+    :return: Dictionary of tweet number -> list of positions
+    """
+    values = []
+    value = 0; shift = 0
+    for byte in data:
+        value |= (byte & 0x7F) << shift
+        if byte & 0x80:
+            shift += 7
+        else:
+            values.append(value)
+            value = 0; shift = 0
+    postings = {}
+    doc = 0; idx = 0
+    while idx < len(values):
+        doc += values[idx]
+        count = values[idx + 1]
+        positions = values[idx + 2:idx + 2 + count]
+        for pos in range(1, count):
+            positions[pos] += positions[pos - 1]
+        postings[doc] = positions
+        idx += 2 + count
+    return postings
+
+def index_path(job, taj_name):
+    """
+    :param job: Job dictionary with a path to an archive
+    :param taj_name: Filename of the TAJ (no directory)
+    :return: Path of the TAJ's text index file
+    """
+    return os.path.join(job['path'], INDEX_DIR, taj_name + '.ftx')
+
+def read_segment(taj_file):
+    """
+    Read the text of every tweet in a TAJ file.
+    :param taj_file: Path to the TAJ file
+    :return: Generator over (byte offset of the tweet's line, tweet ID, POSIX timestamp, text), skipping tweets
+    without a valid ID or date just as arx_mgr.iter_tweetfile does
+    """
+    extract = get_extractor(*FIELDS).extract
+    resolve = tweet_store.Resolver(taj_file)
+    with open(taj_file, 'rb') as fin:
+        offset = 0
+        for line in fin:
+            start = offset
+            offset += len(line)
+            line = resolve(line.decode('utf-8', 'ignore').strip())
+            if not line: continue
+            try:
+                record = extract(json_codec.loads(line))
+            except ValueError:
+                continue
+            if record.tweet_id is None or record.timestamp is None: continue
+            yield start, record.tweet_id, time.mktime(record.timestamp.timetuple()), record.text
+
+def update_segment(job, entry):
+    """
+    Rebuild the text index file for one TAJ. Called when a segment is finalized, since the newest finished TAJ can
+    still grow.
+
+    The file starts with one line of JSON holding the TAJ's size and modification time, the number of tweets, and a
+    dictionary of term -> [start, length, number of tweets] locating its posting list. After it come the tweets'
+    IDs, line offsets and timestamps as native 64-bit arrays, with the tweets numbered in ID order, then the
+    compressed positional posting lists (see encode_positions).
+    :param job: Job dictionary with a path to an archive
+    :param entry: The TAJ's ARX entry
+    """
+    taj_name = os.path.basename(str(entry[0]))
+    taj_file = os.path.join(job['path'], taj_name)
+    docs = sorted(read_segment(taj_file), key=lambda doc : doc[1])
+    stat = os.stat(taj_file)
+
+    postings = {}
+    for num, doc in enumerate(docs):
+        positions = {}
+        for position, term in enumerate(tokenize(doc[3])):
+            positions.setdefault(term, []).append(position)
+        for term, found in positions.items():
+            postings.setdefault(term, []).append((num, found))
+
+    terms = {}
+    blobs = []
+    position = 0
+    for term, term_postings in postings.items():
+        blob = encode_positions(term_postings)
+        terms[term] = [position, len(blob), len(term_postings)]
+        blobs.append(blob)
+        position += len(blob)
+    header = {'version' : FORMAT_VERSION, 'taj' : taj_name, 'size' : stat.st_size, 'mtime' : stat.st_mtime,
+              'byteorder' : sys.byteorder, 'num_tweets' : len(docs), 'terms' : terms}
+
+    # Write to a temporary file first so a reader never sees a partial index
+    path = index_path(job, taj_name)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path + '.tmp', 'wb') as fout:
+        fout.write(json_codec.dumps(header).encode('utf-8') + b'\n')
+        fout.write(array('q', [doc[1] for doc in docs]).tobytes())
+        fout.write(array('q', [doc[0] for doc in docs]).tobytes())
+        fout.write(array('d', [doc[2] for doc in docs]).tobytes())
+        for blob in blobs:
+            fout.write(blob)
+    os.replace(path + '.tmp', path)
+
+
+def parse_query(query):
+    """
+    Parse a search query. Words and "quoted phrases" must all appear unless joined by OR; a leading - or NOT
+    excludes tweets with a word or phrase, and parentheses group. Words are matched after the same normalization as
+    tweet text (see tokenize), so a query word that splits into several terms, such as don't, is matched as a phrase.
+    :param query: Query string, such as: "climate change" (hoax OR scam) -warming
+    :return: Parsed query: nested tuples of ('and', [queries]), ('or', [queries]), ('not', query) and ('phrase',
+    [terms])
+    :raise ValueError: If the query is malformed or has no words to search for
+    """
+    tokens = _QUERY_TOKEN.findall(query)
+    pos = 0
+
+    def peek():
+        return tokens[pos] if pos < len(tokens) else None
+
+    def parse_or():
+        nonlocal pos
+        nodes = [parse_and()]
+        while peek() == 'OR':
+            pos += 1
+            nodes.append(parse_and())
+        return nodes[0] if len(nodes) == 1 else ('or', nodes)
+
+    def parse_and():
+        nonlocal pos
+        nodes = []
+        while peek() not in (None, ')', 'OR'):
+            if peek() == 'AND':
+                pos += 1
+                continue
+            nodes.append(parse_not())
+        if not nodes:
+            raise ValueError('Expected a word or phrase in the search query')
+        return nodes[0] if len(nodes) == 1 else ('and', nodes)
+
+    def parse_not():
+        nonlocal pos
+        token = peek()
+        if token == 'NOT':
+            pos += 1
+            return ('not', parse_not())
+        if token is not None and len(token) > 1 and token[0] == '-':
+            tokens[pos] = token[1:]
+            return ('not', parse_not())
+        return parse_atom()
+
+    def parse_atom():
+        nonlocal pos
+        token = peek()
+        pos += 1
+        if token == '(':
+            node = parse_or()
+            if peek() != ')':
+                raise ValueError('Unbalanced parentheses in the search query')
+            pos += 1
+            return node
+        if token is None or token == ')':
+            raise ValueError('Expected a word or phrase in the search query')
+        terms = tokenize(token.strip('"'))
+        if not terms:
+            raise ValueError('Nothing to search for in ' + token)
+        return ('phrase', terms)
+
+    node = parse_or()
+    if peek() is not None:
+        raise ValueError('Unexpected ' + peek() + ' in the search query')
+    return node
+
+def evaluate(node, source):
+    """
+    Find the tweets matching a parsed query.
+    :param node: Query from parse_query
+    :param source: SegmentIndex, or any object with the same universe() and phrase(terms) methods
+    :return: Set of the tweet numbers that match
+    """
+    kind = node[0]
+    if kind == 'phrase':
+        return source.phrase(node[1])
+    if kind == 'or':
+        found = set()
+        for child in node[1]:
+            found |= evaluate(child, source)
+        return found
+    if kind == 'not':
+        return source.universe() - evaluate(node[1], source)
+
+    # Intersect the terms that must appear before taking out the ones that mustn't
+    found = None
+    for child in node[1]:
+        if child[0] != 'not':
+            found = evaluate(child, source) if found is None else found & evaluate(child, source)
+            if not found: return set()
+    if found is None:
+        found = source.universe()
+    for child in node[1]:
+        if child[0] == 'not':
+            found -= evaluate(child[1], source)
+            if not found: break
+    return found
+
+def _phrase_docs(postings):
+    """
+    :param postings: Positional postings (tweet number -> positions) of each word of a phrase, in phrase order
+    :return: Set of tweet numbers where the words appear consecutively
+    """
+    docs = set(postings[0])
+    for term_postings in postings[1:]:
+        docs.intersection_update(term_postings)
+    found = set()
+    for doc in docs:
+        starts = set(postings[0][doc])
+        for offset, term_postings in enumerate(postings[1:], 1):
+            starts.intersection_update(position - offset for position in term_postings[doc])
+            if not starts: break
+        if starts: found.add(doc)
+    return found
+
+
+class SegmentIndex:
+    """
+    Text index of one finished TAJ, opened for queries. The header and the table of tweets are read up front; posting
+    lists are read from the file as they're looked up.
+    """
+
+    def __init__(self, path, taj_file, header, ids, offsets, timestamps, start):
+        """
+        :param path: Path of the index file
+        :param taj_file: Path of the TAJ it indexes
+        :param header: Decoded header line
+        :param ids: array of tweet IDs by tweet number
+        :param offsets: array of each tweet's line offset in the TAJ by tweet number
+        :param timestamps: array of each tweet's POSIX timestamp by tweet number
+        :param start: Byte offset where the posting lists begin
+        """
+        self.path = path
+        self.taj_file = taj_file
+        self.header = header
+        self.ids = ids
+        self.offsets = offsets
+        self.timestamps = timestamps
+        self.start = start
+
+    def universe(self):
+        return set(range(len(self.ids)))
+
+    def postings(self, term):
+        """
+        :return: Positional postings of a term (tweet number -> positions), empty if it doesn't appear
+        """
+        location = self.header['terms'].get(term)
+        if location is None:
+            return {}
+        with open(self.path, 'rb') as fin:
+            fin.seek(self.start + location[0])
+            return decode_positions(fin.read(location[1]))
+
+    def phrase(self, terms):
+        """
+        :param terms: Normalized terms, in order
+        :return: Set of the tweet numbers whose text has the terms consecutively
+        """
+        if len(terms) == 1:
+            return set(self.postings(terms[0]))
+        if any(term not in self.header['terms'] for term in terms):
+            return set()
+        return _phrase_docs([self.postings(term) for term in terms])
+
+    def search(self, node, min_id=None, max_id=None, min_date=None, max_date=None):
+        """
+        :param node: Query from parse_query
+        :return: List of Hit for the matching tweets within the bounds, in ID order
+        """
+        if min_id is None: min_id = -1
+        if max_id is None: max_id = float('inf')
+        if min_date is None: min_date = -1
+        if max_date is None: max_date = float('inf')
+        hits = []
+        for doc in sorted(evaluate(node, self)):
+            if min_id <= self.ids[doc] <= max_id and min_date <= self.timestamps[doc] <= max_date:
+                hits.append(Hit(self.ids[doc], self.timestamps[doc], self.taj_file, self.offsets[doc]))
+        return hits
+
+
+class _TweetSource:
+    """
+    A single tweet's text, searchable like a SegmentIndex holding only tweet number 0.
+    """
+
+    def __init__(self, text):
+        self.positions = {}
+        for position, term in enumerate(tokenize(text)):
+            self.positions.setdefault(term, []).append(position)
+
+    def universe(self):
+        return {0}
+
+    def phrase(self, terms):
+        postings = []
+        for term in terms:
+            if term not in self.positions: return set()
+            postings.append({0 : self.positions[term]})
+        return _phrase_docs(postings)
+
+
+class Hit:
+    """
+    A tweet that matched a search. The tweet itself is only read from its TAJ when load() is called.
+    """
+    __slots__ = ('tweet_id', 'timestamp', 'taj_file', 'offset')
+
+    def __init__(self, tweet_id, timestamp, taj_file, offset):
+        self.tweet_id = tweet_id
+        self.timestamp = timestamp      # POSIX timestamp
+        self.taj_file = taj_file        # Path of the TAJ holding the tweet
+        self.offset = offset            # Byte offset of the tweet's line in the TAJ
+
+    def load(self, lazy=False):
+        """
+        Read the tweet.
+        :param lazy: Return a tweet_parser.LazyTweet instead of a dict
+        :return: Tweet object
+        :raise ValueError: If the tweet is kept in a shared store that has lost it
+        """
+        with open(self.taj_file, 'rb') as fin:
+            fin.seek(self.offset)
+            line = tweet_store.Resolver(self.taj_file)(fin.readline().decode('utf-8', 'ignore').strip())
+        if line is None:
+            raise ValueError('Tweet ' + str(self.tweet_id) + ' is missing from the shared tweet store')
+        line = user_dict.Rehydrator(self.taj_file)(line)
+        return tweet_parser.LazyTweet(line) if lazy else json_codec.loads(line)
+
+    def __repr__(self):
+        return 'Hit(' + str(self.tweet_id) + ')'
+
+
+def load_segment(job, entry):
+    """
+    Open the text index for a TAJ, if it exists and still matches the file on disk.
+    :param job: Job dictionary with a path to an archive
+    :param entry: The TAJ's ARX entry
+    :return: SegmentIndex, or None if there is no up-to-date index
+    """
+    taj_name = os.path.basename(str(entry[0]))
+    path = index_path(job, taj_name)
+    taj_file = os.path.join(job['path'], taj_name)
+    try:
+        with open(path, 'rb') as fin:
+            header = json_codec.loads(fin.readline())
+            if header.get('version') != FORMAT_VERSION or header.get('byteorder') != sys.byteorder:
+                return None
+            tables = []
+            for typecode in 'qqd':
+                table = array(typecode)
+                table.fromfile(fin, header['num_tweets'])
+                tables.append(table)
+            start = fin.tell()
+        stat = os.stat(taj_file)
+    except (OSError, ValueError, EOFError, KeyError):
+        return None
+    if header.get('size') != stat.st_size or header.get('mtime') != stat.st_mtime:
+        return None
+    return SegmentIndex(path, taj_file, header, tables[0], tables[1], tables[2], start)
+
+def build_index(job, task=None):
+    """
+    Build or refresh the text index for every finished TAJ in an archive, such as one collected before the index was
+    enabled.
+    :param job: Job dictionary with a path to an archive
+    :param task: Optional task_mgr.Task to report progress to and check for cancellation
+    :return: Number of segments (re)built
+    """
+    arx = load_arx(job)
+    finished = arx['finished'] or []
+    if task is not None: task.expect(len(finished), sum(entry[5] for entry in finished))
+    built = 0
+    for entry in finished:
+        if load_segment(job, entry) is None:
+            update_segment(job, entry)
+            built += 1
+        if task is not None:
+            task.tweets_scanned += entry[5]
+            task.segment_done(entry)
+    return built
+
+def scan_segment(taj_file, node, min_id=None, max_id=None, min_date=None, max_date=None):
+    """
+    Search a TAJ without an index, by reading every tweet in it.
+    :return: List of Hit for the matching tweets within the bounds, in ID order
+    """
+    if min_id is None: min_id = -1
+    if max_id is None: max_id = float('inf')
+    if min_date is None: min_date = -1
+    if max_date is None: max_date = float('inf')
+    hits = []
+    for offset, tweet_id, timestamp, text in read_segment(taj_file):
+        if min_id <= tweet_id <= max_id and min_date <= timestamp <= max_date and \
+                evaluate(node, _TweetSource(text)):
+            hits.append(Hit(tweet_id, timestamp, taj_file, offset))
+    hits.sort(key=lambda hit : hit.tweet_id)
+    return hits
+
+def search(job, query, min_id=None, max_id=None, min_date=None, max_date=None, reverse=False, on_segment=None):
+    """
+    Search the text of the tweets in an archive. Segments with an up-to-date text index are answered from it without
+    reading any tweets; the rest, such as the unfinished TAJ, are scanned.
+    :param job: Same as for arx_mgr.scan_tweets
+    :param query: Query string (see parse_query), or a query it has already parsed
+    :param min_id: Minimum tweet ID
+    :param max_id: Maximum tweet ID
+    :param min_date: Minimum date (POSIX timestamp)
+    :param max_date: Maximum date (POSIX timestamp)
+    :param reverse: Give the newest tweets first
+    :param on_segment: Optional callback, called with each ARX entry (or the file) once it has been searched
+    :return: Generator over a Hit for each matching tweet, in tweet ID order
+    :raise ValueError: If the query is malformed
+    """
+    node = parse_query(query) if isinstance(query, str) else query
+    if type(job) is not dict:
+        hits = scan_segment(job, node, min_id, max_id, min_date, max_date)
+        for hit in (reversed(hits) if reverse else hits):
+            yield hit
+        if on_segment is not None: on_segment(job)
+        return
+
+    # The ARX lists segments in ID order, so sorting each segment's hits puts them all in ID order
+    for entry in scan_segments(job, min_id, max_id, min_date, max_date, reverse):
+        index = load_segment(job, entry)
+        if index is None:
+            hits = scan_segment(str(entry[0]), node, min_id, max_id, min_date, max_date)
+        else:
+            hits = index.search(node, min_id, max_id, min_date, max_date)
+        for hit in (reversed(hits) if reverse else hits):
+            yield hit
+        if on_segment is not None: on_segment(entry)
+
+def search_tweets(job, query, min_id=None, max_id=None, min_date=None, max_date=None, reverse=False, lazy=False):
+    """
+    Search the text of the tweets in an archive (see search), reading each matching tweet as it's reached.
+    :param lazy: Yield tweet_parser.LazyTweet records instead of dicts
+    :return: Generator over the matching tweets, in tweet ID order
+    """
+    for hit in search(job, query, min_id, max_id, min_date, max_date, reverse):
+        yield hit.load(lazy)
+
+def export_tweets(job, outfile, query, min_id=None, max_id=None, min_date=None, max_date=None, task=None):
+    """
+    Write the tweets a search finds to a file, one JSON object per line, in tweet ID order.
+    :param outfile: Path of the file to write
+    :param task: Optional task_mgr.Task to report progress to and check for cancellation
+    :return: Number of tweets written
+    """
+    on_segment = None
+    if task is not None and type(job) is dict:
+        task.expect(len(scan_segments(job, min_id, max_id, min_date, max_date)), None)
+        on_segment = task.segment_done
+    hits = search(job, query, min_id, max_id, min_date, max_date, on_segment=on_segment)
+    if task is not None: hits = task.track(hits)
+
+    num_tweets = 0
+    os.makedirs(os.path.dirname(outfile) or '.', exist_ok=True)
+    with open(outfile, 'w') as fout:
+        for hit in hits:
+            fout.write(json_codec.dumps(hit.load()) + '\n')
+            num_tweets += 1
+    return num_tweets
@@ -0,0 +1,347 @@
+import re
+import tweet_parser
+
+# Kinds of constraint segment summaries can check (see arx_mgr.check_summary)
+SUMMARY_KEYS = ('langs', 'authors', 'mentions', 'hashtags')
+
+# Escapes of the only non-ASCII characters that lowercase to ASCII letters (dotted capital I and the Kelvin sign)
+_ASCII_LOWERCASE = ('\\u0130', '\\u212a')
+
+# A reply has a number, rather than null, as its in_reply_to_user_id
+_REPLY = re.compile(r'"in_reply_to_user_id"\s*:\s*\d')
+
+
+class Filter:
+    """
+    A condition on tweets that arx_mgr.scan_tweets can check (see its where parameter). Each filter is checked as
+    cheaply as it can be: first against the segment summaries in the ARX to skip whole TAJ files, then against each
+    raw line to skip tweets without decoding them, and finally against the decoded tweet. Filters combine with
+    & (and), | (or) and ~ (not).
+    """
+
+    def summary(self):
+        """
+        :return: Dictionary of constraints every matching tweet meets, as keyword arguments for
+        arx_mgr.check_summary, so segments that meet none can be skipped
+        """
+        return {}
+
+    def prefilter(self, line):
+        """
+        Check a tweet's raw JSON line. May let through tweets that don't match, but never rejects one that does.
+        :param line: Tweet as a JSON string
+        :return: False if the tweet can't match
+        """
+        return True
+
+    def match(self, tweet):
+        """
+        :param tweet: Decoded tweet (dict or tweet_parser.LazyTweet)
+        :return: True if the tweet matches
+        """
+        raise NotImplementedError
+
+    def __and__(self, other):
+        return AllOf(self, other)
+
+    def __or__(self, other):
+        return AnyOf(self, other)
+
+    def __invert__(self):
+        return Not(self)
+
+
+class AllOf(Filter):
+    """
+    Tweets matching every one of the filters.
+    """
+
+    def __init__(self, *filters):
+        self.filters = []
+        for where in filters:
+            self.filters.extend(where.filters if isinstance(where, AllOf) else [where])
+
+    def summary(self):
+        # Each filter's constraints must all hold; where two constrain the same thing, either will do
+        constraints = {}
+        for where in self.filters:
+            for key, items in where.summary().items():
+                constraints.setdefault(key, items)
+        return constraints
+
+    def prefilter(self, line):
+        return all(where.prefilter(line) for where in self.filters)
+
+    def match(self, tweet):
+        return all(where.match(tweet) for where in self.filters)
+
+    def __repr__(self):
+        return '(' + ' & '.join(map(repr, self.filters)) + ')'
+
+
+class AnyOf(Filter):
+    """
+    Tweets matching at least one of the filters.
+    """
+
+    def __init__(self, *filters):
+        self.filters = []
+        for where in filters:
+            self.filters.extend(where.filters if isinstance(where, AnyOf) else [where])
+
+    def summary(self):
+        # A segment can only be skipped on a constraint every alternative shares
+        summaries = [where.summary() for where in self.filters]
+        constraints = {}
+        for key in SUMMARY_KEYS:
+            if all(key in summary for summary in summaries):
+                constraints[key] = set().union(*(summary[key] for summary in summaries))
+        return constraints
+
+    def prefilter(self, line):
+        return any(where.prefilter(line) for where in self.filters)
+
+    def match(self, tweet):
+        return any(where.match(tweet) for where in self.filters)
+
+    def __repr__(self):
+        return '(' + ' | '.join(map(repr, self.filters)) + ')'
+
+
+class Not(Filter):
+    """
+    Tweets not matching the filter. Nothing can be pushed down past a negation, so these are only checked on decoded
+    tweets.
+    """
+
+    def __init__(self, where):
+        self.where = where
+
+    def match(self, tweet):
+        return not self.where.match(tweet)
+
+    def __repr__(self):
+        return '~' + repr(self.where)
+
+
+class UserIn(Filter):
+    """
+    Tweets written by one of a set of users.
+    """
+
+    def __init__(self, user_ids):
+        self.user_ids = set(int(user_id) for user_id in user_ids)
+        self.digits = [str(user_id) for user_id in self.user_ids]
+
+    def summary(self):
+        return {'authors' : self.user_ids}
+
+    def prefilter(self, line):
+        return any(digits in line for digits in self.digits)
+
+    def match(self, tweet):
+        return tweet_parser.getUserID(tweet) in self.user_ids
+
+    def __repr__(self):
+        return 'user_in(' + repr(sorted(self.user_ids)) + ')'
+
+
+class MentionsUser(Filter):
+    """
+    Tweets mentioning one of a set of users.
+    """
+
+    def __init__(self, user_ids):
+        self.user_ids = set(int(user_id) for user_id in user_ids)
+        self.digits = [str(user_id) for user_id in self.user_ids]
+
+    def summary(self):
+        return {'mentions' : self.user_ids}
+
+    def prefilter(self, line):
+        return any(digits in line for digits in self.digits)
+
+    def match(self, tweet):
+        return not self.user_ids.isdisjoint(tweet_parser.getUserMentions(tweet))
+
+    def __repr__(self):
+        return 'mentions_user(' + repr(sorted(self.user_ids)) + ')'
+
+
+class HasHashtag(Filter):
+    """
+    Tweets with one of a set of hashtags, whatever their case (see tweet_parser.normalize_hashtag). Hashtags can be
+    escaped or differently composed in the raw JSON, so these aren't prefiltered.
+    """
+
+    def __init__(self, hashtags):
+        self.hashtags = set(map(tweet_parser.normalize_hashtag, hashtags))
+
+    def summary(self):
+        return {'hashtags' : self.hashtags}
+
+    def match(self, tweet):
+        return not self.hashtags.isdisjoint(map(tweet_parser.normalize_hashtag, tweet_parser.getHashtags(tweet)))
+
+    def __repr__(self):
+        return 'has_hashtag(' + repr(sorted(self.hashtags)) + ')'
+
+
+class LangIs(Filter):
+    """
+    Tweets in one of a set of languages, by the code Twitter gives them.
+    """
+
+    def __init__(self, langs):
+        self.langs = set(langs)
+        self.quoted = ['"' + lang + '"' for lang in self.langs]
+
+    def summary(self):
+        return {'langs' : self.langs}
+
+    def prefilter(self, line):
+        return any(quoted in line for quoted in self.quoted)
+
+    def match(self, tweet):
+        return tweet_parser.getLang(tweet) in self.langs
+
+    def __repr__(self):
+        return 'lang_is(' + repr(sorted(self.langs)) + ')'
+
+
+class IsReply(Filter):
+    """
+    Tweets replying to a user.
+    """
+
+    def prefilter(self, line):
+        return _REPLY.search(line) is not None
+
+    def match(self, tweet):
+        return tweet_parser.getReplyID(tweet) is not None
+
+    def __repr__(self):
+        return 'is_reply()'
+
+
+class IsRetweet(Filter):
+    """
+    Retweets.
+    """
+
+    def prefilter(self, line):
+        return '"retweeted_status"' in line
+
+    def match(self, tweet):
+        return tweet_parser.getRetweetID(tweet) is not None
+
+    def __repr__(self):
+        return 'is_retweet()'
+
+
+class TextContains(Filter):
+    """
+    Tweets whose text contains a string, ignoring case unless asked not to.
+    """
+
+    def __init__(self, text, case_sensitive=False):
+        self.text = text
+        self.case_sensitive = case_sensitive
+        self.needle = text if case_sensitive else text.lower()
+        # The raw line can only be searched for text that JSON writes as itself
+        self.raw = text.isascii() and text.isprintable() and '"' not in text and '\\' not in text
+
+    def prefilter(self, line):
+        if not self.raw:
+            return True
+        if self.case_sensitive:
+            return self.needle in line
+        # Non-ASCII characters are escaped in the line, and two of them lowercase to ASCII letters
+        return self.needle in line.lower() or any(escape in line for escape in _ASCII_LOWERCASE)
+
+    def match(self, tweet):
+        text = tweet_parser.getTweetText(tweet)
+        if text is None:
+            return False
+        return self.needle in (text if self.case_sensitive else text.lower())
+
+    def __repr__(self):
+        return 'text_contains(' + repr(self.text) + ('' if not self.case_sensitive else ', case_sensitive=True') + ')'
+
+
+def user_in(*user_ids):
+    """
+    :param user_ids: User IDs (or one iterable of them)
+    :return: Filter for tweets written by one of the users
+    """
+    return UserIn(_flatten(user_ids))
+
+def mentions_user(*user_ids):
+    """
+    :param user_ids: User IDs (or one iterable of them)
+    :return: Filter for tweets mentioning one of the users
+    """
+    return MentionsUser(_flatten(user_ids))
+
+def has_hashtag(*hashtags):
+    """
+    :param hashtags: Hashtags, with or without # (or one iterable of them)
+    :return: Filter for tweets with one of the hashtags
+    """
+    return HasHashtag(_flatten(hashtags))
+
+def lang_is(*langs):
+    """
+    :param langs: Language codes, e.g. 'en' (or one iterable of them)
+    :return: Filter for tweets in one of the languages
+    """
+    return LangIs(_flatten(langs))
+
+def is_reply():
+    """
+    :return: Filter for replies
+    """
+    return IsReply()
+
+def is_retweet():
+    """
+    :return: Filter for retweets
+    """
+    return IsRetweet()
+
+def text_contains(text, case_sensitive=False):
+    """
+    :param text: Text to look for in the tweet text
+    :return: Filter for tweets whose text contains it
+    """
+    return TextContains(text, case_sensitive)
+
+def _flatten(values):
+    """
+    Let the filter constructors take either several values or one iterable of them.
+    """
+    if len(values) == 1 and not isinstance(values[0], (str, int)):
+        return list(values[0])
+    return list(values)
+
+def from_options(options):
+    """
+    Build a filter from the terminal's filter flags (see 'help exportgraph').
+    :param options: Dictionary of flag name -> value, as parsed by cmd_interface.parse_graph_args
+    :return: Filter, or None if no filter flags were given
+    :raise ValueError: If a flag's value is malformed
+    """
+    filters = []
+    if 'from' in options: filters.append(user_in(int(user_id) for user_id in options['from'].split(',')))
+    if 'mentions' in options: filters.append(mentions_user(int(user_id) for user_id in options['mentions'].split(',')))
+    if 'hashtag' in options: filters.append(has_hashtag(options['hashtag'].split(',')))
+    if 'lang' in options: filters.append(lang_is(options['lang'].split(',')))
+    if 'isreply' in options: filters.append(is_reply())
+    if 'isretweet' in options: filters.append(is_retweet())
+    if 'notretweet' in options: filters.append(~is_retweet())
+    if 'text' in options:
+        if options['text'] is True: raise ValueError('--text needs the text to look for')
+        filters.append(text_contains(options['text'].strip('"\'')))
+    if not filters:
+        return None
+    return filters[0] if len(filters) == 1 else AllOf(*filters)
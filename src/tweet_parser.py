@@ -1,5 +1,10 @@
 import pytz
 import datetime as dt
+import json
+import unicodedata
+import json_codec
+from json.decoder import scanstring
+from collections.abc import Mapping
 
 def getTweetID(tweet):
     """
@@ -36,7 +41,7 @@ def getTweets(response):
     
     # Parse the json data
     if response is not None :
-        data = response.json()
+        data = json_codec.response_json(response)
     else :
         return []
     
@@ -155,6 +160,14 @@ def getHashtags(tweet):
                 hashtags.append(hashtag['text'])
     return hashtags
 
+def normalize_hashtag(hashtag):
+    """
+    Put a hashtag in the form indexes key it by, so #Climate, #climate and #ＣＬＩＭＡＴＥ all match.
+    :param hashtag: Hashtag text, with or without the leading #
+    :return: Case-folded, NFKC-normalized hashtag without the #
+    """
+    return unicodedata.normalize('NFKC', hashtag).casefold().lstrip('#')
+
 def getSource(tweet):
     """
     If properly included, get Twitter client used to create this tweet
@@ -166,6 +179,18 @@ def getSource(tweet):
     else :
         return None
 
+def getLang(tweet):
+    """
+    If properly included, get the language Twitter detected in this tweet
+    :param tweet: Python dict containing a Twitter tweet object
+    :return: BCP 47 language code, e.g. 'en', or 'und' if Twitter couldn't tell
+    """
+    if 'lang' in tweet and \
+    tweet['lang'] is not None :
+        return tweet['lang']
+    else :
+        return None
+
 def read_timestamp(timestamp_string):
     """
     Parse a timestamp string into a datetime object
@@ -327,3 +352,288 @@ def getUserMentionTuples(tweet) :
                 mentions.add((mention['id'],
                               mention['screen_name']))
     return mentions
+
+
+
+# Shared stand-in for a missing or null sub-object, so extractors can chain .get() calls. Never modify it.
+_EMPTY = {}
+
+def _timestamp(created_at) :
+    """
+    Parse a 'created_at' string as getTimeStamp does.
+    """
+    return read_timestamp(created_at) if created_at is not None else None
+
+# Fields a TweetExtractor can pull from a tweet: field name -> (sub-object the field is read from, or None for the
+# tweet itself; lines of Python that set the field on the record). Each field gives the same value as the getter it
+# is named after.
+FIELDS = {
+    'tweet_id' : (None, ["record.tweet_id = tweet.get('id')"]),
+    'created_at' : (None, ["record.created_at = tweet.get('created_at')"]),
+    'date' : (None, ["record.date = getDate(tweet)"]),
+    'timestamp' : (None, ["record.timestamp = _timestamp(tweet.get('created_at'))"]),
+    'text' : (None, ["record.text = tweet.get('text')"]),
+    'source' : (None, ["record.source = tweet.get('source')"]),
+    'lang' : (None, ["record.lang = tweet.get('lang')"]),
+    'reply_id' : (None, ["record.reply_id = tweet.get('in_reply_to_user_id')"]),
+    'reply_tuple' : (None, [
+        "user_id = tweet.get('in_reply_to_user_id'); screen_name = tweet.get('in_reply_to_screen_name')",
+        "record.reply_tuple = (user_id, screen_name) if user_id is not None and screen_name is not None else None",
+    ]),
+    'user_id' : ('user', ["record.user_id = user.get('id')"]),
+    'screen_name' : ('user', ["record.screen_name = user.get('screen_name')"]),
+    'location' : ('user', ["record.location = user.get('location')"]),
+    'clock_offset' : ('user', ["record.clock_offset = user.get('utc_offset')"]),
+    'timezone' : ('user', ["record.timezone = user.get('time_zone')"]),
+    'hashtags' : ('entities', [
+        "hashtags = []",
+        "for hashtag in entities.get('hashtags') or () :",
+        "    if hashtag.get('text') is not None : hashtags.append(hashtag['text'])",
+        "record.hashtags = hashtags",
+    ]),
+    'user_mentions' : ('entities', [
+        "mentions = set()",
+        "for mention in entities.get('user_mentions') or () :",
+        "    if mention.get('id') is not None : mentions.add(mention['id'])",
+        "record.user_mentions = mentions",
+    ]),
+    'user_mention_tuples' : ('entities', [
+        "mentions = set()",
+        "for mention in entities.get('user_mentions') or () :",
+        "    user_id = mention.get('id'); screen_name = mention.get('screen_name')",
+        "    if user_id is not None and screen_name is not None : mentions.add((user_id, screen_name))",
+        "record.user_mention_tuples = mentions",
+    ]),
+    'retweet_id' : ('retweeted', ["record.retweet_id = retweeted.get('id')"]),
+    'retweet_tuple' : ('retweeted', [
+        "user_id = retweeted.get('id'); screen_name = retweeted.get('screen_name')",
+        "record.retweet_tuple = (user_id, screen_name) if user_id is not None and screen_name is not None else None",
+    ]),
+    'quoted_user_id' : ('quoted', ["record.quoted_user_id = quoted.get('id')"]),
+    'quoted_user_tuple' : ('quoted', [
+        "user_id = quoted.get('id'); screen_name = quoted.get('screen_name')",
+        "record.quoted_user_tuple = (user_id, screen_name) if user_id is not None and screen_name is not None "
+        "else None",
+    ]),
+}
+
+# How each sub-object is found, looked up once per tweet however many fields read from it
+SUBOBJECTS = {
+    'user' : "user = tweet.get('user') or _EMPTY",
+    'entities' : "entities = tweet.get('entities') or _EMPTY",
+    'retweeted' : "retweeted = (tweet.get('retweeted_status') or _EMPTY).get('user') or _EMPTY",
+    'quoted' : "quoted = (tweet.get('quoted_status') or _EMPTY).get('user') or _EMPTY",
+}
+
+_extractors = {}
+
+
+class TweetRecord :
+    """
+    Base class of the records a TweetExtractor makes. Each extractor has its own subclass, whose slots are its fields.
+    """
+    __slots__ = ()
+
+    def as_dict(self) :
+        return {field : getattr(self, field) for field in self.__slots__}
+
+    def __repr__(self) :
+        return 'TweetRecord(' + ', '.join(field + '=' + repr(getattr(self, field)) for field in self.__slots__) + ')'
+
+
+class TweetExtractor :
+    """
+    Pull a fixed set of fields out of tweets in one pass. The fields are declared once, and the extractor compiles a
+    function that finds each sub-object (user, entities, retweeted or quoted user) once and reads every field from
+    it, instead of each getter walking the tweet again with its own checks. Each tweet becomes a small record with
+    one slot per field, e.g.:
+
+        extractor = TweetExtractor('user_id', 'screen_name', 'reply_tuple')
+        for record in extractor.extract_batch(tweets) :
+            print(record.user_id, record.reply_tuple)
+    """
+
+    def __init__(self, *fields) :
+        """
+        :param fields: Names of the fields to extract, from FIELDS
+        """
+        unknown = [field for field in fields if field not in FIELDS]
+        if len(unknown) > 0 :
+            raise ValueError('Unknown tweet fields: ' + ', '.join(unknown))
+        self.fields = tuple(fields)
+        self.record_type = type('TweetRecord', (TweetRecord,), {'__slots__' : self.fields})
+
+        # Compile the extraction function, grouping the fields by the sub-object they read from
+        lines = ['def extract(tweet) :', '    record = _new(Record)']
+        subobjects = []
+        for field in self.fields :
+            subobject = FIELDS[field][0]
+            if subobject is not None and subobject not in subobjects :
+                subobjects.append(subobject)
+        for subobject in [None] + subobjects :
+            if subobject is not None :
+                lines.append('    ' + SUBOBJECTS[subobject])
+            for field in self.fields :
+                if FIELDS[field][0] == subobject :
+                    lines.extend('    ' + line for line in FIELDS[field][1])
+        lines.append('    return record')
+        namespace = {'_new' : object.__new__, 'Record' : self.record_type, '_EMPTY' : _EMPTY,
+                     '_timestamp' : _timestamp, 'getDate' : getDate}
+        exec('\n'.join(lines) + '\n', namespace)
+        self.extract = namespace['extract']
+
+    def __call__(self, tweet) :
+        return self.extract(tweet)
+
+    def extract_batch(self, tweets) :
+        """
+        :param tweets: List of Python dicts containing Twitter tweet objects
+        :return: List of records, one per tweet
+        """
+        return list(map(self.extract, tweets))
+
+    def extract_iter(self, tweetgen) :
+        """
+        :param tweetgen: Iterator over tweet objects
+        :return: Iterator over records, one per tweet. Tweets whose fields can't be read, such as LazyTweets over a
+        malformed line, are skipped, as a scan skips lines it can't decode.
+        """
+        extract = self.extract
+        for tweet in tweetgen :
+            try :
+                record = extract(tweet)
+            except ValueError :
+                continue
+            yield record
+
+
+def get_extractor(*fields) :
+    """
+    Get a TweetExtractor for these fields, compiling it only the first time it's asked for.
+    :param fields: Names of the fields to extract, from FIELDS
+    :return: TweetExtractor
+    """
+    extractor = _extractors.get(fields)
+    if extractor is None :
+        extractor = _extractors[fields] = TweetExtractor(*fields)
+    return extractor
+
+
+# Decodes one JSON value at a time, in C where available
+_scan_once = json.JSONDecoder().scan_once
+
+def _skip_space(line, pos) :
+    """
+    :return: Position of the first non-whitespace character at or after pos
+    """
+    while line[pos] in ' \t\n\r' : pos += 1
+    return pos
+
+
+class LazyTweet(Mapping) :
+    """
+    Read-only tweet over the raw JSON line it was stored as, decoding only what is looked up. The tweet's top-level
+    members are decoded one at a time, in the order they appear in the line, only as far as the member asked for, so
+    large subtrees later in the line (such as 'retweeted_status' and 'quoted_status') are never decoded unless used.
+    A key that doesn't appear anywhere in the line is known to be missing without decoding anything (member names must
+    be written out, as json.dumps writes them, rather than \\u-escaped). Works anywhere a tweet dict is read,
+    including with every getter in this module and TweetExtractor. A malformed line raises ValueError when the
+    broken part is reached. If a member name appears more than once, the first one is used, where json.loads would
+    keep the last; finding a later duplicate would mean decoding the whole line.
+    """
+    __slots__ = ('line', 'members', 'pos', 'done')
+
+    def __init__(self, line) :
+        """
+        :param line: One tweet's JSON object as a string
+        """
+        self.line = line
+        self.members = {}   # Top-level members decoded so far
+        self.pos = None     # Where in the line the next member starts (None before the opening brace is read)
+        self.done = False   # Whether every member has been decoded
+
+    def _decode_next(self) :
+        """
+        Decode the next top-level member.
+        :raise ValueError: If the line isn't a valid JSON object
+        """
+        line = self.line
+        pos = self.pos
+        try :
+            # Find the start of the member name, quickly in the usual json.dumps layout
+            if line.startswith(', "', pos) :
+                pos += 3
+            else :
+                if pos is None :
+                    pos = _skip_space(line, 0)
+                    if line[pos] != '{' : raise ValueError('Tweet is not a JSON object')
+                    pos = _skip_space(line, pos + 1)
+                    end = line[pos] == '}'
+                else :
+                    pos = _skip_space(line, pos)
+                    end = line[pos] == '}'
+                    if not end :
+                        if line[pos] != ',' : raise ValueError('Invalid tweet JSON at position ' + str(pos))
+                        pos = _skip_space(line, pos + 1)
+                if end :
+                    self.done = True
+                    return
+                if line[pos] != '"' : raise ValueError('Invalid tweet JSON at position ' + str(pos))
+                pos += 1
+            key, pos = scanstring(line, pos)
+            if line.startswith(': ', pos) :
+                pos += 2
+            else :
+                pos = _skip_space(line, pos)
+                if line[pos] != ':' : raise ValueError('Invalid tweet JSON at position ' + str(pos))
+                pos = _skip_space(line, pos + 1)
+            value, pos = _scan_once(line, pos)
+        except (IndexError, StopIteration) :
+            raise ValueError('Truncated or invalid tweet JSON')
+        self.members[key] = value
+        self.pos = pos
+
+    def _find(self, key) :
+        """
+        Decode members until key has been decoded or there are none left.
+        :return: True if the tweet has the key
+        """
+        members = self.members
+        if key in members :
+            return True
+        if self.done or ('"' + key + '"') not in self.line :
+            return False
+        while not self.done and key not in members :
+            self._decode_next()
+        return key in members
+
+    def __getitem__(self, key) :
+        if self._find(key) :
+            return self.members[key]
+        raise KeyError(key)
+
+    def __contains__(self, key) :
+        return self._find(key)
+
+    def get(self, key, default=None) :
+        if self._find(key) :
+            return self.members[key]
+        return default
+
+    def to_dict(self) :
+        """
+        Decode the whole tweet.
+        :return: The tweet as a plain dict
+        """
+        while not self.done :
+            self._decode_next()
+        return self.members
+
+    def __iter__(self) :
+        return iter(self.to_dict())
+
+    def __len__(self) :
+        return len(self.to_dict())
+
+    def __repr__(self) :
+        return 'LazyTweet(' + repr(self.line) + ')'
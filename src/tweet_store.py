@@ -0,0 +1,174 @@
+import os
+import sqlite3
+import threading
+import json_codec
+import tweet_parser
+
+# Database the tweets are kept in, inside the store's directory
+STORE_FILE = 'tweets.db'
+
+# Start of every TAJ line that refers to a tweet in a shared store, rather than holding it
+REFERENCE_PREFIX = '{"shared":1,'
+
+# Open stores by directory, kept per thread since SQLite connections can't be shared between threads
+_local = threading.local()
+
+# Store directory named by each archive's ARX, by archive directory
+_archive_stores = {}
+
+
+class TweetStore:
+    """
+    Tweets shared by several archives, each stored once and keyed by its ID, in an SQLite database. Archives of jobs
+    with overlapping queries can keep their tweets here, so a tweet matched by several queries is written once.
+    Their TAJ files then hold a short reference line for each tweet (see make_reference), which readers turn back
+    into the tweet (see Resolver).
+    """
+
+    def __init__(self, path):
+        """
+        :param path: Directory of the store, created if it doesn't exist
+        """
+        os.makedirs(path, exist_ok=True)
+        self.path = path
+        self.db = sqlite3.connect(os.path.join(path, STORE_FILE), timeout=60)
+        # Write-ahead logging lets scans read while collectors write
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('CREATE TABLE IF NOT EXISTS tweets (id INTEGER PRIMARY KEY, body TEXT NOT NULL)')
+        self.db.commit()
+
+    def put(self, tweets):
+        """
+        Store tweets, in one transaction. Tweets already in the store are left as they are.
+        :param tweets: List of (tweet ID, tweet JSON string)
+        :return: Number of tweets that weren't stored before
+        """
+        with self.db:
+            before = self.db.total_changes
+            self.db.executemany('INSERT OR IGNORE INTO tweets (id, body) VALUES (?, ?)', tweets)
+            return self.db.total_changes - before
+
+    def get(self, tweet_id):
+        """
+        :param tweet_id: Tweet ID
+        :return: The tweet's JSON string, or None if it isn't stored
+        """
+        row = self.db.execute('SELECT body FROM tweets WHERE id = ?', (tweet_id,)).fetchone()
+        return row[0] if row is not None else None
+
+    def __len__(self):
+        return self.db.execute('SELECT COUNT(*) FROM tweets').fetchone()[0]
+
+
+class Resolver:
+    """
+    Turns the lines of a TAJ file back into tweets, looking up the ones it only refers to in the shared store its
+    archive's ARX names. The store is only opened once a reference is met, so TAJ files holding their tweets cost
+    nothing extra.
+    """
+
+    def __init__(self, taj_file, fallback=None):
+        """
+        :param taj_file: Path to the TAJ file, inside its archive's directory
+        :param fallback: Directory of the store to use if the ARX names none, such as when it was lost
+        """
+        self.taj_file = str(taj_file)
+        self.fallback = fallback
+        self.store = None
+
+    def __call__(self, line):
+        """
+        :param line: Stripped line of the TAJ file
+        :return: The line's tweet as a JSON string, or None if it refers to a tweet missing from the store
+        :raise LookupError: If the line refers to a shared store, but the archive's ARX names none
+        """
+        if not line.startswith(REFERENCE_PREFIX):
+            return line
+        if self.store is None:
+            path = archive_store(os.path.dirname(os.path.abspath(self.taj_file))) or self.fallback
+            if path is None:
+                raise LookupError(self.taj_file + ' refers to a shared tweet store, but its ARX names none')
+            self.store = open_store(path)
+        try:
+            return self.store.get(reference_id(line))
+        except ValueError:
+            return None
+
+
+def open_store(path):
+    """
+    :param path: Directory of the store
+    :return: TweetStore, opened once per thread and process
+    """
+    if getattr(_local, 'pid', None) != os.getpid():
+        # Connections inherited from a parent process mustn't be used
+        _local.pid = os.getpid()
+        _local.stores = {}
+    key = os.path.realpath(path)
+    if key not in _local.stores:
+        _local.stores[key] = TweetStore(path)
+    return _local.stores[key]
+
+def archive_store(archive_dir):
+    """
+    :param archive_dir: Directory of an archive
+    :return: Directory of the shared store its ARX names, or None if it has none
+    """
+    key = os.path.realpath(archive_dir)
+    if key not in _archive_stores:
+        try:
+            with open(os.path.join(archive_dir, 'index.arx')) as fin:
+                path = json_codec.load(fin).get('store')
+        except (OSError, ValueError):
+            return None
+        # An archive never changes stores once it has one, so only found stores are remembered
+        if path is None:
+            return None
+        _archive_stores[key] = path
+    return _archive_stores[key]
+
+def make_reference(tweet_id, created_at):
+    """
+    Make the line a TAJ file holds for a tweet kept in a shared store. It keeps the tweet's ID and date, so the
+    archive's bounds, ordering and compaction work on it as they do on the tweet itself.
+    :param tweet_id: Tweet ID
+    :param created_at: The tweet's created_at string
+    :return: Reference line, without a line break
+    """
+    return REFERENCE_PREFIX + '"id":' + str(int(tweet_id)) + ',"created_at":' + json_codec.dumps(created_at) + '}'
+
+def reference_id(line):
+    """
+    :param line: Reference line made by make_reference
+    :return: The tweet ID it refers to
+    :raise ValueError: If the line is malformed
+    """
+    try:
+        return int(json_codec.loads(line)['id'])
+    except (KeyError, TypeError):
+        raise ValueError('Malformed shared tweet reference: ' + line)
+
+def share_tweets(path, tweets):
+    """
+    Put tweets in a shared store, and make the lines a TAJ file should hold for them instead. Tweets without an ID
+    or date are kept whole.
+    :param path: Directory of the store
+    :param tweets: List of tweet JSON strings
+    :return: List of lines for the TAJ file, in the same order
+    """
+    records = []; lines = []
+    for line in tweets:
+        try:
+            tweet = tweet_parser.LazyTweet(line)
+            tweet_id = tweet_parser.getTweetID(tweet)
+            created_at = tweet.get('created_at')
+        except ValueError:
+            tweet_id = created_at = None
+        if tweet_id is None or created_at is None or line.startswith(REFERENCE_PREFIX):
+            lines.append(line)
+            continue
+        records.append((tweet_id, line))
+        lines.append(make_reference(tweet_id, created_at))
+    if records:
+        open_store(path).put(records)
+    return lines
@@ -1,6 +1,7 @@
 from rauth import OAuth1Service
 import requests
 import time
+import json_codec
 from urllib.parse import quote
 from base64 import b64encode
 
@@ -152,7 +153,7 @@ def searchQuerySafe(session, creds, query, bounds, app_auth, retry_on_rate_limit
                 reply = searchQuery(session, query, bounds, verbose=False)
                 
                 try :
-                    data = reply.json()
+                    data = json_codec.response_json(reply)
                 except ValueError :
                     if brokentweetctr < 3 :
                         brokentweetctr += 1
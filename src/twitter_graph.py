@@ -1,64 +1,431 @@
-import time
-import networkx as nx
+import os, time
+import tempfile
+from array import array
 from tweet_parser import *
+from arx_mgr import scan_tweets, scan_size, scan_segments, iter_tweetfile
+import multiprocessing
+import edge_store
+import graph_writers
+import compact_graph
 
+# NetworkX is only needed for NetworkX output
+try:
+    import networkx as nx
+except ImportError:
+    nx = None
 
-def build_graph(tweetgen, directed=True, multigraph=False, replies=True, mentions=False, retweets=False, quotes=False):
+
+# Sparse matrix output is optional
+try:
+    import numpy as np
+    import scipy.sparse as sp
+except ImportError:
+    np = None
+    sp = None
+
+INDEX_BITS = 32
+INDEX_MASK = (1 << INDEX_BITS) - 1
+
+
+class EdgeSpool:
+    """
+    List-like stand-in for InteractionCounts.edges that keeps multigraph edges in a temporary file instead of memory,
+    so a multigraph can be written out one edge at a time however many interactions it has.
+    """
     
-    # Initialize the appropriate graph type
-    g = nx.Graph()
-    if directed:
-        if multigraph:
-            g = nx.MultiDiGraph()
-        else:
-            g = nx.DiGraph()
-    elif multigraph:
-        g = nx.MultiGraph()
+    def __init__(self):
+        self.fh = tempfile.TemporaryFile('w+')
+        self.length = 0
+    
+    def append(self, edge):
+        self.fh.write('%d %d %d %r\n' % edge)
+        self.length += 1
+    
+    def extend(self, edges):
+        for edge in edges:
+            self.append(edge)
+    
+    def __len__(self):
+        return self.length
+    
+    def __iter__(self):
+        self.fh.flush()
+        self.fh.seek(0)
+        for line in self.fh:
+            src, snk, tweet_id, timestamp = line.split()
+            yield int(src), int(snk), int(tweet_id), float(timestamp)
+        self.fh.seek(0, os.SEEK_END)
+
+
+class InteractionCounts:
+    """
+    Tally user interactions from a stream of tweets before building any graph. Users are numbered densely in the order
+    they first take part in an interaction, and edges are kept as counts keyed on a single integer packing the source
+    and sink numbers, so each interaction costs one dict update instead of several NetworkX lookups. Users are looked
+    up in a dict and keep one handle string each while counting; only the saved form is compact (see to_csr). Handles
+    are nearly unique per user, so interning them during the count would only add a dict entry per user.
+    """
     
-    # Iterate over tweets to build the user interaction graph
-    for tweet in tweetgen:
+    def __init__(self, directed=True, multigraph=False, replies=True, mentions=False, retweets=False, quotes=False,
+                 keep_pending=False):
+        """
+        :param keep_pending: Remember the latest handle of users who tweet here without taking part in an interaction.
+        Only a tally that will be merged into an earlier one needs them (see merge); a user's handle is otherwise
+        always set when they're numbered.
+        """
+        self.directed = directed
+        self.multigraph = multigraph
+        self.replies = replies
+        self.mentions = mentions
+        self.retweets = retweets
+        self.quotes = quotes
+        
+        self.index = {}     # user ID -> user number
+        self.ids = array('q') # user number -> user ID (packed 64-bit ints rather than Python objects)
+        self.handles = []   # user number -> latest screen name
+        self.pending = {} if keep_pending else None # user ID -> latest screen name, for users not yet in the graph
+        self.counts = {}    # (source number << 32 | sink number) -> number of interactions (weighted graphs)
+        self.edges = []     # (source number, sink number, tweet ID, POSIX timestamp) per interaction (multigraphs)
+        self.num_tweets = 0 # Tweets counted so far
+        
+        # Only the tweet fields these options need are extracted from each tweet (see tweet_parser.TweetExtractor)
+        self.fields = ('user_id', 'screen_name') + (('reply_tuple',) if replies else ()) + \
+                      (('user_mention_tuples',) if mentions else ()) + (('retweet_tuple',) if retweets else ()) + \
+                      (('quoted_user_tuple',) if quotes else ()) + (('tweet_id', 'created_at') if multigraph else ())
+    
+    def node(self, user_id):
+        """
+        Get a user's number, numbering them if they're new.
+        """
+        idx = self.index.get(user_id)
+        if idx is None:
+            idx = self.index[user_id] = len(self.ids)
+            self.ids.append(user_id)
+            self.handles.append(self.pending.pop(user_id, None) if self.pending else None)
+        return idx
+    
+    def add_tweet(self, tweet):
+        """
+        Count the interactions in one tweet.
+        :param tweet: Python dict containing a Twitter tweet object
+        """
+        self.add_record(get_extractor(*self.fields).extract(tweet))
+    
+    def add_record(self, record):
+        """
+        Count the interactions in one tweet, already extracted into a record with this tally's fields.
+        :param record: tweet_parser.TweetRecord from get_extractor(*self.fields)
+        """
+        self.num_tweets += 1
         
         # Get the ID of the user and each connection
-        source = (getUserID(tweet), getScreenName(tweet))
-        if source is None : continue    # If the user isn't valid, we can't add connections
+        source = (record.user_id, record.screen_name)
+        if source[0] is None : return     # If the user isn't valid, we can't add connections
         sinks = set()
-        if replies:
-            rID = getReplyTuple(tweet)
+        if self.replies:
+            rID = record.reply_tuple
             if rID is not None : sinks.add(rID)
-        if mentions:
-            mIDs = getUserMentionTuples(tweet)
-            if mIDs is not None : sinks.update(mIDs)
-        if retweets:
-            rID = getRetweetTuple(tweet)
+        if self.mentions:
+            sinks.update(record.user_mention_tuples)
+        if self.retweets:
+            rID = record.retweet_tuple
             if rID is not None : sinks.add(rID)
-        if quotes:
-            qID = getQuotedUserTuple(tweet)
+        if self.quotes:
+            qID = record.quoted_user_tuple
             if qID is not None : sinks.add(qID)
         sinks.discard(source)
         
-        if multigraph:
-            tweet_id = getTweetID(tweet)
-            timestamp = time.mktime(getTimeStamp(tweet).timetuple())
+        if sinks:
+            if self.multigraph:
+                tweet_id = record.tweet_id
+                timestamp = time.mktime(read_timestamp(record.created_at).timetuple())
+            src = self.node(source[0])
+            for sink in sinks:
+                snk = self.node(sink[0])
+                if self.multigraph:
+                    self.edges.append((src, snk, tweet_id, timestamp))
+                else:
+                    self.count(src, snk, 1)
+                self.handles[snk] = sink[1]
+        
+        # Users only carry a handle once they're in the graph; remember it for an earlier tally they may be in
+        idx = self.index.get(source[0])
+        if idx is not None:
+            self.handles[idx] = source[1]
+        elif self.pending is not None:
+            self.pending[source[0]] = source[1]
+    
+    def count(self, src, snk, weight):
+        """
+        Add weight to the edge between two user numbers.
+        """
+        if not self.directed and self.ids[snk] < self.ids[src]:
+            src, snk = snk, src
+        key = (src << INDEX_BITS) | snk
+        self.counts[key] = self.counts.get(key, 0) + weight
+    
+    def update(self, tweetgen):
+        """
+        Count the interactions in every tweet from an iterator.
+        :param tweetgen: Iterator over tweet objects
+        :return: self
+        """
+        add_record = self.add_record
+        for record in get_extractor(*self.fields).extract_iter(tweetgen):
+            add_record(record)
+        return self
+    
+    def merge(self, other):
+        """
+        Fold in the counts from tweets that come after this tally's tweets in scan order, such as the next archive
+        segment. The result is the same as if one tally had counted both streams back to back.
+        :param other: InteractionCounts built with the same options, and with keep_pending so the latest handles of
+        users already in this tally carry over
+        :return: self
+        """
+        remap = [self.node(user_id) for user_id in other.ids]
+        for key, weight in other.counts.items():
+            self.count(remap[key >> INDEX_BITS], remap[key & INDEX_MASK], weight)
+        self.edges.extend((remap[src], remap[snk], tweet_id, timestamp)
+                          for src, snk, tweet_id, timestamp in other.edges)
+        
+        # The later tweets have the latest handles
+        for idx, handle in zip(remap, other.handles):
+            self.handles[idx] = handle
+        # Users outside this graph get their handle from a later tweet when they join, so theirs aren't kept
+        for user_id, handle in (other.pending or {}).items():
+            idx = self.index.get(user_id)
+            if idx is not None:
+                self.handles[idx] = handle
+        self.num_tweets += other.num_tweets
+        return self
+    
+    def iter_edges(self):
+        """
+        :return: Generator over (source ID, sink ID, weight) for weighted graphs, or
+        (source ID, sink ID, tweet ID, timestamp) for multigraphs
+        """
+        ids = self.ids
+        if self.multigraph:
+            for src, snk, tweet_id, timestamp in self.edges:
+                yield ids[src], ids[snk], tweet_id, timestamp
         else:
-            tweet_id = None
-            timestamp = None
+            for key, weight in self.counts.items():
+                yield ids[key >> INDEX_BITS], ids[key & INDEX_MASK], weight
+    
+    def to_networkx(self):
+        """
+        Build the NetworkX graph in bulk.
+        :return: NetworkX Graph, DiGraph, MultiGraph or MultiDiGraph with a 'handle' on each node
+        """
+        if nx is None:
+            raise ImportError('NetworkX library is required for this feature.')
         
-        # Iterate over connections to populate the graph
-        for sink in sinks:
-            if multigraph:
-                tweet_id = getTweetID(tweet)
-                # Add a new edge, attach Tweet ID as key and POSIX timestamp as an edge property
-                g.add_edge(source[0], sink[0], key=tweet_id, timestamp=timestamp)
-                pass
+        # Initialize the appropriate graph type
+        g = nx.Graph()
+        if self.directed:
+            if self.multigraph:
+                g = nx.MultiDiGraph()
             else:
-                # Add weight to an existing edge if possible, otherwise add an edge
-                if g.has_edge(source[0], sink[0]):
-                    g.edges[source[0], sink[0]]['weight'] += 1
-                else:
-                    g.add_edge(source[0], sink[0])
-                    g.edges[source[0], sink[0]]['weight'] = 1
-            g.node[sink[0]]['handle'] = sink[1]
-        if g.has_node(source[0]) : g.node[source[0]]['handle'] = source[1]
-            
-    return g
+                g = nx.DiGraph()
+        elif self.multigraph:
+            g = nx.MultiGraph()
+        
+        g.add_nodes_from((user_id, {'handle':handle}) for user_id, handle in zip(self.ids, self.handles))
+        if self.multigraph:
+            g.add_edges_from((src, snk, tweet_id, {'timestamp':timestamp})
+                             for src, snk, tweet_id, timestamp in self.iter_edges())
+        else:
+            g.add_weighted_edges_from(self.iter_edges())
+        return g
+    
+    def to_sparse(self):
+        """
+        Build a SciPy sparse adjacency matrix, with rows and columns in user-number order. Entry (i, j) is the number
+        of interactions from user i to user j; undirected graphs give a symmetric matrix.
+        :return: Tuple of (scipy.sparse.csr_matrix) adjacency, (numpy int64 array) user ID of each row,
+        (list) handle of each row
+        """
+        if sp is None:
+            raise ImportError('SciPy library is required for sparse adjacency output.')
+        n = len(self.ids)
+        if self.multigraph:
+            rows = np.fromiter((edge[0] for edge in self.edges), dtype=np.int64, count=len(self.edges))
+            cols = np.fromiter((edge[1] for edge in self.edges), dtype=np.int64, count=len(self.edges))
+            weights = np.ones(len(self.edges), dtype=np.int64)
+        else:
+            keys = np.fromiter(self.counts.keys(), dtype=np.int64, count=len(self.counts))
+            rows = keys >> INDEX_BITS
+            cols = keys & INDEX_MASK
+            weights = np.fromiter(self.counts.values(), dtype=np.int64, count=len(self.counts))
+        adjacency = sp.coo_matrix((weights, (rows, cols)), shape=(n, n)).tocsr()    # Duplicates are summed
+        if not self.directed:
+            adjacency = adjacency + adjacency.T - sp.diags(adjacency.diagonal(), dtype=adjacency.dtype)
+        return adjacency.tocsr(), np.array(self.ids, dtype=np.int64), list(self.handles)
+    
+    def to_csr(self):
+        """
+        Build the compact, memory-mappable form of the graph, keeping these user numbers.
+        :return: compact_graph.CSRGraph
+        """
+        return compact_graph.CSRGraph.from_counts(self)
+
+
+def count_segment(args):
+    """
+    Count the interactions in one TAJ file. This is the map step of count_interactions, run in a worker process.
+    :param args: Tuple of (TAJ path, (min_id, max_id, min_date, max_date), InteractionCounts options as a tuple,
+    tweet_filter.Filter or None)
+    :return: InteractionCounts for the file
+    """
+    taj_file, bounds, options, where = args
+    return InteractionCounts(*options, keep_pending=True).update(iter_tweetfile(taj_file, *bounds, where=where,
+                                                                                users=False))
+
+def stored_counts(data, options):
+    """
+    Turn a segment's edge store (see edge_store.tally_segment) into the InteractionCounts a scan would give.
+    :param data: Edge store dictionary
+    :param options: InteractionCounts options as a tuple
+    :return: InteractionCounts
+    """
+    counts = InteractionCounts(*options, keep_pending=True)
+    mask = edge_store.type_mask(*options[2:])
+    for src, snk, types, num in data['counts']:
+        if types & mask:
+            counts.count(counts.node(src), counts.node(snk), num)
+    for user_id, handle in data['handles']:
+        idx = counts.index.get(user_id)
+        if idx is not None:
+            counts.handles[idx] = handle
+        else:
+            counts.pending[user_id] = handle
+    counts.num_tweets = data['num_tweets']
+    return counts
+
+def within_bounds(entry, min_id, max_id, min_date, max_date):
+    """
+    Check whether every tweet in a TAJ falls inside the bounds, so its stored counts can be used whole.
+    :param entry: ARX entry of the TAJ
+    :return: True if no tweet in the TAJ could be filtered out by the bounds
+    """
+    if min_id is None and max_id is None and min_date == -1 and max_date == float('inf'):
+        return True
+    try:
+        fstart_date = time.mktime(read_timestamp(entry[3]).timetuple())
+        fstop_date = time.mktime(read_timestamp(entry[4]).timetuple())
+        return (min_id is None or entry[1] >= min_id) and (max_id is None or entry[2] <= max_id) and \
+               min_date <= fstart_date and fstop_date <= max_date
+    except:
+        return False
+
+def count_interactions(job, min_id=None, max_id=None, min_date=None, max_date=None, directed=True, multigraph=False,
+                       replies=True, mentions=False, retweets=False, quotes=False, processes=1, task=None,
+                       use_store=True, spool_edges=False, where=None):
+    """
+    Count the user interactions in an archive. With more than one process, each worker counts whole TAJ files and
+    the results are merged in scan order, which gives exactly the same result as a serial scan. Finished TAJs with
+    an up-to-date edge store (see edge_store) are read from the store instead of being parsed, unless a multigraph is
+    requested, the bounds cut through the TAJ or the tweets are filtered; the latest handle seen in the TAJ is then
+    used for each user.
+    :param job: Job dictionary with a path to an archive, or a tweet file (see arx_mgr.resolve_archive)
+    :param processes: Number of worker processes (None for one per CPU)
+    :param task: Optional task_mgr.Task to report progress to and check for cancellation
+    :param use_store: Use the archive's edge store where possible
+    :param spool_edges: Keep multigraph edges in a temporary file rather than in memory (see EdgeSpool)
+    :param where: Optional tweet_filter.Filter; only matching tweets are counted (see arx_mgr.scan_tweets)
+    :return: InteractionCounts
+    """
+    options = (directed, multigraph, replies, mentions, retweets, quotes)
+    counts = InteractionCounts(*options)
+    if multigraph and spool_edges: counts.edges = EdgeSpool()
+    if task is not None:
+        task.expect(*scan_size(job, min_id, max_id, min_date, max_date, where))
+    
+    # Reading a single file, not an ARX
+    if type(job) is not dict:
+        if task is None:
+            tweetgen = scan_tweets(job, min_id, max_id, min_date, max_date, where=where, users=False)
+        else:
+            tweetgen = task.track(scan_tweets(job, min_id, max_id, min_date, max_date, on_segment=task.segment_done,
+                                              where=where, users=False))
+        return counts.update(tweetgen)
+    
+    if min_date is None: min_date = -1
+    if max_date is None: max_date = float('inf')
+    bounds = (min_id, max_id, min_date, max_date)
+    
+    # Find the finished segments whose counts are already stored
+    segments = scan_segments(job, *bounds, **(where.summary() if where is not None else {}))
+    unfinished = job['arx']['unfinished']
+    stored = [None] * len(segments)
+    # The store holds every tweet's interactions, so it can't answer for a filtered scan
+    if use_store and not multigraph and where is None:
+        for idx, entry in enumerate(segments):
+            if entry is not unfinished and within_bounds(entry, *bounds):
+                stored[idx] = edge_store.load_segment(job, entry)
+    work = [(str(entry[0]), bounds, options, where) for entry, data in zip(segments, stored) if data is None]
+    
+    # Map each remaining segment to a worker, reduce all the partial counts in order
+    if processes == 1 or len(work) < 2:
+        parts = map(count_segment, work)
+        pool = None
+    else:
+        pool = multiprocessing.Pool(processes)
+        parts = pool.imap(count_segment, work)
+    try:
+        for entry, data in zip(segments, stored):
+            part = stored_counts(data, options) if data is not None else next(parts)
+            counts.merge(part)
+            if task is not None:
+                task.tweets_scanned += part.num_tweets
+                task.segment_done(entry)
+    finally:
+        if pool is not None: pool.terminate()
+    return counts
+
+def build_graph(tweetgen, directed=True, multigraph=False, replies=True, mentions=False, retweets=False, quotes=False):
+    """
+    Build the user interaction graph from a stream of tweets.
+    :param tweetgen: Iterator over tweet objects
+    :param directed: Build a directed graph
+    :param multigraph: One edge per interaction instead of weighted edges
+    :param replies: Count replies as interactions
+    :param mentions: Count mentions as interactions
+    :param retweets: Count retweets as interactions
+    :param quotes: Count quote retweets as interactions
+    :return: NetworkX graph with a 'handle' on each node and a 'weight' (or 'timestamp' for multigraphs) on each edge
+    """
+    counts = InteractionCounts(directed, multigraph, replies, mentions, retweets, quotes)
+    return counts.update(tweetgen).to_networkx()
+
+def build_adjacency(tweetgen, directed=True, multigraph=False, replies=True, mentions=False, retweets=False,
+                    quotes=False):
+    """
+    Build the user interaction graph from a stream of tweets as a SciPy sparse matrix, for callers that don't need
+    NetworkX. Parameters are the same as for build_graph.
+    :return: Tuple of (scipy.sparse.csr_matrix) adjacency, (numpy array) user IDs, (list) handles
+    """
+    counts = InteractionCounts(directed, multigraph, replies, mentions, retweets, quotes)
+    return counts.update(tweetgen).to_sparse()
 
+def export_graph(job, outfile, min_id=None, max_id=None, min_date=None, max_date=None, directed=True,
+                 multigraph=False, replies=True, mentions=False, retweets=False, quotes=False, processes=1, where=None,
+                 task=None):
+    """
+    Build the user interaction graph for an archive and write it to file. The format is chosen from the extension:
+    .gexf for GEXF, .csv for CSV edge and node lists, and GML otherwise; add .gz, .bz2 or .xz to compress it. The
+    graph is written straight from its interaction counts, and multigraph edges are spooled to disk, so NetworkX
+    isn't needed and memory stays bounded by the number of users and weighted edges.
+    :param job: Job dictionary with a path to an archive, or a tweet file (see arx_mgr.resolve_archive)
+    :param outfile: Path of the file to write
+    :param processes: Number of worker processes to scan the archive with (None for one per CPU)
+    :param where: Optional tweet_filter.Filter; only interactions in matching tweets are counted
+    :param task: Optional task_mgr.Task to report progress to and check for cancellation
+    :return: Tuple of (int) number of nodes, (int) number of edges written
+    """
+    counts = count_interactions(job, min_id, max_id, min_date, max_date, directed, multigraph,
+                                replies, mentions, retweets, quotes, processes, task, spool_edges=True, where=where)
+    if task is not None: task.check()
+    graph_writers.write_graph(counts, outfile)
+    return len(counts.ids), len(counts.edges) if multigraph else len(counts.counts)
@@ -0,0 +1,199 @@
+import os
+import re
+import sqlite3
+import threading
+from hashlib import blake2b
+import json_codec
+import tweet_parser
+
+# Database of an archive's user profiles, inside the archive's directory
+DICT_FILE = 'users.db'
+
+# Key naming the profile a user object stands in for
+STUB_KEY = '$user'
+
+# A stand-in user object as json_codec.dumps writes it (see make_stub); screen names never hold braces
+_STUB = re.compile(r'\{"\$user": "([0-9a-f]+)"[^{}]*\}')
+
+# tweet_parser fields a stand-in answers without the profile
+STUB_FIELDS = ('user_id', 'screen_name', 'retweet_id', 'retweet_tuple', 'quoted_user_id', 'quoted_user_tuple')
+
+# Profiles kept in memory per dictionary; active accounts appear in thousands of tweets per segment
+CACHE_SIZE = 100000
+
+# Open dictionaries by archive directory, kept per thread since SQLite connections can't be shared between threads
+_local = threading.local()
+
+
+class UserDictionary:
+    """
+    The distinct states of the user profiles in an archive's tweets, each stored once in an SQLite database beside
+    the TAJ files and keyed by a hash of the profile. When a profile changes, such as a user's follower count, the new
+    state is added as another version. Archives of jobs with a user_dictionary keep only a small stand-in for each
+    user object in their TAJ files (see make_stub), which readers swap back for the profile (see Rehydrator).
+    """
+
+    def __init__(self, archive_dir):
+        """
+        :param archive_dir: Directory of the archive
+        """
+        self.path = os.path.join(archive_dir, DICT_FILE)
+        self.db = sqlite3.connect(self.path, timeout=60)
+        # Write-ahead logging lets scans read while the collector writes
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('CREATE TABLE IF NOT EXISTS profiles (key TEXT PRIMARY KEY, user_id INTEGER, '
+                        'first_seen INTEGER, body TEXT NOT NULL)')
+        self.db.execute('CREATE INDEX IF NOT EXISTS profiles_by_user ON profiles (user_id, first_seen)')
+        self.db.commit()
+        self.cache = {}
+
+    def put(self, profiles):
+        """
+        Store profile states, in one transaction. States already stored are left as they are.
+        :param profiles: List of (key, user ID, ID of the first tweet the state was seen in, profile JSON string)
+        :return: Number of states that weren't stored before
+        """
+        with self.db:
+            before = self.db.total_changes
+            self.db.executemany('INSERT OR IGNORE INTO profiles (key, user_id, first_seen, body) VALUES (?, ?, ?, ?)',
+                                profiles)
+            return self.db.total_changes - before
+
+    def get(self, key):
+        """
+        :param key: Key of a profile state (see profile_key)
+        :return: The profile's JSON string, or None if it isn't stored
+        """
+        body = self.cache.get(key)
+        if body is None:
+            row = self.db.execute('SELECT body FROM profiles WHERE key = ?', (key,)).fetchone()
+            if row is None:
+                return None
+            if len(self.cache) >= CACHE_SIZE:
+                self.cache.clear()
+            body = self.cache[key] = row[0]
+        return body
+
+    def versions(self, user_id):
+        """
+        :param user_id: User ID
+        :return: List of (ID of the first tweet it was seen in, profile dict) for each state of the user's profile,
+        oldest first
+        """
+        rows = self.db.execute('SELECT first_seen, body FROM profiles WHERE user_id = ? ORDER BY first_seen',
+                               (int(user_id),))
+        return [(first_seen, json_codec.loads(body)) for first_seen, body in rows]
+
+    def __len__(self):
+        return self.db.execute('SELECT COUNT(*) FROM profiles').fetchone()[0]
+
+
+class Rehydrator:
+    """
+    Swaps the stand-in user objects in the lines of a TAJ file back for the full profiles, from its archive's user
+    dictionary. The dictionary is only opened once a stand-in is met. A stand-in whose profile is missing is left as
+    it is, so the user ID and screen name can still be read.
+    """
+
+    def __init__(self, taj_file):
+        """
+        :param taj_file: Path to the TAJ file, inside its archive's directory
+        """
+        self.archive_dir = os.path.dirname(os.path.abspath(str(taj_file)))
+        self.dictionary = None
+
+    def __call__(self, line):
+        """
+        :param line: Stripped line of the TAJ file, or None
+        :return: The line with every user object whole
+        """
+        if not line or '{"$user": "' not in line:
+            return line
+        if self.dictionary is None:
+            self.dictionary = open_dictionary(self.archive_dir)
+            if self.dictionary is None:
+                return line
+        return _STUB.sub(lambda match : self.dictionary.get(match.group(1)) or match.group(0), line)
+
+
+def open_dictionary(archive_dir, create=False):
+    """
+    :param archive_dir: Directory of an archive
+    :param create: Create the dictionary if the archive has none
+    :return: UserDictionary, opened once per thread and process, or None if the archive has none
+    """
+    if getattr(_local, 'pid', None) != os.getpid():
+        # Connections inherited from a parent process mustn't be used
+        _local.pid = os.getpid()
+        _local.dictionaries = {}
+    key = os.path.realpath(archive_dir)
+    if key not in _local.dictionaries:
+        if not create and not os.path.exists(os.path.join(archive_dir, DICT_FILE)):
+            return None
+        _local.dictionaries[key] = UserDictionary(archive_dir)
+    return _local.dictionaries[key]
+
+def needs_profiles(fields):
+    """
+    :param fields: Names of tweet_parser fields
+    :return: True if any of them reads more of a user object than a stand-in holds
+    """
+    return any(tweet_parser.FIELDS[field][0] in ('user', 'retweeted', 'quoted') and field not in STUB_FIELDS
+               for field in fields)
+
+def profile_key(body):
+    """
+    :param body: Profile JSON string
+    :return: Key of the profile state, a hash of the JSON
+    """
+    return blake2b(body.encode('utf-8'), digest_size=8).hexdigest()
+
+def make_stub(key, user):
+    """
+    Make the stand-in a TAJ line holds for a user object kept in the dictionary. It keeps the user's ID and screen
+    name, so tweet_parser's getters and extractors read those without the profile.
+    :param key: Key of the profile state
+    :param user: The user object
+    :return: Stand-in dict
+    """
+    stub = {STUB_KEY : key}
+    for name in ('id', 'id_str', 'screen_name'):
+        if name in user: stub[name] = user[name]
+    return stub
+
+def normalize_tweets(archive_dir, tweets):
+    """
+    Move the user objects of tweets, including those of the tweets they retweet or quote, into an archive's user
+    dictionary, and make the lines its TAJ file should hold instead. Rehydrating a line gives back the original
+    exactly, since lines are written with json_codec.dumps.
+    :param archive_dir: Directory of the archive
+    :param tweets: List of tweet JSON strings
+    :return: List of lines for the TAJ file, in the same order
+    """
+    profiles = {}; lines = []
+    for line in tweets:
+        try:
+            tweet = json_codec.loads(line)
+        except ValueError:
+            lines.append(line)
+            continue
+        if not isinstance(tweet, dict):
+            lines.append(line)
+            continue
+        tweet_id = tweet_parser.getTweetID(tweet)
+        changed = False
+        holders = [tweet, tweet.get('retweeted_status'), tweet.get('quoted_status')]
+        if isinstance(holders[1], dict): holders.append(holders[1].get('quoted_status'))
+        for holder in holders:
+            user = holder.get('user') if isinstance(holder, dict) else None
+            if not isinstance(user, dict) or user.get('id') is None or STUB_KEY in user:
+                continue
+            body = json_codec.dumps(user)
+            key = profile_key(body)
+            if key not in profiles: profiles[key] = (key, user['id'], tweet_id, body)
+            holder['user'] = make_stub(key, user)
+            changed = True
+        lines.append(json_codec.dumps(tweet) if changed else line)
+    if profiles:
+        open_dictionary(archive_dir, create=True).put(list(profiles.values()))
+    return lines
@@ -0,0 +1,291 @@
+import os
+import time
+import json
+import shutil
+import multiprocessing
+import json_codec
+import tweet_parser
+import tweet_store
+from arx_mgr import SUMMARY_FIELDS, archive_lock, first_bound, get_stat, last_bound, new_arx, summarize_records, \
+    write_arx
+
+# Number of bad lines listed by line number for each file; the rest are only counted
+MAX_LISTED = 20
+
+# Tweet fields each line is checked for
+FIELDS = ('tweet_id', 'date', 'timestamp') + SUMMARY_FIELDS
+
+
+def scan_file(args):
+    """
+    Check every line of one TAJ file. This is the map step of verify_archive, run in a worker process.
+
+    Finished TAJ files are written as a series of new-to-old runs, one per unfinished TAJ that was finalized into
+    them, with each run newer than the last; unfinished TAJ files are old-to-new. A tweet is out of order if it
+    breaks this, by falling in an unfinished TAJ or rising to no new high in a finished one.
+    :param args: Tuple of (TAJ path, True if it's a finished TAJ, True to summarize it as summarize_taj does, the
+    shared store to read its tweets from if its ARX names none)
+    :return: Dictionary with the number of 'tweets', 'bad_lines' (with up to MAX_LISTED 'bad_line_numbers'),
+    tweets 'unresolved' (referred to, but missing from, the archive's shared store), 'out_of_order' and 'duplicates', the lowest and highest tweet IDs ('min_id', 'max_id') and the dates of
+    those tweets ('min_date', 'max_date'), the range of POSIX times ('min_time', 'max_time'), and the 'summary'
+    """
+    taj_file, finished, summarize, store = args
+    extract = tweet_parser.get_extractor(*FIELDS).extract
+    stats = {'tweets' : 0, 'bad_lines' : 0, 'bad_line_numbers' : [], 'unresolved' : 0, 'out_of_order' : 0,
+             'duplicates' : 0, 'min_id' : None, 'max_id' : None, 'min_date' : None, 'max_date' : None,
+             'min_time' : None, 'max_time' : None, 'summary' : None}
+    seen = set()
+
+    def records():
+        prev_id = None
+        resolve = tweet_store.Resolver(taj_file, store)
+        with open(taj_file, 'rb') as fin:
+            for line_no, line in enumerate(fin, 1):
+                line = line.decode('utf-8', 'ignore').strip()
+                if not line: continue
+                try:
+                    body = resolve(line)
+                    if body is None:
+                        stats['unresolved'] += 1
+                        continue
+                    record = extract(json_codec.loads(body))
+                    posix_time = time.mktime(record.timestamp.timetuple())
+                    tweet_id = int(record.tweet_id)
+                except Exception:
+                    stats['bad_lines'] += 1
+                    if len(stats['bad_line_numbers']) < MAX_LISTED: stats['bad_line_numbers'].append(line_no)
+                    continue
+
+                if tweet_id in seen:
+                    stats['duplicates'] += 1
+                seen.add(tweet_id)
+                if prev_id is not None:
+                    if not finished:
+                        if tweet_id < prev_id: stats['out_of_order'] += 1
+                    # A rise starts the next run, which must be newer than everything before it
+                    elif prev_id < tweet_id <= stats['max_id']:
+                        stats['out_of_order'] += 1
+                prev_id = tweet_id
+
+                stats['tweets'] += 1
+                if stats['min_id'] is None or tweet_id < stats['min_id']:
+                    stats['min_id'] = tweet_id; stats['min_date'] = record.date
+                if stats['max_id'] is None or tweet_id > stats['max_id']:
+                    stats['max_id'] = tweet_id; stats['max_date'] = record.date
+                if stats['min_time'] is None or posix_time < stats['min_time']: stats['min_time'] = posix_time
+                if stats['max_time'] is None or posix_time > stats['max_time']: stats['max_time'] = posix_time
+                yield record
+
+    if summarize:
+        stats['summary'] = summarize_records(records())
+    else:
+        for record in records(): pass
+    return stats
+
+def read_arx(job):
+    """
+    :param job: Job dictionary with a path to an archive
+    :return: The archive's ARX dictionary, or None if it's missing or unreadable
+    """
+    try:
+        with open(job['path'] + '/index.arx') as fin:
+            return json_codec.load(fin)
+    except (OSError, ValueError):
+        return None
+
+def expected_entries(finished, unfinished):
+    """
+    Build the ARX entries the data calls for, following the conventions finalize_taj and append_current_tweets use:
+    each entry's lower bounds are the upper bounds of the one before, or just below the first tweet for the first.
+    :param finished: List of (filename, scan_file statistics) of the finished TAJ files, in ID order
+    :param unfinished: Tuple of (filename, scan_file statistics) of the unfinished TAJ, or None
+    :return: Tuple of the list of finished entries, and the unfinished entry (or None)
+    """
+    prior_id = None; prior_date = None
+    entries = []
+    for name, stats in finished:
+        entries.append([name, prior_id if prior_id is not None else stats['min_id'] - 1, stats['max_id'],
+                        prior_date if prior_date is not None else stats['min_date'], stats['max_date'],
+                        stats['tweets'], stats['summary']])
+        prior_id = stats['max_id']; prior_date = stats['max_date']
+    entry = None
+    if unfinished is not None:
+        name, stats = unfinished
+        entry = [name, prior_id if prior_id is not None else stats['min_id'], stats['max_id'],
+                 prior_date if prior_date is not None else stats['min_date'], stats['max_date'], stats['tweets']]
+    return entries, entry
+
+def compare_entry(actual, expected, stats):
+    """
+    :param actual: ARX entry as found in the ARX
+    :param expected: ARX entry the data calls for
+    :param stats: scan_file statistics of the TAJ
+    :return: List of descriptions of what's wrong with the actual entry
+    """
+    problems = []
+    if actual[5] != expected[5]:
+        problems.append('lists ' + str(actual[5]) + ' tweets, holds ' + str(expected[5]))
+    if actual[2] != expected[2]:
+        problems.append('upper ID bound ' + str(actual[2]) + ' should be ' + str(expected[2]))
+    if actual[4] != expected[4]:
+        problems.append('upper date ' + str(actual[4]) + ' should be ' + str(expected[4]))
+    # Lower bounds above the data make scans skip tweets they should read
+    if actual[1] is not None and actual[1] >= stats['min_id']:
+        problems.append('lower ID bound ' + str(actual[1]) + ' is not below the first tweet, ' + str(stats['min_id']))
+    lower_date = tweet_parser.read_timestamp(actual[3]) if actual[3] else None
+    if lower_date is not None and time.mktime(lower_date.timetuple()) > stats['min_time']:
+        problems.append('lower date ' + str(actual[3]) + ' is after the first tweet')
+    return problems
+
+def verify_archive(job, rebuild=False, processes=1, task=None):
+    """
+    Check every TAJ file in an archive against its ARX, reading the files in parallel. Finds malformed lines, tweets
+    out of order or repeated within a file, TAJ files whose ID ranges overlap, files missing from the disk or from
+    the ARX, and ARX entries with the wrong bounds or counts. Can then rebuild the ARX from the data, which also
+    recovers an archive whose index.arx was lost.
+
+    Without an ARX to go by, every tweets-*.taj file is taken as finished, and the new-tweets-*.taj file holding
+    tweets newer than all of them as unfinished; the others are left over from earlier finalize_taj calls. Files an
+    ARX lists as retired by compaction are ignored.
+    :param job: Job dictionary with a path to an archive
+    :param rebuild: Replace the ARX with one built from the data (the old one is kept as index.arx.bak). Stop the
+    job's collection first.
+    :param processes: Number of worker processes (None for one per CPU)
+    :param task: Optional task_mgr.Task to report progress to and check for cancellation
+    :return: Report dictionary with the statistics of each file scanned (see scan_file), the 'issues' found (each a
+    dictionary of 'file', 'problem' and 'detail'), the number of 'tweets', and whether the ARX was 'rebuilt'
+    """
+    path = job['path']
+    arx = read_arx(job)
+    issues = []
+    def issue(name, problem, detail=''):
+        issues.append({'file' : name, 'problem' : problem, 'detail' : detail})
+
+    if arx is None:
+        issue('index.arx', 'missing or unreadable')
+        listed = []; listed_unfinished = None; retired = set()
+    else:
+        listed = [entry[0] for entry in arx['finished'] or []]
+        listed_unfinished = arx['unfinished'][0] if arx['unfinished'] is not None else None
+        retired = set(item[0] for item in arx.get('retired', []))
+    on_disk = set(name for name in os.listdir(path) if name.endswith('.taj') and name not in retired)
+    for name in listed + [listed_unfinished]:
+        if name is not None and name not in on_disk: issue(name, 'missing', 'listed in the ARX but not on disk')
+
+    # Read every finished TAJ, and the unfinished one, in parallel
+    finished_names = sorted(name for name in on_disk if name.startswith('tweets-'))
+    store = job.get('shared_store')
+    work = [(os.path.join(path, name), True, rebuild, store) for name in finished_names]
+    if listed_unfinished in on_disk: work.append((os.path.join(path, listed_unfinished), False, False, store))
+    if task is not None: task.expect(len(work), sum(entry[5] for entry in arx['finished'] or []) if arx else None)
+    if processes == 1 or len(work) < 2:
+        results = map(scan_file, work)
+        pool = None
+    else:
+        pool = multiprocessing.Pool(processes)
+        results = pool.imap(scan_file, work)
+    scanned = {}
+    try:
+        for args, stats in zip(work, results):
+            scanned[os.path.basename(args[0])] = stats
+            if task is not None:
+                task.tweets_scanned += stats['tweets']
+                task.segment_done(args[0])
+    finally:
+        if pool is not None: pool.terminate()
+
+    # Find the unfinished TAJ among the leftovers if the ARX doesn't name one
+    maxima = [scanned[name]['max_id'] for name in finished_names if scanned[name]['max_id'] is not None]
+    finished_max = max(maxima) if maxima else None
+    unfinished = listed_unfinished if listed_unfinished in scanned else None
+    if unfinished is None:
+        newest = None
+        for name in sorted(name for name in on_disk if name.startswith('new-tweets-')):
+            first_id = first_bound(os.path.join(path, name))[0]
+            last_id = last_bound(os.path.join(path, name))[0]
+            if first_id is None or last_id is None or (finished_max is not None and first_id <= finished_max):
+                continue
+            if newest is None or last_id > newest[1]: newest = (name, last_id)
+        if newest is not None:
+            unfinished = newest[0]
+            scanned[unfinished] = scan_file((os.path.join(path, unfinished), False, False, store))
+            if task is not None: task.tweets_scanned += scanned[unfinished]['tweets']
+            if arx is not None: issue(unfinished, 'unlisted', 'newer than every finished TAJ, but not in the ARX')
+
+    # Problems within each file
+    for name in sorted(scanned):
+        stats = scanned[name]
+        if stats['bad_lines']:
+            issue(name, 'malformed lines', str(stats['bad_lines']) + ' lines, at line numbers ' +
+                  ', '.join(map(str, stats['bad_line_numbers'])) +
+                  (' and more' if stats['bad_lines'] > len(stats['bad_line_numbers']) else ''))
+        if stats['unresolved']:
+            issue(name, 'missing from shared store', str(stats['unresolved']) + ' tweets referred to')
+        if stats['out_of_order']: issue(name, 'out of order', str(stats['out_of_order']) + ' tweets')
+        if stats['duplicates']: issue(name, 'duplicates', str(stats['duplicates']) + ' repeated tweet IDs')
+        if stats['tweets'] == 0 and name != unfinished: issue(name, 'empty', 'holds no tweets')
+        if arx is not None and name in finished_names and name not in listed:
+            issue(name, 'unlisted', 'finished TAJ not in the ARX')
+
+    # Problems between files, in ID order
+    ordered = sorted((stats['min_id'], name) for name, stats in scanned.items()
+                     if stats['tweets'] and (name in finished_names or name == unfinished))
+    for (prev_min, prev), (next_min, name) in zip(ordered, ordered[1:]):
+        if next_min <= scanned[prev]['max_id']:
+            issue(name, 'overlap', 'IDs from ' + str(next_min) + ' overlap ' + prev + ', up to ' +
+                  str(scanned[prev]['max_id']))
+    if arx is not None and [name for name in listed if name in scanned and scanned[name]['tweets']] != \
+            [name for min_id, name in ordered if name in listed]:
+        issue('index.arx', 'out of order', 'finished TAJ files are not listed in ID order')
+
+    # Compare the ARX with what the data calls for
+    finished = [(name, scanned[name]) for min_id, name in ordered if name != unfinished]
+    entries, unfinished_entry = expected_entries(finished, (unfinished, scanned[unfinished])
+                                                 if unfinished is not None and scanned[unfinished]['tweets'] else None)
+    if arx is not None:
+        expected = {entry[0] : entry for entry in entries + [unfinished_entry] if entry is not None}
+        for entry in (arx['finished'] or []) + ([arx['unfinished']] if arx['unfinished'] is not None else []):
+            if entry[0] in expected and entry[0] in scanned:
+                for problem in compare_entry(entry, expected[entry[0]], scanned[entry[0]]):
+                    issue(entry[0], 'wrong entry', problem)
+
+    if rebuild:
+        rebuild_arx(job, arx, entries, unfinished_entry)
+    for stats in scanned.values():
+        del stats['summary']
+    return {'files' : scanned, 'issues' : issues, 'tweets' : sum(stats['tweets'] for stats in scanned.values()),
+            'rebuilt' : rebuild}
+
+def rebuild_arx(job, arx, entries, unfinished_entry):
+    """
+    Replace an archive's ARX with entries built from its data, keeping the rest of the old ARX (such as its query).
+    :param job: Job dictionary with a path to an archive (and its keywords, if the old ARX is lost)
+    :param arx: The old ARX dictionary, or None if it's lost
+    :param entries: Finished ARX entries (see expected_entries)
+    :param unfinished_entry: Unfinished ARX entry, or None
+    """
+    arx_path = job['path'] + '/index.arx'
+    if arx is None:
+        arx = new_arx(job) if 'keywords' in job else {'query' : None, 'filters' : None}
+        if job.get('shared_store'): arx['store'] = job['shared_store']
+    elif os.path.exists(arx_path):
+        shutil.copyfile(arx_path, arx_path + '.bak')
+    arx['finished'] = entries
+    arx['unfinished'] = unfinished_entry
+    arx['revision'] = arx.get('revision', 0) + 1
+    with archive_lock(job):
+        job['arx'] = arx
+        job['arx_stat'] = get_stat(arx_path)
+        write_arx(job)
+
+def write_report(job, outfile, rebuild=False, processes=1, task=None):
+    """
+    Verify an archive (see verify_archive) and save the report as JSON.
+    :param outfile: Path of the JSON file to write
+    :return: Report dictionary
+    """
+    report = verify_archive(job, rebuild, processes, task)
+    os.makedirs(os.path.dirname(outfile) or '.', exist_ok=True)
+    with open(outfile, 'w') as fout:
+        json.dump(report, fout, indent=4)
+    return report